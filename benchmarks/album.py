@@ -0,0 +1,122 @@
+"""
+Benchmark of the albums that the admins send in the topics (TG_ALBUM_WINDOW, see tg/album.py): the time from the
+first message of an album until all its media was sent to whatsapp, when the messages are sent one after the other
+(TG_ALBUM_WINDOW=0) and when the media of the album is downloaded ahead while the previous ones are uploaded.
+
+--albums albums of --size photos are sent, --concurrency at a time, to the fakes of benchmarks/fakes.py: a download
+from telegram takes --download-latency seconds and an upload to whatsapp takes --upload-latency seconds (50%-150% of
+it). It also checks that the media of every album arrived in order. The album window itself is not in the latency.
+
+Usage:
+    python -m benchmarks.album --albums 50 --size 10 --download-latency 0.2 --upload-latency 0.05
+"""
+
+import argparse
+import asyncio
+import itertools
+import re
+import time
+
+from benchmarks import fakes
+
+from pyrogram import enums  # noqa: E402
+
+ITEM = re.compile(r"album(\d+) item(\d+)")
+
+
+class AlbumBenchmark:
+    def __init__(self, args: argparse.Namespace):
+        from data import config
+
+        self.args = args
+        self.settings = config.get_settings()
+        self.bridge = fakes.FakeBridge(faults=fakes.Faults(latency=args.upload_latency))
+        self.bridge.telegram.faults = fakes.Faults(latency=args.download_latency)
+        self.telegram = self.bridge.telegram
+        self.deliveries = self.bridge.deliveries
+        self._group_ids = itertools.count(1)
+        self.arrived: dict[str, list[int]] = {}
+        """example: {album: [item]} - by the order they arrived to whatsapp"""
+
+        delivered = self.deliveries.delivered
+
+        def record(text: str | None):
+            for album, item in ITEM.findall(text or ""):
+                self.arrived.setdefault(album, []).append(int(item))
+            delivered(text)
+
+        self.deliveries.delivered = record
+
+    async def send_album(self, topic_id: int, window: float) -> float:
+        """Send an album to the handlers, returns the seconds from its first message until all of it was sent"""
+        group_id = next(self._group_ids)
+        messages = [
+            self.telegram.message(
+                topic_id=topic_id,
+                caption=f"album{group_id} item{item} {self.deliveries.new_marker('album')}",
+                media=enums.MessageMediaType.PHOTO,
+                file_size=self.args.media_size_kb * 1024,
+                media_group_id=str(group_id) if window else None,
+            )
+            for item in range(self.args.size)
+        ]
+        started = time.perf_counter()
+        for msg in messages:  # pyrogram handles the updates of a chat one by one
+            await fakes.dispatch(self.telegram, msg)
+        while len(self.arrived.get(str(group_id), [])) < len(messages):
+            await asyncio.sleep(0.005)
+        return time.perf_counter() - started - window
+
+    async def measure(self, window: float) -> tuple[float, list[float]]:
+        self.settings.tg_album_window = window
+        topics = self.telegram.topics
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def send(index: int) -> float:
+            async with semaphore:
+                return await self.send_album(topics[index % len(topics)], window)
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(send(index) for index in range(self.args.albums)))
+        return time.perf_counter() - started, list(latencies)
+
+    async def run(self):
+        args = self.args
+        # a user for every album in flight, the first message creates the user and the topic
+        for i in range(args.concurrency):
+            message = fakes.wa_text(msg_id=f"wamid.album{i}", text=f"hello {self.deliveries.new_marker('setup')}")
+            await self.bridge.post_webhook(fakes.wa_update(wa_id=f"97250{i:07d}", name=f"User {i}", message=message))
+        await self.deliveries.wait(timeout=30)
+
+        print(
+            f"{args.albums} albums of {args.size} photos ({args.media_size_kb}KB), concurrency {args.concurrency}, "
+            f"download {args.download_latency * 1000:.0f}ms, upload {args.upload_latency * 1000:.0f}ms"
+        )
+        print(f"{'mode':<11} {'time':>8} {'albums/s':>9} {'p50':>9} {'p95':>9} {'max':>9}")
+        for mode, window in (("sequential", 0.0), ("pipelined", args.window)):
+            self.arrived.clear()
+            seconds, latencies = await self.measure(window)
+            print(
+                f"{mode:<11} {seconds:>7.2f}s {args.albums / seconds:>9.1f} "
+                + " ".join(f"{fakes.percentile(latencies, p) * 1000:>7.0f}ms" for p in (0.5, 0.95, 1.0))
+            )
+            unordered = sum(items != sorted(items) for items in self.arrived.values())
+            if unordered:
+                print(f"ERROR: {unordered} albums arrived out of order in the {mode} mode")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--albums", type=int, default=50)
+    parser.add_argument("--size", type=int, default=10, help="photos in an album (up to 10 in telegram)")
+    parser.add_argument("--concurrency", type=int, default=4, help="albums that are sent at the same time")
+    parser.add_argument("--media-size-kb", type=int, default=200)
+    parser.add_argument("--download-latency", type=float, default=0.2, help="seconds of a download from telegram")
+    parser.add_argument("--upload-latency", type=float, default=0.05, help="seconds of a request to whatsapp")
+    parser.add_argument("--window", type=float, default=0.1, help="TG_ALBUM_WINDOW of the pipelined mode")
+    args = parser.parse_args()
+    asyncio.run(AlbumBenchmark(args).run())
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,185 @@
+"""
+Benchmark of the cache of the workers (REDIS_URL, see data/cache_memory.py): how long a worker uses an old copy
+of a user after another worker changed it, and the hit rate of the cache.
+
+A writer process changes the name of a probe user to the time of the change, like a worker that bans a user,
+while reader processes read random users and the probe user, like the workers that handle their messages.
+Every reader measures the time from the change until it read the new name. With the memory cache (no
+REDIS_URL) the readers keep their first copy, and the changes they never saw are counted as missed.
+
+A local stand-in of redis (benchmarks/fakes.FakeRedis) is used when --redis-url is not given.
+
+Usage:
+    python -m benchmarks.cache_shared --readers 2 --updates 200 --interval 0.02
+    python -m benchmarks.cache_shared --redis-url redis://localhost:6379/0
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+PROBE = "972599999999"
+
+
+def run_writer(args: argparse.Namespace) -> dict:
+    """Run in the writer process, see main_cli"""
+    from data import numbers
+    from db import repositoy
+
+    time.sleep(max(args.start_at - time.time(), 0))
+    for _ in range(args.updates):
+        repositoy.update_user(wa_user_id=PROBE, phone_id=numbers.primary.phone_id, name=repr(time.time()))
+        time.sleep(args.interval)
+    return {}
+
+
+def run_reader(args: argparse.Namespace) -> dict:
+    """Run in the reader processes, see main_cli"""
+    from benchmarks import fakes
+    from data import cache_memory, numbers
+    from db import repositoy
+
+    stop_at = args.start_at + args.updates * args.interval + args.grace
+    last_name, staleness, reads, start = None, [], 0, time.time()
+    while time.time() < stop_at:
+        for _ in range(10):
+            repositoy.get_user_by_wa_id(
+                wa_id=f"97250{random.randrange(args.users):07d}", phone_id=numbers.primary.phone_id
+            )
+        name = repositoy.get_user_by_wa_id(wa_id=PROBE, phone_id=numbers.primary.phone_id).name
+        reads += 11
+        if name != last_name and last_name is not None:
+            staleness.append(time.time() - float(name))
+        last_name = name
+    return {
+        "reads_per_second": reads / (time.time() - start),
+        "seen": len(staleness),
+        "p50": fakes.percentile(staleness, 0.5),
+        "p99": fakes.percentile(staleness, 0.99),
+        "max": max(staleness, default=0.0),
+        **cache_memory.my_cache.get_hit_stats(),
+    }
+
+
+def run(args: argparse.Namespace):
+    from benchmarks import fakes
+    from data import numbers
+    from db import repositoy, tables
+
+    tables.create_tables()
+    phone_id, chat_id = numbers.primary.phone_id, numbers.primary.tg_group_id
+    for i in range(args.users):  # the users exist, the benchmark measures the cache
+        wa_id = f"97250{i:07d}"
+        repositoy.create_user_and_topic(
+            wa_id=wa_id,
+            bsuid=f"IL.{wa_id}",
+            name=f"User {i}",
+            username=None,
+            topic_id=i + 1,
+            phone_id=phone_id,
+            chat_id=chat_id,
+        )
+    repositoy.create_user_and_topic(
+        wa_id=PROBE,
+        bsuid=f"IL.{PROBE}",
+        name="0",
+        username=None,
+        topic_id=args.users + 1,
+        phone_id=phone_id,
+        chat_id=chat_id,
+    )
+
+    redis = None
+    if args.redis_url is None:
+        redis = fakes.FakeRedis()
+    redis_url = args.redis_url or redis.url
+
+    print(
+        f"{args.readers} readers, {args.users} users, {args.updates} changes every {args.interval * 1000:.0f}ms, "
+        f"{os.cpu_count()} cpus"
+    )
+    print(
+        f"{'cache':<7} {'reads/s':>9} {'hit rate':>9} {'local':>7} {'seen':>9} {'missed':>7} "
+        f"{'stale p50':>10} {'stale p99':>10} {'stale max':>10}"
+    )
+    for cache, url in (("memory", ""), ("shared", redis_url)):
+        start_at = time.time() + args.warmup  # the processes import the bot before the first change
+        common = [
+            f"--users={args.users}",
+            f"--updates={args.updates}",
+            f"--interval={args.interval}",
+            f"--grace={args.grace}",
+            f"--start-at={start_at}",
+        ]
+        env = {
+            **os.environ,
+            "REDIS_URL": url,
+            "CACHE_LOCAL_TTL": str(args.local_ttl),
+            "LOG_FILE_LEVEL": "WARNING",
+            "PYTHONPATH": fakes.cwd,
+        }
+        processes = [
+            subprocess.Popen(
+                [sys.executable, "-m", "benchmarks.cache_shared", f"--role={role}", *common],
+                cwd=fakes.cwd,
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                text=True,
+            )
+            for role in ["writer"] + ["reader"] * args.readers
+        ]
+        results = []
+        for process in processes:
+            stdout, stderr = process.communicate()
+            if process.returncode != 0:
+                print(f"{cache} failed:\n{stderr[-2000:]}")
+                return
+            results.append(json.loads(stdout.strip().splitlines()[-1]))
+
+        for result in results[1:]:
+            print(
+                f"{cache:<7} {result['reads_per_second']:>9,.0f} {result['hit_rate']:>9.1%} "
+                f"{result.get('local_hits', result['hits']) / max(result['hits'] + result['misses'], 1):>7.1%} "
+                f"{result['seen']:>4}/{args.updates:<4} {args.updates - result['seen']:>7} "
+                f"{result['p50'] * 1000:>8.1f}ms {result['p99'] * 1000:>8.1f}ms {result['max'] * 1000:>8.1f}ms"
+            )
+    if redis is not None:
+        print(f"the stand-in of redis handled {redis.commands:,} commands")
+        redis.close()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--readers", type=int, default=2)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--updates", type=int, default=200, help="changes of the probe user")
+    parser.add_argument("--interval", type=float, default=0.02, help="seconds between the changes")
+    parser.add_argument("--grace", type=float, default=2, help="seconds the readers keep reading after the last change")
+    parser.add_argument("--warmup", type=float, default=10, help="seconds for the processes to start")
+    parser.add_argument("--local-ttl", type=float, default=60, help="CACHE_LOCAL_TTL of the processes")
+    parser.add_argument("--redis-url", help="a real redis, default is the local stand-in")
+    parser.add_argument("--role", choices=("writer", "reader"), help=argparse.SUPPRESS)
+    parser.add_argument("--start-at", type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.role is None:
+        # before the bot modules are imported, the processes get it from the environment
+        os.environ["DATABASE_URL"] = (
+            f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='whatsgram-bench-'), 'bench.sqlite')}"
+        )
+        run(args)
+        return
+    from benchmarks import fakes  # noqa: F401, the environment of the bot
+
+    result = run_writer(args) if args.role == "writer" else run_reader(args)
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main_cli()
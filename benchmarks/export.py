@@ -0,0 +1,173 @@
+"""
+Benchmark of /export (see tg/export.py): the time, the peak memory and the size of the export of a conversation
+of growing length, and the lag of the event loop of the bot while it runs.
+
+The conversation is one of --users topics, its messages are between the messages of the other topics. The
+messages are read from the fake telegram with --latency seconds per request, the document is read by the fake
+telegram in parts like pyrogram uploads it. The memory is measured by tracemalloc, so it includes the pages of
+the database and of telegram, and the spooled file while it's in memory (EXPORT_SPOOL_MB).
+
+Usage:
+    python -m benchmarks.export --messages 1000,10000,100000
+"""
+
+import argparse
+import asyncio
+import datetime
+import os
+import time
+import tracemalloc
+
+PART_SIZE = 512 * 1024  # the parts of an upload of pyrogram
+
+
+def fill(users: int, messages: int):
+    """Add the users with their topics, and the messages of all the topics one after the other"""
+    from benchmarks import micro
+    from sqlalchemy import insert
+
+    from db.tables import create_tables, get_session, WaUser, Topic, Message
+
+    create_tables()
+    now = datetime.datetime.now()
+    with get_session() as session:
+        session.execute(
+            insert(Topic),
+            [
+                {
+                    "id": i + 1,
+                    "phone_id": micro.PHONE_ID,
+                    "chat_id": micro.CHAT_ID,
+                    "topic_id": i + 1,
+                    "name": f"User {i}",
+                    "created_at": now,
+                }
+                for i in range(users)
+            ],
+        )
+        session.execute(
+            insert(WaUser),
+            [
+                {
+                    "id": i + 1,
+                    "phone_id": micro.PHONE_ID,
+                    "wa_id": micro._wa_id(i),
+                    "name": f"User {i}",
+                    "created_at": now,
+                    "topic_id": i + 1,
+                }
+                for i in range(users)
+            ],
+        )
+        for start in range(0, messages * users, 10_000):
+            session.execute(
+                insert(Message),
+                [
+                    {
+                        "phone_id": micro.PHONE_ID,
+                        "chat_id": micro.CHAT_ID,
+                        "topic_msg_id": users + j + 1,
+                        "wa_msg_id": f"wamid.export{j}",
+                        "sent_from_tg": j % 3 == 0,
+                        "created_at": now,
+                        "topic_id": j % users + 1,
+                        "user_id": j % users + 1,
+                    }
+                    for j in range(start, min(start + 10_000, messages * users))
+                ],
+            )
+            session.commit()
+
+
+def clear():
+    from db.tables import get_session, WaUser, Topic, Message
+
+    with get_session() as session:
+        for table in (Message, WaUser, Topic):
+            session.query(table).delete()
+        session.commit()
+
+
+async def measure(fmt: str, latency: float) -> dict[str, float]:
+    """Export the first topic, returns the seconds, the peak memory, the size and the max lag of the loop"""
+    from benchmarks import fakes, micro
+    from data import clients
+    from db import repositoy
+    from tg import export
+
+    uploaded = {"size": 0}
+
+    class Telegram(fakes.FakeTelegram):
+        async def send_document(self, chat_id, document, *args, **kwargs):
+            await self._request()
+            while part := document.read(PART_SIZE):
+                uploaded["size"] += len(part)
+            return fakes._SentMessage(0)
+
+    clients.tg_bot = Telegram(faults=fakes.Faults(latency=latency), deliveries=fakes.Deliveries())
+    topic = repositoy.get_topic_by_topic_id(topic_id=1, chat_id=micro.CHAT_ID)
+
+    lag = {"max": 0.0}
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lag["max"] = max(lag["max"], time.perf_counter() - started - 0.01)
+
+    tick = asyncio.create_task(ticker())
+    tracemalloc.start()
+    started = time.perf_counter()
+    export.start(topic=topic, msg_id=1, fmt=fmt)
+    await asyncio.gather(*export._tasks.values())
+    seconds = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    done.set()
+    await tick
+    return {"seconds": seconds, "peak": peak, "size": uploaded["size"], "lag": lag["max"]}
+
+
+def run(args: argparse.Namespace):
+    from benchmarks import fakes  # noqa: F401, sets the environment of the bot before it's imported
+    from data import config
+
+    settings = config.get_settings()
+    print(
+        f"{args.users} topics, page {settings.export_page_size}, spool {settings.export_spool_mb:g}MB, "
+        f"telegram latency {args.latency * 1000:.0f}ms, {os.cpu_count()} cpus"
+    )
+    print(f"{'messages':>10} {'format':>6} {'time':>8} {'msg/s':>8} {'peak memory':>12} {'size':>10} {'max lag':>8}")
+    for messages in args.messages:
+        clear()
+        fill(args.users, messages)
+        for fmt in args.formats:
+            result = asyncio.run(measure(fmt, args.latency))
+            print(
+                f"{messages:>10,} {fmt:>6} {result['seconds']:>7.1f}s {messages / result['seconds']:>8,.0f} "
+                f"{result['peak'] / 1024 / 1024:>10.1f}MB {result['size'] / 1024 / 1024:>8.1f}MB "
+                f"{result['lag'] * 1000:>6.1f}ms"
+            )
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--messages", type=lambda value: [int(n) for n in value.split(",")], default=[1000, 10_000, 100_000],
+        help="messages of the exported conversation, comma separated",
+    )
+    parser.add_argument("--users", type=int, default=10, help="topics, the messages of all of them are in the table")
+    parser.add_argument("--formats", type=lambda value: value.split(","), default=["html", "jsonl"])
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds per request to telegram")
+    parser.add_argument("--page-size", type=int, default=100, help="EXPORT_PAGE_SIZE")
+    args = parser.parse_args()
+
+    # before the bot modules are imported, the settings are read once
+    os.environ["EXPORT_PAGE_SIZE"] = str(args.page_size)
+    os.environ.setdefault("LOG_FILE_LEVEL", "WARNING")
+    run(args)
+
+
+if __name__ == "__main__":
+    main_cli()
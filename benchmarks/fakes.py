@@ -0,0 +1,744 @@
+"""
+Local stand-ins for WhatsApp and Telegram, to run the bot without real accounts.
+
+Import this module before any module of the bot: it sets fake credentials and moves to a temporary
+working directory, so the database and the logs of the benchmark don't touch the real ones.
+
+- FakeGraphAPI: an httpx transport that answers the WhatsApp Cloud API requests of pywa
+- FakeTelegram: replaces the pyrogram client in `clients.tg_bot`
+- Deliveries: the latency from injecting a message until the other side got it, by a marker in the text
+- FakeCollector: an httpx transport that receives the OTLP/HTTP JSON exports of data/tracing.py and checks them
+- FakeRedis: a redis server (the commands of the shared cache) for the benchmarks with several processes
+"""
+
+import os
+import tempfile
+
+cwd = os.getcwd()
+workdir = tempfile.mkdtemp(prefix="whatsgram-bench-")
+os.environ.update(
+    TG_API_ID="1",
+    TG_API_HASH="fake",
+    TG_BOT_TOKEN="1:fake",
+    TG_GROUP_TOPIC_ID="-1001111111111",
+    WA_PHONE_ID="1111111",
+    WA_BUSINESS_ID="2222222",
+    WA_VERIFY_TOKEN="fake",
+    WA_TOKEN="fake",
+    WA_PHONE_NUMBER="972500000000",
+    WA_APP_ID="3333333",
+    WA_APP_SECRET="fake-app-secret",
+    WA_CALLBACK_URL="https://localhost",
+    WA_WEBHOOK_ENDPOINT="/whatsgrambot",
+    PORT="8080",
+    HTTPX_TIMEOUT="15.0",
+    DEBUG="false",
+)
+os.environ.setdefault("LOG_FILE_LEVEL", "INFO")
+os.chdir(workdir)
+
+import asyncio  # noqa: E402
+import concurrent.futures  # noqa: E402
+import dataclasses  # noqa: E402
+import datetime  # noqa: E402
+import fnmatch  # noqa: E402
+import hashlib  # noqa: E402
+import hmac  # noqa: E402
+import io  # noqa: E402
+import itertools  # noqa: E402
+import json  # noqa: E402
+import logging  # noqa: E402
+import random  # noqa: E402
+import re  # noqa: E402
+import socketserver  # noqa: E402
+import threading  # noqa: E402
+import time  # noqa: E402
+
+import httpx  # noqa: E402
+from pyrogram import enums, errors as tg_errors, handlers, types as tg_types  # noqa: E402
+from pyrogram.types.messages_and_media.message import Str  # noqa: E402
+
+from data import config, utils  # noqa: E402
+from tg import handlers as tg_handlers  # noqa: E402
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+MARKER = re.compile(r"#load(\d+)")
+
+
+def get_rss() -> int:
+    """The resident memory of the process in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:  # not linux, the peak instead
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values: list[float], percentile: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile))] if values else 0.0
+
+
+@dataclasses.dataclass
+class Faults:
+    """The behavior of the fake backends"""
+
+    latency: float = 0.05  # average seconds of every request, the actual latency is 50%-150% of it
+    flood_wait_rate: float = 0.0  # share of telegram requests that raise FloodWait
+    flood_wait_seconds: int = 1  # up to 10 seconds are slept by the client, like pyrogram, more are raised
+    error_rate: float = 0.0  # share of requests that fail
+    injected: dict[str, int] = dataclasses.field(default_factory=lambda: {"flood_wait": 0, "error": 0})
+
+    async def delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+    def should_fail(self) -> bool:
+        if random.random() < self.error_rate:
+            self.injected["error"] += 1
+            return True
+        return False
+
+    def should_flood(self) -> bool:
+        if random.random() < self.flood_wait_rate:
+            self.injected["flood_wait"] += 1
+            return True
+        return False
+
+
+class Deliveries:
+    """Match the messages that were injected to the messages that the fake backends got"""
+
+    def __init__(self):
+        self._sent: dict[int, tuple[str, float]] = {}
+        """example: {marker: (direction, time.perf_counter())}"""
+        self.latencies: dict[str, list[float]] = {}
+        """example: {"wa_to_tg": [0.1, 0.2]}"""
+        self._counter = itertools.count(1)
+        self.last_delivered_at = 0.0
+
+    def new_marker(self, direction: str) -> str:
+        """Return a marker to put in the text of an injected message"""
+        marker = next(self._counter)
+        self._sent[marker] = (direction, time.perf_counter())
+        return f"#load{marker}"
+
+    def delivered(self, text: str | None):
+        """Called by the fake backends with every text and caption they get"""
+        if not text:
+            return
+        for match in MARKER.finditer(text):
+            sent = self._sent.pop(int(match.group(1)), None)
+            if sent is not None:
+                direction, start = sent
+                self.last_delivered_at = time.perf_counter()
+                self.latencies.setdefault(direction, []).append(self.last_delivered_at - start)
+
+    @property
+    def pending(self) -> int:
+        return len(self._sent)
+
+    async def wait(self, timeout: float):
+        """Wait until all the injected messages are delivered, or the timeout"""
+        deadline = time.perf_counter() + timeout
+        while self._sent and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+
+
+# whatsapp
+
+
+def sign(body: bytes) -> str:
+    """The X-Hub-Signature-256 header of a webhook body"""
+    digest = hmac.new(settings.wa_app_secret.encode(), body, hashlib.sha256).hexdigest()
+    return f"sha256={digest}"
+
+
+def wa_update(*, wa_id: str, name: str, message: dict) -> dict:
+    """Wrap a message in a webhook update, as sent by the WhatsApp Cloud API"""
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [
+            {
+                "id": str(settings.wa_business_id),
+                "changes": [
+                    {
+                        "value": {
+                            "messaging_product": "whatsapp",
+                            "metadata": {
+                                "display_phone_number": str(settings.wa_phone_number),
+                                "phone_number_id": str(settings.wa_phone_id),
+                            },
+                            "contacts": [
+                                {"profile": {"name": name}, "wa_id": wa_id, "user_id": f"IL.{wa_id}"}
+                            ],
+                            "messages": [
+                                {
+                                    "from": wa_id,
+                                    "timestamp": str(int(time.time())),
+                                    **message,
+                                }
+                            ],
+                        },
+                        "field": "messages",
+                    }
+                ],
+            }
+        ],
+    }
+
+
+def wa_text(*, msg_id: str, text: str) -> dict:
+    return {"id": msg_id, "type": "text", "text": {"body": text}}
+
+
+def wa_media(*, msg_id: str, media_type: str, media_id: str, caption: str | None, **extra) -> dict:
+    """
+    :param media_type: image, video, document, audio or sticker
+    :param media_id: the id that FakeGraphAPI serves, see FakeGraphAPI.add_media
+    """
+    media = {
+        "id": media_id,
+        "mime_type": {"image": "image/jpeg", "video": "video/mp4", "audio": "audio/ogg", "sticker": "image/webp"}.get(
+            media_type, "application/pdf"
+        ),
+        "sha256": hashlib.sha256(media_id.encode()).hexdigest(),
+        **extra,
+    }
+    if caption is not None and media_type in ("image", "video", "document"):
+        media["caption"] = caption
+    return {"id": msg_id, "type": media_type, media_type: media}
+
+
+class FakeGraphAPI:
+    """Answer the requests of pywa like the WhatsApp Cloud API, pass `transport` to the httpx session"""
+
+    def __init__(self, faults: Faults, deliveries: Deliveries):
+        self.faults = faults
+        self.deliveries = deliveries
+        self.transport = httpx.MockTransport(self.handle)
+        self.requests = 0
+        self._media_sizes: dict[str, int] = {}
+        self.default_media_size = 1024  # bytes of media that was not added
+        self._ids = itertools.count(1)
+
+    def add_media(self, media_id: str, size: int):
+        """Serve media of this size for the media id"""
+        self._media_sizes[media_id] = size
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        await self.faults.delay()
+        if self.faults.should_fail():
+            return httpx.Response(
+                400,
+                json={
+                    "error": {
+                        "message": "(#131000) Something went wrong",
+                        "type": "OAuthException",
+                        "code": 131000,
+                        "error_data": {"messaging_product": "whatsapp", "details": "Injected error"},
+                        "fbtrace_id": "fake",
+                    }
+                },
+            )
+
+        if not request.url.host.startswith("graph."):  # media download
+            media_id = request.url.params.get("mid", "")
+            return httpx.Response(200, content=random.randbytes(self._media_sizes.get(media_id, self.default_media_size)))
+
+        path = request.url.path.rstrip("/")
+        if request.method == "POST" and path.endswith("/messages"):
+            body = json.loads(request.content)
+            if body.get("status") == "read":
+                return httpx.Response(200, json={"success": True})
+            content = body.get(body.get("type"), {})
+            self.deliveries.delivered(content.get("body") or content.get("caption"))
+            return httpx.Response(
+                200,
+                json={
+                    "messaging_product": "whatsapp",
+                    "contacts": [
+                        {"input": body["to"], "wa_id": body["to"]}
+                        if body.get("to")
+                        else {"input": body.get("recipient"), "user_id": body.get("recipient")}
+                    ],
+                    "messages": [{"id": f"wamid.fake{next(self._ids)}"}],
+                },
+            )
+        if request.method == "POST" and path.endswith("/media"):
+            return httpx.Response(200, json={"id": f"{next(self._ids)}"})
+        if request.method == "GET":
+            media_id = path.rsplit("/", maxsplit=1)[-1]
+            return httpx.Response(
+                200,
+                json={
+                    "messaging_product": "whatsapp",
+                    "url": f"https://lookaside.fbsbx.com/whatsapp_business/attachments/?mid={media_id}",
+                    "mime_type": "application/octet-stream",
+                    "sha256": hashlib.sha256(media_id.encode()).hexdigest(),
+                    "file_size": self._media_sizes.get(media_id, self.default_media_size),
+                    "id": media_id,
+                },
+            )
+        return httpx.Response(200, json={"success": True})
+
+
+# telegram
+
+
+class _SentMessage:
+    """The message that the fake telegram returns, only what the bot reads from it"""
+
+    def __init__(self, msg_id: int, media: enums.MessageMediaType | None = None):
+        self.id = msg_id
+        self.media = media
+        if media is not None:
+            setattr(self, media.name.lower(), tg_types.Document(file_id=f"fake{msg_id}", file_unique_id=f"fake{msg_id}"))
+
+    async def pin(self, *args, **kwargs):
+        return True
+
+
+class FakeTelegram:
+    """Replace the pyrogram client in `clients.tg_bot`, with the methods that the bot calls"""
+
+    def __init__(self, faults: Faults, deliveries: Deliveries):
+        self.faults = faults
+        self.deliveries = deliveries
+        self.requests = 0
+        self.topics: list[int] = []
+        self.user_topics: dict[str, int] = {}
+        """example: {wa_id: topic_id}"""
+        self.chats: dict[int, int] = {}
+        """example: {topic_id or msg_id: chat_id} - the group of the topics and the messages (TG_OVERFLOW_GROUP_IDS)"""
+        self._ids = itertools.count(1)
+        self.admin = tg_types.User(id=1000, first_name="Admin")
+        self.chat = tg_types.Chat(
+            id=settings.tg_group_topic_id, type=enums.ChatType.SUPERGROUP, is_forum=True, title="WhatsGram"
+        )
+        self.sleep_threshold = 10  # like pyrogram.Client
+        self.executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix="Handler")  # for sync filters
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return asyncio.get_running_loop()
+
+    async def _request(self):
+        self.requests += 1
+        await self.faults.delay()
+        if self.faults.should_flood():
+            if self.faults.flood_wait_seconds > self.sleep_threshold:
+                raise tg_errors.FloodWait(value=self.faults.flood_wait_seconds)
+            await asyncio.sleep(self.faults.flood_wait_seconds)  # pyrogram sleeps short flood waits itself
+        if self.faults.should_fail():
+            raise tg_errors.InternalServerError("Injected error")
+
+    async def _send(
+        self, chat_id: int, text: str | None, media: enums.MessageMediaType | None = None
+    ) -> _SentMessage:
+        await self._request()
+        self.deliveries.delivered(text)
+        sent = _SentMessage(next(self._ids), media)
+        self.chats[sent.id] = chat_id
+        return sent
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        return await self._send(chat_id, text)
+
+    async def send_photo(self, chat_id, photo, caption=None, *args, **kwargs):
+        return await self._send(chat_id, caption, enums.MessageMediaType.PHOTO)
+
+    async def send_video(self, chat_id, video, caption=None, *args, **kwargs):
+        return await self._send(chat_id, caption, enums.MessageMediaType.VIDEO)
+
+    async def send_document(self, chat_id, document, caption=None, *args, **kwargs):
+        return await self._send(chat_id, caption, enums.MessageMediaType.DOCUMENT)
+
+    async def send_audio(self, chat_id, audio, caption=None, *args, **kwargs):
+        return await self._send(chat_id, caption, enums.MessageMediaType.AUDIO)
+
+    async def send_voice(self, chat_id, voice, caption=None, *args, **kwargs):
+        return await self._send(chat_id, caption, enums.MessageMediaType.VOICE)
+
+    async def send_sticker(self, chat_id, sticker, *args, **kwargs):
+        return await self._send(chat_id, None, enums.MessageMediaType.STICKER)
+
+    async def send_contact(self, chat_id, *args, **kwargs):
+        return await self._send(chat_id, None)
+
+    async def send_location(self, chat_id, *args, **kwargs):
+        return await self._send(chat_id, None)
+
+    async def send_media_group(self, chat_id, media, *args, **kwargs):
+        await self._request()
+        sent = []
+        for item in media:
+            self.deliveries.delivered(item.caption)
+            sent.append(_SentMessage(next(self._ids), enums.MessageMediaType.DOCUMENT))
+            self.chats[sent[-1].id] = chat_id
+        return sent
+
+    async def set_reaction(self, *args, **kwargs):
+        await self._request()
+        return True
+
+    async def pin_chat_message(self, *args, **kwargs):
+        return True
+
+    async def create_forum_topic(self, chat_id, name, *args, **kwargs):
+        await self._request()
+        topic = _SentMessage(next(self._ids))  # the bot reads only the id
+        self.topics.append(topic.id)
+        self.chats[topic.id] = chat_id
+        self.user_topics[name.rsplit(" | ", maxsplit=1)[-1]] = topic.id
+        return topic
+
+    async def get_messages(self, chat_id, message_ids, *args, **kwargs):
+        """The messages of the topic (/export), the fake doesn't keep the texts: every message has a text"""
+        await self._request()
+        return [
+            tg_types.Message(
+                client=self,
+                id=msg_id,
+                chat=self._get_chat(msg_id),
+                date=datetime.datetime.now(),
+                text=Str(f"Message {msg_id} of the conversation").init([]),
+            )
+            for msg_id in message_ids
+        ]
+
+    async def get_chat_member(self, chat_id, user_id):
+        return tg_types.ChatMember(status=enums.ChatMemberStatus.ADMINISTRATOR, user=self.admin)
+
+    async def download_media(self, message, *args, in_memory: bool = False, **kwargs):
+        await self._request()
+        media = getattr(message, message.media.name.lower())
+        download = io.BytesIO(random.randbytes(utils.get_media_file(media).file_size or 1024))
+        download.name = getattr(media, "file_name", None) or "media"
+        return download
+
+    @staticmethod
+    def _media(media: enums.MessageMediaType, file_id: str, file_size: int, mime_type: str | None):
+        common = dict(file_id=file_id, file_unique_id=file_id, file_size=file_size)
+        match media:
+            case enums.MessageMediaType.PHOTO:
+                return tg_types.Photo(
+                    sizes=[tg_types.Thumbnail(**common, width=1280, height=720)],
+                    date=datetime.datetime.now(),
+                )
+            case enums.MessageMediaType.VIDEO:
+                return tg_types.Video(
+                    **common, width=1280, height=720, duration=10, mime_type=mime_type or "video/mp4"
+                )
+            case enums.MessageMediaType.ANIMATION:
+                return tg_types.Animation(**common, width=480, height=270, mime_type=mime_type or "video/mp4")
+            case enums.MessageMediaType.VIDEO_NOTE:
+                return tg_types.VideoNote(**common, length=240, duration=10, mime_type=mime_type or "video/mp4")
+            case enums.MessageMediaType.AUDIO:
+                return tg_types.Audio(**common, duration=180, mime_type=mime_type or "audio/mpeg")
+            case enums.MessageMediaType.VOICE:
+                return tg_types.Voice(**common, duration=5, mime_type=mime_type or "audio/ogg")
+            case enums.MessageMediaType.STICKER:
+                return tg_types.Sticker(
+                    **common, width=512, height=512, is_animated=False, is_video=False, mime_type="image/webp"
+                )
+            case _:
+                return tg_types.Document(
+                    **common, file_name=f"{file_id}.pdf", mime_type=mime_type or "application/pdf"
+                )
+
+    def _get_chat(self, msg_id: int) -> tg_types.Chat:
+        """The group of a topic or a message, the group of the primary number if it's unknown"""
+        chat_id = self.chats.get(msg_id, self.chat.id)
+        if chat_id == self.chat.id:
+            return self.chat
+        return tg_types.Chat(id=chat_id, type=enums.ChatType.SUPERGROUP, is_forum=True, title="WhatsGram")
+
+    def message(
+        self,
+        *,
+        topic_id: int,
+        text: str | None = None,
+        caption: str | None = None,
+        media: enums.MessageMediaType | None = None,
+        file_size: int = 1024,
+        mime_type: str | None = None,
+        media_group_id: str | None = None,
+        reply_to_message_id: int | None = None,
+    ) -> tg_types.Message:
+        """Build a message that an admin sent in the topic"""
+        msg_id = next(self._ids)
+        self.chats[msg_id] = self.chats.get(topic_id, self.chat.id)
+        kwargs = {}
+        if media is not None:
+            kwargs[media.name.lower()] = self._media(
+                media, f"{media.name.lower()}{msg_id}", file_size, mime_type
+            )
+        return tg_types.Message(
+            client=self,
+            id=msg_id,
+            chat=self._get_chat(msg_id),
+            from_user=self.admin,
+            date=datetime.datetime.now(),
+            text=Str(text).init([]) if text is not None else None,
+            caption=Str(caption).init([]) if caption is not None else None,
+            media=media,
+            media_group_id=media_group_id,
+            message_thread_id=topic_id,
+            is_topic_message=True,
+            reply_to_message_id=reply_to_message_id or topic_id,
+            **kwargs,
+        )
+
+    def reaction(self, *, message_id: int, emoji: str | None) -> tg_types.MessageReactionUpdated:
+        """Build a reaction of an admin, None to remove the reaction"""
+        return tg_types.MessageReactionUpdated(
+            client=self,
+            chat=self._get_chat(message_id),
+            message_id=message_id,
+            user=self.admin,
+            actor_chat=None,
+            date=datetime.datetime.now(),
+            old_reaction=[],
+            new_reaction=[tg_types.ReactionTypeEmoji(emoji=emoji)] if emoji else [],
+        )
+
+
+async def dispatch(client: FakeTelegram, update: tg_types.Message | tg_types.MessageReactionUpdated):
+    """Run the first handler of `tg.handlers.HANDLERS` that matches the update, like the pyrogram dispatcher"""
+    for handler in tg_handlers.HANDLERS:
+        if isinstance(update, tg_types.Message) and not isinstance(handler, handlers.MessageHandler):
+            continue
+        if isinstance(update, tg_types.MessageReactionUpdated) and not isinstance(
+            handler, handlers.MessageReactionUpdatedHandler
+        ):
+            continue
+        if await handler.check(client, update):
+            try:
+                await handler.callback(client, update)
+            except Exception:  # noqa
+                _logger.exception("Error in the handler of the update")
+            return
+
+
+class FakeBridge:
+    """The bot with the fake backends: the app of main.py, with `clients.wa_bot` and `clients.tg_bot` on the fakes"""
+
+    def __init__(self, faults: Faults):
+        import main
+        from data import clients, numbers
+        from db import tables
+
+        tables.create_tables()
+        self.faults = faults
+        self.deliveries = Deliveries()
+        self.graph_api = FakeGraphAPI(faults=faults, deliveries=self.deliveries)
+        self.telegram = FakeTelegram(faults=faults, deliveries=self.deliveries)
+
+        app = main.create_app()
+        clients.tg_bot = self.telegram
+        clients.wa_bots = main.create_wa_bots(app=app, transport=self.graph_api.transport)
+        clients.wa_bot = clients.wa_bots[numbers.primary.phone_id]
+        self.webhook = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://whatsgram", timeout=None
+        )
+
+    async def post_webhook(self, update: dict) -> int:
+        """Post a signed webhook update to the bot, returns the status code"""
+        body = json.dumps(update).encode()
+        res = await self.webhook.post(
+            settings.wa_webhook_endpoint,
+            content=body,
+            headers={"Content-Type": "application/json", "X-Hub-Signature-256": sign(body)},
+        )
+        return res.status_code
+
+
+class FakeCollector:
+    """
+    Receive the traces of data/tracing.py like an OpenTelemetry collector (OTLP/HTTP with JSON), pass `transport`
+    to the httpx session of the exporter. Every export is checked against the OTLP format, the spans of a bad
+    export are not kept and its problems are in `invalid`.
+    """
+
+    def __init__(self, faults: Faults):
+        self.faults = faults
+        self.transport = httpx.MockTransport(self.handle)
+        self.requests = 0
+        self.spans: dict[str, list[dict]] = {}
+        """example: {trace_id: [span]}"""
+        self.invalid: list[str] = []
+
+    @property
+    def received(self) -> int:
+        return sum(len(spans) for spans in self.spans.values())
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        await self.faults.delay()
+        if self.faults.should_fail():
+            return httpx.Response(503)
+        if request.method != "POST" or request.headers.get("content-type") != "application/json":
+            self.invalid.append(f"{request.method} {request.headers.get('content-type')}")
+            return httpx.Response(415)
+
+        spans, problems = self._check(json.loads(request.content))
+        if problems:
+            self.invalid.extend(problems)
+            return httpx.Response(400, json={"message": "; ".join(problems)})
+        for span in spans:
+            self.spans.setdefault(span["traceId"], []).append(span)
+        return httpx.Response(200, json={"partialSuccess": {}})
+
+    @staticmethod
+    def _check(body: dict) -> tuple[list[dict], list[str]]:
+        """The spans of the export, and what is wrong in it"""
+        spans, problems = [], []
+        for resource_spans in body.get("resourceSpans") or [None]:
+            if not isinstance(resource_spans, dict):
+                return [], ["no resourceSpans"]
+            attributes = {a.get("key"): a.get("value") for a in resource_spans.get("resource", {}).get("attributes", [])}
+            if "stringValue" not in (attributes.get("service.name") or {}):
+                problems.append("no service.name in the resource")
+            for scope_spans in resource_spans.get("scopeSpans", []):
+                spans.extend(scope_spans.get("spans", []))
+
+        span_ids = {(span.get("traceId"), span.get("spanId")) for span in spans}
+        for span in spans:
+            name = span.get("name")
+            if not re.fullmatch(r"[0-9a-f]{32}", span.get("traceId", "")) or span["traceId"] == "0" * 32:
+                problems.append(f"{name}: bad traceId {span.get('traceId')!r}")
+            if not re.fullmatch(r"[0-9a-f]{16}", span.get("spanId", "")) or span["spanId"] == "0" * 16:
+                problems.append(f"{name}: bad spanId {span.get('spanId')!r}")
+            if "parentSpanId" in span and (span.get("traceId"), span["parentSpanId"]) not in span_ids:
+                problems.append(f"{name}: the parent {span['parentSpanId']} is not in the export")
+            if not isinstance(span.get("kind"), int):
+                problems.append(f"{name}: kind is not an int")
+            start, end = span.get("startTimeUnixNano"), span.get("endTimeUnixNano")
+            if not (isinstance(start, str) and start.isdigit() and isinstance(end, str) and end.isdigit()):
+                problems.append(f"{name}: the times are not strings of nanoseconds")
+            elif int(start) > int(end):
+                problems.append(f"{name}: ends before it starts")
+        return spans, problems
+
+
+class FakeRedis:
+    """
+    A redis server in a thread, with the commands that data/cache_memory.TwoLevelCache uses
+    (GET, SET PX, DEL, SCAN, PUBLISH and SUBSCRIBE), so the processes of a benchmark can share a cache without redis
+    """
+
+    def __init__(self):
+        self._data: dict[bytes, tuple[bytes, float | None]] = {}
+        """example: {key: (value, expires_at)}"""
+        self._subscribers: dict[bytes, set[socketserver.StreamRequestHandler]] = {}
+        """example: {channel: {connection}}"""
+        self._lock = threading.Lock()
+        self.commands = 0
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                self.write_lock = threading.Lock()
+                try:
+                    while (command := fake._read_command(self.rfile)) is not None:
+                        fake.commands += 1
+                        self.send(fake._execute(self, command))
+                except (ConnectionError, OSError):
+                    pass
+                finally:
+                    with fake._lock:
+                        for subscribers in fake._subscribers.values():
+                            subscribers.discard(self)
+
+            def send(self, reply: bytes):
+                with self.write_lock:  # publish writes from the connection of the publisher
+                    self.wfile.write(reply)
+
+        self._server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f"redis://127.0.0.1:{self._server.server_address[1]}/0"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @staticmethod
+    def _read_command(rfile) -> list[bytes] | None:
+        line = rfile.readline()
+        if not line:
+            return None
+        command = []
+        for _ in range(int(line[1:])):  # *<count>, then $<length> and the value of every argument
+            length = int(rfile.readline()[1:])
+            command.append(rfile.read(length + 2)[:-2])
+        return command
+
+    @classmethod
+    def _encode(cls, value) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, int):
+            return b":%d\r\n" % value
+        if isinstance(value, list):
+            return b"*%d\r\n" % len(value) + b"".join(cls._encode(item) for item in value)
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    def _get(self, key: bytes) -> bytes | None:
+        value, expires_at = self._data.get(key, (None, None))
+        if expires_at is not None and expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def _execute(self, connection, command: list[bytes]) -> bytes:
+        name, args = command[0].upper(), command[1:]
+        with self._lock:
+            if name == b"PING":
+                return b"+PONG\r\n"
+            if name in (b"CLIENT", b"SELECT"):
+                return b"+OK\r\n"
+            if name == b"GET":
+                return self._encode(self._get(args[0]))
+            if name == b"SET":
+                expires_at = None
+                if len(args) > 3 and args[2].upper() == b"PX":
+                    expires_at = time.monotonic() + int(args[3]) / 1000
+                self._data[args[0]] = (args[1], expires_at)
+                return b"+OK\r\n"
+            if name == b"DEL":
+                return self._encode(sum(self._data.pop(key, None) is not None for key in args))
+            if name == b"SCAN":  # one page with all the keys
+                options = dict(zip(args[1::2], args[2::2]))
+                pattern = options.get(b"MATCH", b"*").decode()
+                keys = [key for key in list(self._data) if fnmatch.fnmatchcase(key.decode(), pattern)]
+                return self._encode([b"0", [key for key in keys if self._get(key) is not None]])
+            if name == b"PUBLISH":
+                subscribers = list(self._subscribers.get(args[0], ()))
+            elif name in (b"SUBSCRIBE", b"UNSUBSCRIBE"):
+                replies = []
+                for channel in args:
+                    subscribers = self._subscribers.setdefault(channel, set())
+                    if name == b"SUBSCRIBE":
+                        subscribers.add(connection)
+                    else:
+                        subscribers.discard(connection)
+                    count = sum(connection in subscribers for subscribers in self._subscribers.values())
+                    replies.append(self._encode([name.lower(), channel, count]))
+                return b"".join(replies)
+            else:
+                return b"-ERR unknown command '%s'\r\n" % name
+        message = self._encode([b"message", args[0], args[1]])
+        for subscriber in subscribers:
+            try:
+                subscriber.send(message)
+            except OSError:
+                pass
+        return self._encode(len(subscribers))
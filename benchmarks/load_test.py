@@ -0,0 +1,159 @@
+"""
+Load test of the bridge with fake WhatsApp and Telegram backends (see benchmarks/fakes.py).
+
+WhatsApp messages are posted as signed webhooks to the FastAPI app of main.py, and Telegram messages
+are passed to the handlers of tg/handlers.py. Prints the throughput, the latency percentiles
+(from injecting a message until the fake backend of the other side got it) and the memory.
+
+Usage:
+    python -m benchmarks.load_test --messages 2000 --concurrency 50 --media 0.2 --latency 0.05
+    python -m benchmarks.load_test --flood-wait 0.01 --errors 0.01
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from benchmarks import fakes
+
+from pyrogram import enums  # noqa: E402
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.faults = fakes.Faults(
+            latency=args.latency,
+            flood_wait_rate=args.flood_wait,
+            flood_wait_seconds=args.flood_wait_seconds,
+            error_rate=args.errors,
+        )
+        self.bridge = fakes.FakeBridge(faults=self.faults)
+        self.deliveries = self.bridge.deliveries
+        self.graph_api = self.bridge.graph_api
+        self.telegram = self.bridge.telegram
+        self.users = [(f"97250{i:07d}", f"User {i}") for i in range(args.users)]
+        self.wa_msg_ids = iter(range(1, 1_000_000_000))
+        self.webhook_errors = 0
+
+    async def send_wa(self, wa_id: str, name: str, media: bool):
+        msg_id = f"wamid.load{next(self.wa_msg_ids)}"
+        marker = self.deliveries.new_marker("wa_to_tg")
+        if media:
+            media_id = f"{random.getrandbits(48)}"
+            self.graph_api.add_media(media_id, self.args.media_size_kb * 1024)
+            media_type = random.choice(("image", "document"))
+            message = fakes.wa_media(
+                msg_id=msg_id,
+                media_type=media_type,
+                media_id=media_id,
+                caption=f"media {marker}",
+                **({"filename": f"{media_id}.pdf"} if media_type == "document" else {}),
+            )
+        else:
+            message = fakes.wa_text(msg_id=msg_id, text=f"hello *from* whatsapp {marker}")
+        status_code = await self.bridge.post_webhook(
+            fakes.wa_update(wa_id=wa_id, name=name, message=message)
+        )
+        if status_code != 200:
+            self.webhook_errors += 1
+
+    async def send_tg(self, topic_id: int, media: bool):
+        marker = self.deliveries.new_marker("tg_to_wa")
+        if media:
+            size = self.args.media_size_kb * 1024
+            msg = self.telegram.message(
+                topic_id=topic_id,
+                caption=f"media {marker}",
+                media=random.choice((enums.MessageMediaType.PHOTO, enums.MessageMediaType.DOCUMENT)),
+                file_size=size,
+            )
+        else:
+            msg = self.telegram.message(topic_id=topic_id, text=f"hello from telegram {marker}")
+        await fakes.dispatch(self.telegram, msg)
+
+    async def run(self):
+        args = self.args
+        # every user sends a first message, that creates the user and the topic, without faults
+        error_rate, flood_wait_rate = self.faults.error_rate, self.faults.flood_wait_rate
+        self.faults.error_rate = self.faults.flood_wait_rate = 0
+        await asyncio.gather(*(self.send_wa(wa_id, name, media=False) for wa_id, name in self.users))
+        await self.deliveries.wait(timeout=args.timeout)
+        self.deliveries.latencies.clear()
+        self.faults.error_rate, self.faults.flood_wait_rate = error_rate, flood_wait_rate
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+        rss = [fakes.get_rss()]
+
+        async def send_one():
+            async with semaphore:
+                media = random.random() < args.media
+                if args.direction == "wa" or (args.direction == "both" and random.random() < 0.5):
+                    await self.send_wa(*random.choice(self.users), media=media)
+                else:
+                    await self.send_tg(random.choice(self.telegram.topics), media=media)
+
+        async def sample_rss():
+            while True:
+                await asyncio.sleep(0.5)
+                rss.append(fakes.get_rss())
+
+        rss_task = asyncio.create_task(sample_rss())
+        start = time.perf_counter()
+        await asyncio.gather(*(send_one() for _ in range(args.messages)))
+        await self.deliveries.wait(timeout=args.timeout)
+        duration = self.deliveries.last_delivered_at - start
+        rss_task.cancel()
+        rss.append(fakes.get_rss())
+
+        delivered = sum(len(latencies) for latencies in self.deliveries.latencies.values())
+        print(
+            f"{args.messages} messages ({args.media:.0%} media of {args.media_size_kb}KB) from {args.users} users, "
+            f"concurrency {args.concurrency}, backend latency {args.latency * 1000:.0f}ms"
+        )
+        print(f"delivered {delivered} in {duration:.2f}s: {delivered / duration:,.1f} msg/s")
+        print(f"{'direction':<10} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+        for direction, latencies in sorted(self.deliveries.latencies.items()):
+            print(
+                f"{direction:<10} {len(latencies):>7} "
+                + " ".join(
+                    f"{fakes.percentile(latencies, percentile) * 1000:>7.0f}ms"
+                    for percentile in (0.5, 0.95, 0.99, 1.0)
+                )
+            )
+        print(
+            f"not delivered: {self.deliveries.pending}, webhook errors: {self.webhook_errors}, "
+            f"injected: {self.faults.injected}"
+        )
+        print(
+            f"requests: whatsapp {self.graph_api.requests}, telegram {self.telegram.requests}"
+        )
+        print(
+            f"rss: start {rss[0] / 1024 / 1024:.0f}MB, peak {max(rss) / 1024 / 1024:.0f}MB, "
+            f"end {rss[-1] / 1024 / 1024:.0f}MB"
+        )
+        print(f"the logs and the database are in {fakes.workdir}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=20, help="messages in flight")
+    parser.add_argument("--direction", choices=("both", "wa", "tg"), default="both")
+    parser.add_argument("--media", type=float, default=0.2, help="share of media messages")
+    parser.add_argument("--media-size-kb", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05, help="average seconds of every fake request")
+    parser.add_argument("--flood-wait", type=float, default=0.0, help="share of telegram requests with FloodWait")
+    parser.add_argument("--flood-wait-seconds", type=int, default=1)
+    parser.add_argument("--errors", type=float, default=0.0, help="share of requests that fail")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for the last deliveries")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    asyncio.run(LoadTest(args).run())
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,78 @@
+"""
+Benchmark of the logging cost in the event loop thread.
+
+Logs the debug messages of bridged messages (like repositoy.create_message) with the log file
+at DEBUG and at INFO, with and without the logging queue, and prints how many messages per second
+the caller can log and how long the log file took to be fully written.
+
+Usage:
+    python -m benchmarks.logging_throughput [messages]
+"""
+
+import atexit
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from data import config
+
+_logger = logging.getLogger("benchmarks.repositoy")
+
+
+def _bridge_message(i: int):
+    """The logs of one bridged message"""
+    _logger.debug(
+        "create message wa_id:%s, topic_id:%s, wa_msg_id:%s, topic_msg_id:%s, sent_from_tg:%s",
+        "972500000000",
+        1234,
+        f"wamid.{i:020d}",
+        i,
+        False,
+    )
+    _logger.debug(f"update user wa_user_id='972500000000', kwargs={{'active': True, 'msg': {i}}}")
+
+
+def _run(messages: int, use_queue: bool, file_level: str) -> tuple[float, float, int]:
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers.copy():
+        root_logger.removeHandler(handler)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "log.log")
+        listener = config.setup_logging(
+            use_queue=use_queue, queue_size=messages * 2, file_level=file_level, filename=filename
+        )
+
+        start = time.perf_counter()
+        for i in range(messages):
+            _bridge_message(i)
+        caller = time.perf_counter() - start
+
+        if listener is not None:
+            listener.stop()  # wait until the file is written
+            atexit.unregister(listener.stop)
+        total = time.perf_counter() - start
+        for handler in root_logger.handlers.copy():
+            handler.close()
+            root_logger.removeHandler(handler)
+        size = os.path.getsize(filename)
+
+    return caller, total, size
+
+
+def main():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    print(f"{'mode':<8} {'file level':<10} {'msg/s (caller)':>15} {'msg/s (written)':>16} {'log size':>10}")
+    for use_queue in (False, True):
+        for file_level in ("DEBUG", "INFO"):
+            caller, total, size = _run(messages, use_queue, file_level)
+            print(
+                f"{'queue' if use_queue else 'sync':<8} {file_level:<10} "
+                f"{messages / caller:>15,.0f} {messages / total:>16,.0f} {size / 1024:>8,.0f}KB"
+            )
+
+
+if __name__ == "__main__":
+    main()
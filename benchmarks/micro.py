@@ -0,0 +1,387 @@
+"""
+Micro-benchmarks of the building blocks of every bridged message: the memory cache, the queries of
+the repository (at growing table sizes), the text converters and the filter that creates the users.
+
+Every case is timed in ROUNDS rounds that take at least MIN_ROUND_SECONDS, the fastest round counts.
+The results are saved as json in benchmarks/results, and compared to the previous results file,
+so a regression between versions shows up as a number.
+
+Usage:
+    python -m benchmarks.micro
+    python -m benchmarks.micro --sizes 1000,100000 --only repositoy
+    python -m benchmarks.micro --compare benchmarks/results/micro_20260101-120000_1a2b3c4.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import gc
+import glob
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import typing
+
+from benchmarks import fakes
+
+from pywa_async import types as wa_types  # noqa: E402
+from sqlalchemy import func, insert, select  # noqa: E402
+
+from data import cache_memory, clients, numbers, utils  # noqa: E402
+from db import repositoy  # noqa: E402
+from db.tables import create_tables, get_session, WaUser, Topic, Message  # noqa: E402
+from wa import wa_bot  # noqa: E402
+
+MIN_ROUND_SECONDS = 0.1
+ROUNDS = 7
+MESSAGES_PER_USER = 5
+PHONE_ID = numbers.primary.phone_id  # the users of fill_tables belong to the primary number
+CHAT_ID = numbers.primary.tg_group_id  # and their topics are in its group
+_new_message_ids = itertools.count(10**12)  # above the ids of fill_tables
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+TEXTS = {
+    "short": "ok, thanks!",
+    "long": "The quick brown fox jumps over the lazy dog. " * 80,
+    "formatted": "**bold** __italic__ ~~strike~~ `code` ||spoiler|| [site](https://example.com) *wa* _wa_ ~wa~ " * 10,
+    "unicode": "שלום 👋 привет 你好 مرحبا " * 40,
+}
+
+
+def _measure(run: typing.Callable[[int], float]) -> float:
+    """
+    Seconds per call
+
+    :param run: runs the case `number` times, returns the seconds it took
+    """
+    gc.disable()  # like timeit, a collection in one round is noise
+    try:
+        number = 1
+        while run(number) < MIN_ROUND_SECONDS:
+            number *= 2
+        return min(run(number) for _ in range(ROUNDS)) / number
+    finally:
+        gc.enable()
+
+
+def _sync(case: typing.Callable[[], typing.Any]) -> typing.Callable[[int], float]:
+    def run(number: int) -> float:
+        start = time.perf_counter()
+        for _ in range(number):
+            case()
+        return time.perf_counter() - start
+
+    return run
+
+
+def _async(
+    loop: asyncio.AbstractEventLoop, case: typing.Callable[[], typing.Awaitable]
+) -> typing.Callable[[int], float]:
+    async def batch(number: int) -> float:
+        start = time.perf_counter()
+        for _ in range(number):
+            await case()
+        return time.perf_counter() - start
+
+    return lambda number: loop.run_until_complete(batch(number))
+
+
+def _wa_id(i: int) -> str:
+    return f"97250{i:07d}"
+
+
+def fill_tables(users: int):
+    """Add users (each with a topic) and MESSAGES_PER_USER messages per user, up to `users` users"""
+    create_tables()
+    with get_session() as session:
+        existing = session.scalar(select(func.count()).select_from(WaUser))
+        now = datetime.datetime.now()
+        for start in range(existing, users, 10_000):
+            chunk = range(start, min(start + 10_000, users))
+            session.execute(
+                insert(Topic),
+                [
+                    {
+                        "id": i + 1,
+                        "phone_id": PHONE_ID,
+                        "chat_id": CHAT_ID,
+                        "topic_id": i + 1,
+                        "name": f"User {i}",
+                        "created_at": now,
+                    }
+                    for i in chunk
+                ],
+            )
+            session.execute(
+                insert(WaUser),
+                [
+                    {
+                        "id": i + 1,
+                        "phone_id": PHONE_ID,
+                        "wa_id": _wa_id(i),
+                        "bsuid": f"IL.{_wa_id(i)}",
+                        "name": f"User {i}",
+                        "created_at": now,
+                        "topic_id": i + 1,
+                    }
+                    for i in chunk
+                ],
+            )
+            session.execute(
+                insert(Message),
+                [
+                    {
+                        "phone_id": PHONE_ID,
+                        "chat_id": CHAT_ID,
+                        "topic_msg_id": i * MESSAGES_PER_USER + j + 1_000_000,
+                        "wa_msg_id": f"wamid.{i * MESSAGES_PER_USER + j}",
+                        "sent_from_tg": j % 2 == 0,
+                        "created_at": now,
+                        "topic_id": i + 1,
+                        "user_id": i + 1,
+                    }
+                    for i in chunk
+                    for j in range(MESSAGES_PER_USER)
+                ],
+            )
+            session.commit()
+
+
+def bench_cache() -> dict[str, float]:
+    cache = cache_memory.MemoryCache()
+    cache.set(cache_name="bench", cache_id=cache.build_cache_id(wa_id="1"), cache_data="user")
+
+    @cache.cachable(cache_name="hit", params=("wa_id",))
+    def cached(*, wa_id: str) -> str:
+        return wa_id
+
+    @cache.cachable(cache_name="miss", params=("wa_id",))
+    def not_cached(*, wa_id: str) -> None:  # None is never cached
+        return None
+
+    keys = itertools.cycle(range(1000))
+    return {
+        "cache.build_cache_id": _measure(_sync(lambda: cache.build_cache_id(wa_id="1"))),
+        "cache.get[hit]": _measure(
+            _sync(lambda: cache.get(cache_name="bench", cache_id=cache.build_cache_id(wa_id="1")))
+        ),
+        "cache.get[miss]": _measure(
+            _sync(lambda: cache.get(cache_name="bench", cache_id=cache.build_cache_id(wa_id="2")))
+        ),
+        "cache.set": _measure(
+            _sync(lambda: cache.set(cache_name="set", cache_id=next(keys), cache_data="user"))
+        ),
+        "cache.cachable[hit]": _measure(_sync(lambda: cached(wa_id="1"))),
+        "cache.cachable[miss]": _measure(_sync(lambda: not_cached(wa_id="1"))),
+    }
+
+
+def bench_repository(users: int) -> dict[str, float]:
+    """The queries at `users` users, [db] skips the cache"""
+    rnd = random.Random(users)
+    sample = [rnd.randrange(users) for _ in range(1000)]
+    user_ids = itertools.cycle(sample)
+    message_ids = itertools.cycle([rnd.randrange(users * MESSAGES_PER_USER) for _ in range(1000)])
+    repositoy.cache.clear()
+    for i in sample:  # [cached] measures the hits
+        repositoy.get_user_by_wa_id(wa_id=_wa_id(i), phone_id=PHONE_ID)
+    results = {
+        "repositoy.get_user_by_wa_id[db]": _measure(
+            _sync(
+                lambda: repositoy.get_user_by_wa_id.__wrapped__(wa_id=_wa_id(next(user_ids)), phone_id=PHONE_ID)
+            )
+        ),
+        "repositoy.get_user_by_wa_id[db,bsuid]": _measure(
+            _sync(
+                lambda: repositoy.get_user_by_wa_id.__wrapped__(
+                    wa_id=f"IL.{_wa_id(next(user_ids))}", phone_id=PHONE_ID
+                )
+            )
+        ),
+        "repositoy.get_user_by_wa_id[cached]": _measure(
+            _sync(lambda: repositoy.get_user_by_wa_id(wa_id=_wa_id(next(user_ids)), phone_id=PHONE_ID))
+        ),
+        "repositoy.get_topic_by_topic_id[db]": _measure(
+            _sync(
+                lambda: repositoy.get_topic_by_topic_id.__wrapped__(topic_id=next(user_ids) + 1, chat_id=CHAT_ID)
+            )
+        ),
+        "repositoy.get_message[db,topic_msg_id]": _measure(
+            _sync(
+                lambda: repositoy.get_message.__wrapped__(
+                    topic_msg_id=next(message_ids) + 1_000_000, wa_msg_id=None, chat_id=CHAT_ID
+                )
+            )
+        ),
+        "repositoy.get_message[db,wa_msg_id]": _measure(
+            _sync(
+                lambda: repositoy.get_message.__wrapped__(
+                    topic_msg_id=None, wa_msg_id=f"wamid.{next(message_ids)}", chat_id=None
+                )
+            )
+        ),
+    }
+
+    def create_message():
+        i, msg_id = next(user_ids), next(_new_message_ids)
+        repositoy.create_message(
+            wa_id=_wa_id(i),
+            topic_id=i + 1,
+            wa_msg_id=f"wamid.{msg_id}",
+            topic_msg_id=msg_id,
+            sent_from_tg=False,
+            phone_id=PHONE_ID,
+            chat_id=CHAT_ID,
+        )
+
+    results["repositoy.create_message"] = _measure(_sync(create_message))
+    return {f"{name}@{users}": seconds for name, seconds in results.items()}
+
+
+def bench_texts() -> dict[str, float]:
+    results = {}
+    for name, text in TEXTS.items():
+        results[f"utils.get_tg_text_to_wa[{name}]"] = _measure(_sync(lambda: utils.get_tg_text_to_wa(text)))
+        results[f"utils.get_wa_text_to_tg[{name}]"] = _measure(_sync(lambda: utils.get_wa_text_to_tg(text)))
+    return results
+
+
+def bench_create_user_filter(loop: asyncio.AbstractEventLoop, users: int) -> dict[str, float]:
+    """The filter that runs before every whatsapp message, for users that exist"""
+    rnd = random.Random(users)
+    messages = [
+        wa_types.Message.from_update(
+            client=clients.wa_bot,
+            update=fakes.wa_update(
+                wa_id=_wa_id(i), name=f"User {i}", message=fakes.wa_text(msg_id=f"wamid.filter{i}", text="hi")
+            ),
+        )
+        for i in (rnd.randrange(users) for _ in range(100))
+    ]
+    for msg in messages:  # [cached] measures the hits
+        loop.run_until_complete(wa_bot._create_user(clients.wa_bot, msg))
+    messages = itertools.cycle(messages)
+
+    async def uncached():
+        repositoy.cache.delete(cache_name="get_user_by_wa_id")
+        await wa_bot._create_user(clients.wa_bot, next(messages))
+
+    results = {
+        "wa_bot._create_user[cached]": _measure(
+            _async(loop, lambda: wa_bot._create_user(clients.wa_bot, next(messages)))
+        ),
+        "wa_bot._create_user[db]": _measure(_async(loop, uncached)),
+    }
+    return {f"{name}@{users}": seconds for name, seconds in results.items()}
+
+
+def get_version() -> str:
+    """The git commit of the benchmarked code"""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(RESULTS_DIR),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def save(results: dict[str, float], sizes: list[int], directory: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    version = get_version()
+    created_at = datetime.datetime.now()
+    path = os.path.join(directory, f"micro_{created_at:%Y%m%d-%H%M%S}_{version}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "version": version,
+                "created_at": created_at.isoformat(timespec="seconds"),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "sizes": sizes,
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+    return path
+
+
+def compare(results: dict[str, float], baseline_path: str, threshold: float) -> int:
+    """Print the change of every case from the baseline, returns the count of regressions"""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\ncompared to {baseline['version']} ({baseline['created_at']}, python {baseline['python']}):")
+    print(f"{'case':<52} {'before':>10} {'after':>10} {'change':>8}")
+    regressions = 0
+    for name, seconds in results.items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        change = seconds / before - 1
+        regression = change > threshold
+        regressions += regression
+        print(
+            f"{name:<52} {before * 1e6:>8.2f}us {seconds * 1e6:>8.2f}us {change:>+7.0%}"
+            + ("  REGRESSION" if regression else "")
+        )
+    return regressions
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="users in the tables, comma separated")
+    parser.add_argument("--only", default=None, help="cache, utils, repositoy or wa_bot")
+    parser.add_argument("--output", default=RESULTS_DIR, help="directory of the results files")
+    parser.add_argument("--compare", default=None, help="results file to compare to, default is the last one")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown that counts as a regression")
+    parser.add_argument("--no-save", action="store_true")
+    args = parser.parse_args()
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+    output = os.path.join(fakes.cwd, args.output)
+    baseline = (
+        os.path.join(fakes.cwd, args.compare)
+        if args.compare
+        else max(glob.glob(os.path.join(output, "micro_*.json")), default=None, key=os.path.getmtime)
+    )
+
+    fakes.FakeBridge(faults=fakes.Faults(latency=0))  # clients.wa_bot, for the filter
+    loop = asyncio.new_event_loop()
+    benchmarks: list[tuple[str, typing.Callable[[], dict[str, float]]]] = [
+        ("cache", bench_cache),
+        ("utils", bench_texts),
+    ]
+    for size in sizes:
+        benchmarks.append((f"repositoy@{size}", lambda size=size: bench_repository(size)))
+        benchmarks.append((f"wa_bot@{size}", lambda size=size: bench_create_user_filter(loop, size)))
+
+    results: dict[str, float] = {}
+    print(f"{'case':<52} {'per call':>10} {'calls/s':>12}")
+    for group, benchmark in benchmarks:
+        if args.only and args.only not in group:
+            continue
+        if "@" in group:
+            fill_tables(int(group.split("@")[1]))
+        for name, seconds in benchmark().items():
+            results[name] = seconds
+            print(f"{name:<52} {seconds * 1e6:>8.2f}us {1 / seconds:>12,.0f}")
+
+    if not args.no_save:
+        print(f"\nsaved to {save(results, sizes, output)}")
+    if baseline:
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{regressions} regressions over {args.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,199 @@
+"""
+Benchmark of the whatsapp numbers of one bridge (WA_NUMBERS, see data/numbers.py): the memory, the connections
+and the throughput of the connection pools by the number of numbers.
+
+- bridge: a pool for every number, with one ssl context for all the pools (numbers.create_transport, like main.py)
+- default: a pool for every number with the defaults of httpx, every pool loads the certificates
+- one: one pool for all the numbers, with the connections of all the pools of bridge
+
+A local server stands in for the Graph API (it answers like benchmarks/fakes.FakeGraphAPI) and counts the
+connections that were opened to it. Every run is a new process with the numbers in WA_NUMBERS, that sends
+--messages messages from every number, --concurrency of every number at the same time.
+
+Usage:
+    python -m benchmarks.numbers --numbers 1,10,50 --messages 50 --concurrency 5 --latency 0.02
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+
+class _LocalGraphAPI(httpx.AsyncBaseTransport):
+    """Send the requests of the Graph API to the local server with the transport"""
+
+    def __init__(self, port: int, transport: httpx.AsyncHTTPTransport):
+        self._port = port
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        request.url = request.url.copy_with(scheme="http", host="127.0.0.1", port=self._port)
+        return await self._transport.handle_async_request(request)
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+
+async def run_numbers(args: argparse.Namespace) -> dict:
+    """Run in the process of every run, see main_cli"""
+    from benchmarks import fakes
+    import main
+    from data import numbers
+    from pywa_async import WhatsApp
+
+    settings = main.settings
+
+    rss_start = fakes.get_rss()
+    if args.pool == "one":
+        connections = settings.wa_max_connections * len(numbers.get_all())
+        transport = _LocalGraphAPI(
+            args.port,
+            httpx.AsyncHTTPTransport(
+                limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+            ),
+        )
+        wa_bots = main.create_wa_bots(app=None, transport=transport)
+    else:
+        wa_bots = {
+            number.phone_id: WhatsApp(
+                phone_id=number.phone_id,
+                token=number.token,
+                session=main.create_http_session(
+                    numbers.RateLimitedTransport(
+                        _LocalGraphAPI(
+                            args.port,
+                            numbers.create_transport() if args.pool == "bridge" else httpx.AsyncHTTPTransport(),
+                        ),
+                        number,
+                    )
+                ),
+            )
+            for number in numbers.get_all()
+        }
+    rss_clients = fakes.get_rss()
+
+    async def send(wa: WhatsApp, to: int):
+        for i in range(to, args.messages, args.concurrency):
+            await wa.send_message(to=f"97250{i:07d}", text=f"bench {i}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(wa, to) for wa in wa_bots.values() for to in range(args.concurrency)))
+    duration = time.perf_counter() - start
+    return {
+        "rss_clients": rss_clients - rss_start,
+        "rss_total": fakes.get_rss() - rss_start,
+        "per_second": len(wa_bots) * args.messages / duration,
+    }
+
+
+def _serve(port: int, latency: float) -> set[tuple[str, int]]:
+    """Start the local Graph API in a thread, returns the addresses of the connections that it got"""
+    import uvicorn
+    from fastapi import FastAPI, Request, Response
+
+    from benchmarks import fakes
+
+    graph_api = fakes.FakeGraphAPI(faults=fakes.Faults(latency=latency), deliveries=fakes.Deliveries())
+    connections = set()
+    app = FastAPI()
+
+    @app.api_route("/{path:path}", methods=["GET", "POST"])
+    async def handle(path: str, request: Request):
+        connections.add(tuple(request.client))
+        res = await graph_api.handle(
+            httpx.Request(request.method, f"https://graph.facebook.com/{path}", content=await request.body())
+        )
+        return Response(res.content, status_code=res.status_code, media_type="application/json")
+
+    server = uvicorn.Server(
+        uvicorn.Config(app=app, host="127.0.0.1", port=port, access_log=False, log_level="warning", log_config=None)
+    )
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return connections
+
+
+def run(args: argparse.Namespace):
+    from benchmarks import fakes
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    connections = _serve(port, args.latency)
+
+    print(
+        f"{args.messages} messages from every number, {args.concurrency} at the same time, "
+        f"backend latency {args.latency * 1000:.0f}ms, {os.cpu_count()} cpus"
+    )
+    print(
+        f"{'numbers':>7} {'pool':<8} {'connections':>11} {'rss clients':>12} {'rss total':>10} "
+        f"{'per number':>11} {'msg/s':>9}"
+    )
+    for count in (int(count) for count in args.numbers.split(",")):
+        wa_numbers = [
+            {"phone_id": str(2_000_000 + i), "tg_group_id": -1002000000000 - i} for i in range(count - 1)
+        ]
+        for pool in ("bridge", "default", "one"):
+            connections.clear()
+            process = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.numbers",
+                    f"--pool={pool}",
+                    f"--port={port}",
+                    f"--messages={args.messages}",
+                    f"--concurrency={args.concurrency}",
+                ],
+                cwd=fakes.cwd,
+                env={
+                    **os.environ,
+                    "WA_NUMBERS": json.dumps(wa_numbers),
+                    "WA_RATE": "0",  # the pools are measured, not the rate limit
+                    "METRICS": "false",
+                    "LOG_FILE_LEVEL": "WARNING",
+                    "PYTHONPATH": fakes.cwd,
+                },
+                capture_output=True,
+                text=True,
+            )
+            if process.returncode != 0:  # one pool for many numbers can be too slow for the server
+                print(f"{count:>7} {pool:<8} failed: {process.stderr.strip().splitlines()[-1]}")
+                continue
+            result = json.loads(process.stdout.strip().splitlines()[-1])
+            print(
+                f"{count:>7} {pool:<8} {len(connections):>11} {result['rss_clients'] / 1024 / 1024:>10.1f}MB "
+                f"{result['rss_total'] / 1024 / 1024:>8.1f}MB {result['rss_total'] / count / 1024:>9.0f}KB "
+                f"{result['per_second']:>9,.0f}"
+            )
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--numbers", default="1,10,50", help="number counts to compare, comma separated")
+    parser.add_argument("--messages", type=int, default=50, help="messages from every number")
+    parser.add_argument("--concurrency", type=int, default=5, help="messages of every number at the same time")
+    parser.add_argument("--latency", type=float, default=0.02, help="average seconds of every request")
+    parser.add_argument("--pool", choices=("bridge", "default", "one"), help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    from benchmarks import fakes  # noqa: F401, the environment of the bot
+
+    if args.pool is None:
+        run(args)
+        return
+    print(json.dumps(asyncio.run(run_numbers(args))))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,224 @@
+"""
+Replay traffic that was recorded with RECORD_TRAFFIC_FILE (see data/recorder.py) against the fake
+WhatsApp and Telegram backends (see benchmarks/fakes.py), to benchmark every release on the same workload.
+
+The events are sent at the recorded times divided by --speed (0 sends them as fast as possible).
+Prints the time the bot took to handle every kind of event, the throughput and the memory (RSS).
+
+Replies and reactions to messages that the bot sent while recording can't be matched in the replay,
+they take the path of a message that is not in the database.
+
+Usage:
+    python -m benchmarks.replay traffic.jsonl --speed 10
+    python -m benchmarks.replay traffic.jsonl --speed 0 --latency 0.1 --media-size-kb 500
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+from benchmarks import fakes
+
+from pyrogram import enums  # noqa: E402
+
+_logger = logging.getLogger(__name__)
+
+settings = fakes.settings
+
+
+def load_events(path: str) -> list[dict]:
+    """Load the recorded events, a partially written last line is skipped"""
+    events = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                continue
+    return sorted(events, key=lambda event: event["t"])
+
+
+def _get_user(event: dict) -> str | None:
+    """The user of the event, the events of a user are replayed one by one like whatsapp delivers them"""
+    if event["src"] == "tg":
+        return event.get("user")
+    value = event["body"]["entry"][0]["changes"][0]["value"]
+    for contact in value.get("contacts", []):
+        return contact.get("wa_id") or contact.get("user_id")
+    for status in value.get("statuses", []):
+        return status.get("recipient_id") or status.get("recipient_user_id")
+    return None
+
+
+def _get_wa_kind(update: dict) -> str:
+    value = update["entry"][0]["changes"][0]["value"]
+    if value.get("messages"):
+        return f"wa_{value['messages'][0]['type']}"
+    if value.get("statuses"):
+        return f"wa_status_{value['statuses'][0]['status']}"
+    return f"wa_{update['entry'][0]['changes'][0]['field']}"
+
+
+class Replay:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.faults = fakes.Faults(
+            latency=args.latency, flood_wait_rate=args.flood_wait, error_rate=args.errors
+        )
+        self.bridge = fakes.FakeBridge(faults=self.faults)
+        self.bridge.graph_api.default_media_size = args.media_size_kb * 1024
+        self.telegram = self.bridge.telegram
+        self.durations: dict[str, list[float]] = {}
+        """example: {"wa_text": [0.1, 0.2]}"""
+        self.message_ids: dict[int, int] = {}
+        """example: {recorded message id: replayed message id}"""
+        self.failed = 0
+        self._creating: dict[str, asyncio.Task] = {}
+        self._user_locks: dict[str | None, asyncio.Lock] = {}
+
+    async def _post_wa(self, update: dict) -> int:
+        for entry in update.get("entry", []):
+            entry["id"] = str(settings.wa_business_id)
+            for change in entry.get("changes", []):
+                change.setdefault("value", {})["metadata"] = {
+                    "display_phone_number": str(settings.wa_phone_number),
+                    "phone_number_id": str(settings.wa_phone_id),
+                }
+                # the time of the replay, not of the recording (the tracing measures the webhook delay)
+                value = change.get("value", {})
+                for item in value.get("messages", []) + value.get("statuses", []):
+                    item["timestamp"] = str(int(time.time()))
+        return await self.bridge.post_webhook(update)
+
+    async def _get_topic(self, user: str | None) -> int | None:
+        """The topic of the user in the replay, the user is created if it didn't send a message yet"""
+        if user is None:
+            return None
+        if user not in self.telegram.user_topics:
+            if user not in self._creating:
+                self._creating[user] = asyncio.create_task(self._create_user(user))
+            await self._creating[user]
+        return self.telegram.user_topics.get(user)
+
+    async def _create_user(self, user: str):
+        is_phone = user.isdigit()
+        update = fakes.wa_update(
+            wa_id=user if is_phone else "",
+            name="Replay",
+            message=fakes.wa_text(msg_id=f"wamid.replay{user}", text="replay"),
+        )
+        if not is_phone:
+            update["entry"][0]["changes"][0]["value"]["contacts"][0]["user_id"] = user
+        await self._post_wa(update)
+
+    async def _replay_tg(self, event: dict):
+        if event["kind"] == "reaction":
+            update = self.telegram.reaction(
+                message_id=self.message_ids.get(event["message_id"], event["message_id"]),
+                emoji=event["emoji"],
+            )
+        else:
+            topic_id = await self._get_topic(event["user"])
+            if topic_id is None:
+                return
+            update = self.telegram.message(
+                topic_id=topic_id,
+                text=event["text"],
+                caption=event["caption"],
+                media=enums.MessageMediaType[event["media"].upper()] if event["media"] else None,
+                file_size=event["file_size"] or self.args.media_size_kb * 1024,
+                mime_type=event["mime_type"],
+                media_group_id=event["media_group_id"],
+                reply_to_message_id=self.message_ids.get(event["reply_to"]),
+            )
+            self.message_ids[event["id"]] = update.id
+        await fakes.dispatch(self.telegram, update)
+
+    async def replay_event(self, event: dict):
+        user = _get_user(event)
+        if user is None:
+            await self._replay_event(event)
+            return
+        async with self._user_locks.setdefault(user, asyncio.Lock()):
+            await self._replay_event(event)
+
+    async def _replay_event(self, event: dict):
+        if event["src"] == "wa":
+            kind = _get_wa_kind(event["body"])
+        else:
+            kind = f"tg_{event['media'] or 'text'}" if event["kind"] == "message" else "tg_reaction"
+        start = time.perf_counter()
+        try:
+            if event["src"] == "wa":
+                if await self._post_wa(event["body"]) != 200:
+                    self.failed += 1
+            else:
+                await self._replay_tg(event)
+        except Exception as e:  # noqa
+            self.failed += 1
+            _logger.exception(f"Error replaying {kind}: {e}")
+        self.durations.setdefault(kind, []).append(time.perf_counter() - start)
+
+    async def run(self):
+        events = load_events(self.args.file)
+        if not events:
+            print("no events to replay")
+            return
+        recorded = events[-1]["t"] - events[0]["t"]
+        rss = [fakes.get_rss()]
+
+        tasks = []
+        start = time.perf_counter()
+        for event in events:
+            if self.args.speed > 0:
+                delay = start + (event["t"] - events[0]["t"]) / self.args.speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    rss.append(fakes.get_rss())
+            tasks.append(asyncio.create_task(self.replay_event(event)))
+        await asyncio.gather(*tasks)
+        duration = time.perf_counter() - start
+        rss.append(fakes.get_rss())
+
+        print(
+            f"replayed {len(events)} events ({recorded:.0f}s recorded) in {duration:.2f}s "
+            f"at speed {self.args.speed or 'max'}: {len(events) / duration:,.1f} events/s"
+        )
+        print(f"{'kind':<24} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+        for kind, durations in sorted(self.durations.items()):
+            print(
+                f"{kind:<24} {len(durations):>7} "
+                + " ".join(
+                    f"{fakes.percentile(durations, percentile) * 1000:>7.0f}ms"
+                    for percentile in (0.5, 0.95, 0.99, 1.0)
+                )
+            )
+        print(f"failed: {self.failed}, injected: {self.faults.injected}")
+        print(
+            f"requests: whatsapp {self.bridge.graph_api.requests}, telegram {self.telegram.requests}"
+        )
+        print(
+            f"rss: start {rss[0] / 1024 / 1024:.0f}MB, peak {max(rss) / 1024 / 1024:.0f}MB, "
+            f"end {rss[-1] / 1024 / 1024:.0f}MB"
+        )
+        print(f"the logs and the database are in {fakes.workdir}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", help="the file of RECORD_TRAFFIC_FILE")
+    parser.add_argument("--speed", type=float, default=1, help="1 for the recorded pace, 0 for max speed")
+    parser.add_argument("--media-size-kb", type=int, default=200, help="size of media with unknown size")
+    parser.add_argument("--latency", type=float, default=0.05, help="average seconds of every fake request")
+    parser.add_argument("--flood-wait", type=float, default=0.0, help="share of telegram requests with FloodWait")
+    parser.add_argument("--errors", type=float, default=0.0, help="share of requests that fail")
+    args = parser.parse_args()
+    args.file = os.path.join(fakes.cwd, args.file)  # fakes moved to a temporary directory
+    asyncio.run(Replay(args).run())
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,245 @@
+"""
+Benchmark of the retention of the messages (MESSAGE_RETENTION_DAYS, see data/retention.py): the size of the
+database and the time of the queries before and after the old messages were archived and deleted, and the
+latency of the writes of the bot while the retention runs.
+
+The messages are spread over --days days, the oldest first like the bot creates them, and the retention keeps the
+last --retention days. While the retention and the incremental vacuum run, a thread saves a message every
+--probe-interval seconds (like the bot that bridges messages), its latency is compared to the same writes
+without the retention.
+
+Usage:
+    python -m benchmarks.retention --users 2000 --messages 200000 --days 90 --retention 30
+"""
+
+import argparse
+import asyncio
+import datetime
+import itertools
+import os
+import threading
+import time
+
+_new_ids = itertools.count(10**8)  # above the ids of fill, for the messages that the benchmark saves
+
+
+def fill(users: int, messages: int, days: float):
+    """Add the users with their topics, and the messages spread over the days"""
+    from benchmarks import micro
+    from sqlalchemy import insert
+
+    from db.tables import create_tables, get_session, WaUser, Topic, Message
+
+    create_tables()
+    now = datetime.datetime.now()
+    with get_session() as session:
+        session.execute(
+            insert(Topic),
+            [
+                {
+                    "id": i + 1,
+                    "phone_id": micro.PHONE_ID,
+                    "chat_id": micro.CHAT_ID,
+                    "topic_id": i + 1,
+                    "name": f"User {i}",
+                    "created_at": now,
+                }
+                for i in range(users)
+            ],
+        )
+        session.execute(
+            insert(WaUser),
+            [
+                {
+                    "id": i + 1,
+                    "phone_id": micro.PHONE_ID,
+                    "wa_id": micro._wa_id(i),
+                    "bsuid": f"IL.{micro._wa_id(i)}",
+                    "name": f"User {i}",
+                    "created_at": now,
+                    "topic_id": i + 1,
+                }
+                for i in range(users)
+            ],
+        )
+        for start in range(0, messages, 10_000):
+            session.execute(
+                insert(Message),
+                [
+                    {
+                        "phone_id": micro.PHONE_ID,
+                        "chat_id": micro.CHAT_ID,
+                        "topic_msg_id": j + 1,
+                        "wa_msg_id": f"wamid.HBgMOTcyNTAxMjM0NTY3FQIAEhggQkVOQ0g{j:012d}",
+                        "sent_from_tg": j % 2 == 0,
+                        "created_at": now - datetime.timedelta(days=days) * (1 - j / messages),
+                        "topic_id": j % users + 1,
+                        "user_id": j % users + 1,
+                    }
+                    for j in range(start, min(start + 10_000, messages))
+                ],
+            )
+            session.commit()
+
+
+def get_size() -> int:
+    """The bytes of the database and its WAL"""
+    from db.tables import engine
+
+    path = engine.url.database
+    return sum(os.path.getsize(file) for file in (path, f"{path}-wal") if os.path.exists(file))
+
+
+def measure_queries(users: int, messages: int) -> dict[str, float]:
+    """Seconds per query, without the cache"""
+    from benchmarks import micro
+
+    from db import repositoy
+
+    recent = itertools.cycle(range(max(messages - 1000, 1), messages + 1))  # the newest messages of fill
+    user_ids = itertools.cycle(range(users))
+
+    def create_message():
+        i, msg_id = next(user_ids), next(_new_ids)
+        repositoy.create_message(
+            wa_id=micro._wa_id(i),
+            topic_id=i + 1,
+            wa_msg_id=f"wamid.new{msg_id}",
+            topic_msg_id=msg_id,
+            sent_from_tg=False,
+            phone_id=micro.PHONE_ID,
+            chat_id=micro.CHAT_ID,
+        )
+
+    window_start = datetime.datetime.now() - datetime.timedelta(days=1)
+    return {
+        "get_message[topic_msg_id]": micro._measure(
+            micro._sync(
+                lambda: repositoy.get_message.__wrapped__(
+                    topic_msg_id=next(recent), wa_msg_id=None, chat_id=micro.CHAT_ID
+                )
+            )
+        ),
+        "get_message[wa_msg_id]": micro._measure(
+            micro._sync(
+                lambda: repositoy.get_message.__wrapped__(
+                    topic_msg_id=None, wa_msg_id=f"wamid.HBgMOTcyNTAxMjM0NTY3FQIAEhggQkVOQ0g{next(recent) - 1:012d}",
+                    chat_id=None,
+                )
+            )
+        ),
+        "get_last_message": micro._measure(
+            micro._sync(
+                lambda: repositoy.get_last_message(wa_id=micro._wa_id(next(user_ids)), phone_id=micro.PHONE_ID)
+            )
+        ),
+        "count_broadcast_users": micro._measure(
+            micro._sync(
+                lambda: repositoy.count_broadcast_users(window_start=window_start, phone_id=micro.PHONE_ID)
+            )
+        ),
+        "create_message": micro._measure(micro._sync(create_message)),
+    }
+
+
+def probe_writes(seconds: float, interval: float, stop: threading.Event | None = None) -> list[float]:
+    """Save a message every interval, returns the latency of every write"""
+    from benchmarks import micro
+
+    from db import repositoy
+
+    latencies = []
+    deadline = time.monotonic() + seconds
+    while (stop is None and time.monotonic() < deadline) or (stop is not None and not stop.is_set()):
+        msg_id = next(_new_ids)
+        start = time.perf_counter()
+        repositoy.create_message(
+            wa_id=micro._wa_id(msg_id % 10),
+            topic_id=msg_id % 10 + 1,
+            wa_msg_id=f"wamid.probe{msg_id}",
+            topic_msg_id=msg_id,
+            sent_from_tg=True,
+            phone_id=micro.PHONE_ID,
+            chat_id=micro.CHAT_ID,
+        )
+        latencies.append(time.perf_counter() - start)
+        time.sleep(interval)
+    return latencies
+
+
+def run(args: argparse.Namespace):
+    from benchmarks import fakes
+    from data import retention
+    from db import repositoy
+
+    print(
+        f"{args.messages:,} messages of {args.users:,} users over {args.days:g} days, retention {args.retention:g} days, "
+        f"{os.cpu_count()} cpus"
+    )
+    started = time.perf_counter()
+    fill(args.users, args.messages, args.days)
+    repositoy.checkpoint()
+    print(f"filled in {time.perf_counter() - started:.1f}s")
+
+    size_before = get_size()
+    queries_before = measure_queries(args.users, args.messages)
+    baseline = probe_writes(args.probe_seconds, args.probe_interval)
+
+    stop = threading.Event()
+    during: list[float] = []
+    probe = threading.Thread(
+        target=lambda: during.extend(probe_writes(0, args.probe_interval, stop)), daemon=True
+    )
+    probe.start()
+    started = time.perf_counter()
+    asyncio.run(retention.run_once())
+    duration = time.perf_counter() - started
+    stop.set()
+    probe.join()
+
+    repositoy.checkpoint()
+    size_after = get_size()
+    queries_after = measure_queries(args.users, args.messages)
+    stats = retention.get_stats()
+
+    print(
+        f"retention: {stats['deleted']:,} messages deleted ({stats['archived']:,} archived) and "
+        f"{stats['vacuumed_pages']:,} pages vacuumed in {duration:.1f}s"
+    )
+    print(f"{'':<28} {'before':>10} {'after':>10}")
+    print(f"{'database size':<28} {size_before / 1024 / 1024:>8.1f}MB {size_after / 1024 / 1024:>8.1f}MB")
+    for name, seconds in queries_before.items():
+        print(f"{name:<28} {seconds * 1e6:>8.0f}us {queries_after[name] * 1e6:>8.0f}us")
+    print(f"{'writes while':<28} {'idle':>10} {'retention':>10}")
+    for name, q in (("p50", 0.5), ("p99", 0.99)):
+        print(
+            f"{'write latency ' + name:<28} {fakes.percentile(baseline, q) * 1000:>8.1f}ms "
+            f"{fakes.percentile(during, q) * 1000:>8.1f}ms"
+        )
+    print(f"{'write latency max':<28} {max(baseline) * 1000:>8.1f}ms {max(during, default=0) * 1000:>8.1f}ms")
+    archive = os.path.abspath(os.path.join(fakes.workdir, retention.settings.message_archive_dir or ""))
+    if os.path.isdir(archive):
+        archived = sum(os.path.getsize(os.path.join(archive, name)) for name in os.listdir(archive))
+        print(f"archive: {archived / 1024 / 1024:.1f}MB in {archive}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--messages", type=int, default=200_000)
+    parser.add_argument("--days", type=float, default=90, help="the messages are spread over these days")
+    parser.add_argument("--retention", type=float, default=30, help="MESSAGE_RETENTION_DAYS")
+    parser.add_argument("--batch-size", type=int, default=1000, help="RETENTION_BATCH_SIZE")
+    parser.add_argument("--probe-interval", type=float, default=0.005, help="seconds between the probe writes")
+    parser.add_argument("--probe-seconds", type=float, default=3, help="seconds of probe writes without retention")
+    args = parser.parse_args()
+
+    # before the bot modules are imported, the settings are read once
+    os.environ["MESSAGE_RETENTION_DAYS"] = str(args.retention)
+    os.environ["RETENTION_BATCH_SIZE"] = str(args.batch_size)
+    os.environ.setdefault("LOG_FILE_LEVEL", "WARNING")
+    run(args)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,172 @@
+"""
+Benchmark of the scale out (WORKERS, see data/sharding.py): the throughput of WhatsApp messages by the number of workers.
+
+The router of the bot forwards signed webhooks to worker processes, that run the bot on the fakes of
+benchmarks/fakes.py and share one database. Every message carries its user, its number in the conversation
+and the time it was sent, so the workers measure the latency and check that the messages of every
+conversation arrived to Telegram in order.
+
+Use a low --latency to measure the cpu of the workers. The throughput grows with the workers up to the cores
+of the machine, and up to the write lock of sqlite (use --database-url with postgres).
+
+Usage:
+    python -m benchmarks.scale_out --workers 1,2,4 --messages 4000 --users 200 --latency 0.005
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+TEXT = re.compile(r"bench u(\d+) s(\d+) t([\d.]+)")
+
+
+class _Receiver:
+    """Replaces fakes.Deliveries in the worker, the time and the order are read from the text"""
+
+    def __init__(self):
+        self.latencies: list[float] = []
+        self.last_seq: dict[int, int] = {}
+        """example: {user: the number of the last message of the user that arrived}"""
+        self.out_of_order = 0
+        self.last_delivered_at = 0.0
+
+    def delivered(self, text: str | None):
+        match = TEXT.search(text or "")
+        if match is None:
+            return
+        user, seq, sent_at = int(match.group(1)), int(match.group(2)), float(match.group(3))
+        self.last_delivered_at = time.time()
+        self.latencies.append(self.last_delivered_at - sent_at)
+        if seq <= self.last_seq.get(user, -1):
+            self.out_of_order += 1
+        self.last_seq[user] = seq
+
+
+async def run_worker(args: argparse.Namespace):
+    """Run in the worker processes that the router starts"""
+    from benchmarks import fakes
+    from data import sharding
+
+    index = int(os.environ[sharding.WORKER_ENV])
+    bridge = fakes.FakeBridge(faults=fakes.Faults(latency=args.latency))
+    bridge.telegram._ids = itertools.count(args.id_base + index * 10**8)  # unique message ids in the shared database
+    receiver = bridge.telegram.deliveries = bridge.graph_api.deliveries = _Receiver()
+
+    await sharding.serve(index=index, path=os.environ[sharding.ROUTER_ENV])
+    with open(os.path.join(args.results, f"worker{index}.json"), "w") as f:
+        json.dump(
+            {
+                "latencies": receiver.latencies,
+                "out_of_order": receiver.out_of_order,
+                "last_delivered_at": receiver.last_delivered_at,
+            },
+            f,
+        )
+
+
+async def run(args: argparse.Namespace):
+    from benchmarks import fakes
+    from data import numbers, sharding
+    from db import repositoy, tables
+
+    tables.create_tables()  # before the workers, they only find the tables
+    users = [f"97250{i:07d}" for i in range(args.users)]
+    for i, wa_id in enumerate(users):  # the users exist, the benchmark measures the messages
+        repositoy.create_user_and_topic(
+            wa_id=wa_id,
+            bsuid=f"IL.{wa_id}",
+            name=f"User {i}",
+            username=None,
+            topic_id=10**7 + i,
+            phone_id=numbers.primary.phone_id,
+            chat_id=numbers.primary.tg_group_id,
+        )
+    os.environ["PYTHONPATH"] = fakes.cwd  # the workers run `-m benchmarks.scale_out` from the work directory
+
+    print(
+        f"{args.messages} messages from {args.users} users, backend latency {args.latency * 1000:.0f}ms, "
+        f"{os.cpu_count()} cpus"
+    )
+    print(f"{'workers':>7} {'msg/s':>9} {'speedup':>8} {'p50':>9} {'p99':>9} {'lost':>6} {'unordered':>10}")
+    first_rate = None
+    for run_index, workers in enumerate(int(workers) for workers in args.workers.split(",")):
+        results = tempfile.mkdtemp(dir=fakes.workdir)
+        router = sharding.Router(
+            workers=workers,
+            command=[
+                sys.executable,
+                "-m",
+                "benchmarks.scale_out",
+                "--worker",
+                f"--latency={args.latency}",
+                f"--results={results}",
+                f"--id-base={10**10 * (run_index + 1)}",
+            ],
+            path=os.path.join(results, "router.sock"),
+        )
+        await router.start()
+
+        start = time.time()
+        for i in range(args.messages):
+            user, seq = i % args.users, i // args.users
+            update = fakes.wa_update(
+                wa_id=users[user],
+                name=f"User {user}",
+                message=fakes.wa_text(
+                    msg_id=f"wamid.scale{run_index}_{i}", text=f"bench u{user} s{seq} t{time.time()}"
+                ),
+            )
+            await router.forward(key=sharding.get_wa_key(update), source="wa", payload=json.dumps(update).encode())
+        await router.stop(timeout=args.timeout)
+
+        latencies, out_of_order, last_delivered_at = [], 0, start
+        for index in range(workers):
+            try:
+                with open(os.path.join(results, f"worker{index}.json")) as f:
+                    result = json.load(f)
+            except FileNotFoundError:
+                continue
+            latencies += result["latencies"]
+            out_of_order += result["out_of_order"]
+            last_delivered_at = max(last_delivered_at, result["last_delivered_at"])
+        rate = len(latencies) / (last_delivered_at - start) if latencies else 0.0
+        first_rate = first_rate or rate
+        print(
+            f"{workers:>7} {rate:>9,.1f} {rate / first_rate if first_rate else 0:>7.2f}x "
+            f"{fakes.percentile(latencies, 0.5) * 1000:>7.0f}ms {fakes.percentile(latencies, 0.99) * 1000:>7.0f}ms "
+            f"{args.messages - len(latencies):>6} {out_of_order:>10}"
+        )
+    print(f"the logs and the database are in {fakes.workdir}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4", help="worker counts to compare, comma separated")
+    parser.add_argument("--messages", type=int, default=4000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.005, help="average seconds of every fake request")
+    parser.add_argument("--database-url", help="the database of the workers, default is a new sqlite file")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for the workers to finish")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--results", help=argparse.SUPPRESS)
+    parser.add_argument("--id-base", type=int, default=0, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        asyncio.run(run_worker(args))
+        return
+    # before the bot modules are imported, the workers get it from the environment
+    os.environ["DATABASE_URL"] = args.database_url or (
+        f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='whatsgram-bench-'), 'bench.sqlite')}"
+    )
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,225 @@
+"""
+Benchmark of /search (MESSAGE_SEARCH, see search_messages in db/repositoy.py): the time of the queries with
+millions of messages, the size of the full-text index, and the cost of the index on the writes of the bot.
+
+The texts are made of --vocabulary words, picked by Zipf's law like the words of real messages, so the most
+common word is in a big part of the messages and the rare words are in a few of them. Only the newest
+SEARCH_MAX_MATCHES matches are ranked, so a common word takes about the same time at any size of the table.
+
+Usage:
+    python -m benchmarks.search --messages 2000000
+"""
+
+import argparse
+import datetime
+import itertools
+import os
+import random
+import time
+
+_new_ids = itertools.count(10**9)  # above the ids of fill, for the messages that the benchmark saves
+
+SYLLABLES = ["ka", "lo", "mi", "ra", "te", "su", "no", "vi", "de", "pa", "sha", "ro", "ne", "ba", "li", "go"]
+
+
+def get_vocabulary(size: int) -> list[str]:
+    """Different words of 2-4 syllables, the first is the most common"""
+    rng = random.Random(1)
+    words: dict[str, None] = {}
+    while len(words) < size:
+        words["".join(rng.choices(SYLLABLES, k=rng.randint(2, 4)))] = None
+    return list(words)
+
+
+def fill(users: int, messages: int, vocabulary: list[str], words_per_message: int) -> float:
+    """
+    Add the users with their topics, and the messages with their texts
+    :return: the seconds of the texts (the full-text index is updated by them)
+    """
+    from benchmarks import micro
+    from sqlalchemy import insert
+
+    from db.tables import create_tables, get_session, WaUser, Topic, Message, MessageText
+
+    create_tables()
+    rng = random.Random(2)
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+    now = datetime.datetime.now()
+    text_seconds = 0.0
+    with get_session() as session:
+        session.execute(
+            insert(Topic),
+            [
+                {
+                    "id": i + 1,
+                    "phone_id": micro.PHONE_ID,
+                    "chat_id": micro.CHAT_ID,
+                    "topic_id": i + 1,
+                    "name": f"User {i}",
+                    "created_at": now,
+                }
+                for i in range(users)
+            ],
+        )
+        session.execute(
+            insert(WaUser),
+            [
+                {
+                    "id": i + 1,
+                    "phone_id": micro.PHONE_ID,
+                    "wa_id": micro._wa_id(i),
+                    "name": f"User {i}",
+                    "created_at": now,
+                    "topic_id": i + 1,
+                }
+                for i in range(users)
+            ],
+        )
+        for start in range(0, messages, 10_000):
+            ids = range(start, min(start + 10_000, messages))
+            session.execute(
+                insert(Message),
+                [
+                    {
+                        "id": j + 1,
+                        "phone_id": micro.PHONE_ID,
+                        "chat_id": micro.CHAT_ID,
+                        "topic_msg_id": j + 1,
+                        "wa_msg_id": f"wamid.search{j}",
+                        "sent_from_tg": j % 2 == 0,
+                        "created_at": now,
+                        "topic_id": j % users + 1,
+                        "user_id": j % users + 1,
+                    }
+                    for j in ids
+                ],
+            )
+            texts = [
+                {
+                    "message_id": j + 1,
+                    "text": " ".join(
+                        rng.choices(vocabulary, cum_weights=weights, k=rng.randint(1, words_per_message * 2))
+                    ),
+                }
+                for j in ids
+            ]
+            started = time.perf_counter()
+            session.execute(insert(MessageText), texts)
+            session.commit()
+            text_seconds += time.perf_counter() - started
+            if start % 500_000 == 0:
+                print(f"  {start:,} messages...")
+    return text_seconds
+
+
+def get_size() -> int:
+    """The bytes of the database and its WAL"""
+    from db.tables import engine
+
+    path = engine.url.database
+    return sum(os.path.getsize(file) for file in (path, f"{path}-wal") if os.path.exists(file))
+
+
+def count_matches(query: str) -> int:
+    """The messages that match the query, search_messages reads only the best of them"""
+    from db import repositoy
+    from db.tables import engine
+
+    with engine.connect() as connection:
+        return connection.exec_driver_sql(
+            "SELECT count(*) FROM message_text_fts WHERE message_text_fts MATCH ?",
+            (repositoy._to_fts_query(query),),
+        ).scalar()
+
+
+def measure_queries(vocabulary: list[str], limit: int) -> dict[str, tuple[float, int]]:
+    """Seconds per query, and the messages that match"""
+    from benchmarks import micro
+
+    from db import repositoy
+
+    queries = {
+        "common word": vocabulary[0],
+        "word in 1% of messages": vocabulary[min(len(vocabulary) - 1, 40)],
+        "rare word": vocabulary[-1],
+        "two common words": f"{vocabulary[0]} {vocabulary[1]}",
+        "common + rare word": f"{vocabulary[0]} {vocabulary[-1]}",
+        "prefix": f"{vocabulary[5][:3]}*",
+        "no match": "zzzz",
+    }
+    results = {}
+    for name, query in queries.items():
+        seconds = micro._measure(
+            micro._sync(lambda: repositoy.search_messages(query=query, phone_id=micro.PHONE_ID, limit=limit))
+        )
+        results[f"{name} ({query})"] = (seconds, count_matches(query))
+    return results
+
+
+def measure_writes(with_text: bool) -> float:
+    """Seconds per create_message of the bot, with or without the text"""
+    from benchmarks import micro
+
+    from db import repositoy
+
+    def create_message():
+        msg_id = next(_new_ids)
+        repositoy.create_message(
+            wa_id=micro._wa_id(msg_id % 10),
+            topic_id=msg_id % 10 + 1,
+            wa_msg_id=f"wamid.new{msg_id}",
+            topic_msg_id=msg_id,
+            sent_from_tg=False,
+            phone_id=micro.PHONE_ID,
+            chat_id=micro.CHAT_ID,
+            text="hello, where is my order? it was sent last week" if with_text else None,
+        )
+
+    return micro._measure(micro._sync(create_message))
+
+
+def run(args: argparse.Namespace):
+    from benchmarks import fakes  # noqa: F401, sets the environment of the bot before it's imported
+    from db import repositoy
+
+    vocabulary = get_vocabulary(args.vocabulary)
+    print(
+        f"{args.messages:,} messages of {args.users:,} users, {args.vocabulary:,} words, "
+        f"up to {args.words * 2} words per message, {os.cpu_count()} cpus"
+    )
+    started = time.perf_counter()
+    text_seconds = fill(args.users, args.messages, vocabulary, args.words)
+    repositoy.checkpoint()
+    print(
+        f"filled in {time.perf_counter() - started:.1f}s, the texts and the index {text_seconds:.1f}s "
+        f"({args.messages / text_seconds:,.0f} texts/s)"
+    )
+    print(f"database size {get_size() / 1024 / 1024:.1f}MB")
+
+    print(f"{'query (limit ' + str(args.limit) + ')':<40} {'time':>10} {'matches':>10}")
+    for name, (seconds, matches) in measure_queries(vocabulary, args.limit).items():
+        print(f"{name:<40} {seconds * 1000:>8.2f}ms {matches:>10,}")
+
+    without_text, with_text = measure_writes(False), measure_writes(True)
+    print(f"{'create_message':<40} {without_text * 1e6:>8.0f}us")
+    print(f"{'create_message with text':<40} {with_text * 1e6:>8.0f}us")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--messages", type=int, default=2_000_000)
+    parser.add_argument("--vocabulary", type=int, default=50_000, help="different words in the messages")
+    parser.add_argument("--words", type=int, default=8, help="average words per message")
+    parser.add_argument("--limit", type=int, default=10, help="SEARCH_RESULTS")
+    args = parser.parse_args()
+
+    # before the bot modules are imported, the settings are read once
+    os.environ["MESSAGE_SEARCH"] = "true"
+    os.environ["SEARCH_RESULTS"] = str(args.limit)
+    os.environ.setdefault("LOG_FILE_LEVEL", "WARNING")
+    run(args)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,199 @@
+"""
+Benchmark of the conversion of the animated and the video stickers (STICKER_CONVERT, see data/stickers.py): the
+hit rate of the cache of the converted stickers, the latency of a sticker with a hit and with a conversion, and
+the lag of the event loop of the bot while they are converted.
+
+--messages stickers are sent, --concurrency at a time, picked from --unique stickers by Zipf's law like the
+stickers of real chats (a few popular stickers are most of them). Half are animated (TGS) and half are video
+(WebM) stickers, made of moving shapes. Every case runs once with the cache of STICKER_CACHE_MB and once without
+it, a download takes --latency seconds.
+
+Usage:
+    python -m benchmarks.stickers --messages 200 --unique 40 --concurrency 8 --workers 1
+"""
+
+import argparse
+import asyncio
+import gzip
+import io
+import itertools
+import json
+import os
+import random
+import time
+import types
+
+TICK = 0.01
+SIZE = 512
+
+
+def make_tgs(seed: int, shapes: int = 6, seconds: float = 3, fps: int = 60) -> bytes:
+    """A TGS sticker (gzipped Lottie) of shapes that move and turn"""
+    rng = random.Random(seed)
+    frames = int(seconds * fps)
+    ease = {"i": {"x": [0.5], "y": [0.5]}, "o": {"x": [0.5], "y": [0.5]}}
+    layers = []
+    for i in range(shapes):
+        start, end = [rng.randint(60, SIZE - 60), rng.randint(60, SIZE - 60), 0], [
+            rng.randint(60, SIZE - 60), rng.randint(60, SIZE - 60), 0
+        ]
+        shape = {"ty": rng.choice(["el", "rc"]), "p": {"a": 0, "k": [0, 0]}, "s": {"a": 0, "k": [
+            rng.randint(40, 160), rng.randint(40, 160)
+        ]}, "r": {"a": 0, "k": 12}}
+        fill = {"ty": "fl", "c": {"a": 0, "k": [rng.random(), rng.random(), rng.random(), 1]}, "o": {"a": 0, "k": 90}}
+        layers.append({
+            "ty": 4, "ind": i + 1, "ip": 0, "op": frames, "st": 0, "sr": 1,
+            "ks": {
+                "o": {"a": 0, "k": 100},
+                "r": {"a": 1, "k": [{"t": 0, "s": [0], **ease}, {"t": frames, "s": [rng.choice([-360, 360])]}]},
+                "p": {"a": 1, "k": [
+                    {"t": 0, "s": start, **ease}, {"t": frames // 2, "s": end, **ease}, {"t": frames, "s": start}
+                ]},
+                "a": {"a": 0, "k": [0, 0, 0]},
+                "s": {"a": 0, "k": [100, 100, 100]},
+            },
+            "shapes": [shape, fill],
+        })
+    animation = {"v": "5.5.2", "fr": fps, "ip": 0, "op": frames, "w": SIZE, "h": SIZE, "layers": layers}
+    return gzip.compress(json.dumps(animation).encode())
+
+
+def make_webm(seed: int, shapes: int = 6, seconds: float = 3, fps: int = 30) -> bytes:
+    """A WebM sticker (VP9 with alpha) of circles that move over a transparent background"""
+    import av
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    circles = [
+        (rng.randint(0, SIZE), rng.randint(0, SIZE), rng.randint(20, 80), rng.uniform(-6, 6), rng.uniform(-6, 6),
+         tuple(rng.randint(0, 255) for _ in range(3)))
+        for _ in range(shapes)
+    ]
+    output = io.BytesIO()
+    with av.open(output, mode="w", format="webm") as container:
+        stream = container.add_stream("libvpx-vp9", rate=fps, options={"auto-alt-ref": "0", "crf": "35", "b": "0"})
+        stream.width = stream.height = SIZE
+        stream.pix_fmt = "yuva420p"
+        for n in range(int(seconds * fps)):
+            image = Image.new("RGBA", (SIZE, SIZE), (0, 0, 0, 0))
+            draw = ImageDraw.Draw(image)
+            for x, y, radius, dx, dy, color in circles:
+                cx, cy = (x + dx * n) % SIZE, (y + dy * n) % SIZE
+                draw.ellipse((cx - radius, cy - radius, cx + radius, cy + radius), fill=(*color, 230))
+            frame = av.VideoFrame.from_image(image).reformat(format="yuva420p")
+            container.mux(stream.encode(frame))
+        container.mux(stream.encode())
+    return output.getvalue()
+
+
+def _get_sticker(key: str, is_video: bool) -> types.SimpleNamespace:
+    """The fields of a pyrogram Sticker that the conversion reads"""
+    return types.SimpleNamespace(file_unique_id=key, is_video=is_video, is_animated=not is_video)
+
+
+async def measure(sent: list[int], stickers: list[bytes], concurrency: int, latency: float) -> dict[str, float]:
+    """Send the stickers, returns the hit rate, the latency of the hits and the misses, and the lag of the loop"""
+    from benchmarks import fakes
+
+    from data import stickers as module
+
+    lags, hits, misses = [], [], []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(TICK)
+            lags.append(time.perf_counter() - started - TICK)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    sizes = {}
+
+    async def send(index: int):
+        downloaded = False
+
+        async def download() -> io.BytesIO:
+            nonlocal downloaded
+            downloaded = True
+            await asyncio.sleep(latency)
+            return io.BytesIO(stickers[index])
+
+        async with semaphore:
+            started = time.perf_counter()
+            webp = await module.convert(_get_sticker(f"sticker{index}", index % 2 == 1), download)
+            (misses if downloaded else hits).append(time.perf_counter() - started)
+            sizes[index] = len(webp.getvalue())
+
+    before = module.get_stats()
+    tick = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    await asyncio.gather(*(send(index) for index in sent))
+    seconds = time.perf_counter() - started
+    done.set()
+    await tick
+    after = module.get_stats()
+    converted = after["converted"] - before["converted"]
+    return {
+        "seconds": seconds,
+        "converted": converted,
+        "hit_rate": len(hits) / len(sent),
+        "hit_p50": fakes.percentile(hits, 0.5),
+        "miss_p50": fakes.percentile(misses, 0.5),
+        "miss_p99": fakes.percentile(misses, 0.99),
+        "convert_avg": (after["seconds"] - before["seconds"]) / converted if converted else 0.0,
+        "lag_p99": fakes.percentile(lags, 0.99),
+        "size": sum(sizes.values()) / len(sizes),
+    }
+
+
+def run(args: argparse.Namespace):
+    from benchmarks import fakes  # noqa: F401, sets the environment of the bot before it's imported
+    from data import stickers as module
+
+    stickers = [make_webm(i) if i % 2 else make_tgs(i) for i in range(args.unique)]
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, args.unique + 1)))
+    sent = random.Random(0).choices(range(args.unique), cum_weights=weights, k=args.messages)
+    average = sum(len(data) for data in stickers) / len(stickers)
+    print(
+        f"{args.messages} stickers of {args.unique} unique (avg {average / 1024:.0f}KB),"
+        f" concurrency {args.concurrency}, {args.workers} workers, {os.cpu_count()} cpus"
+    )
+    print(
+        f"{'cache':<9} {'time':>8} {'converted':>10} {'hit rate':>9} {'hit p50':>9} {'miss p50':>9} "
+        f"{'miss p99':>9} {'convert':>9} {'lag p99':>9} {'avg size':>9}"
+    )
+    for cache_mb in (args.cache_mb, 0):
+        module.settings.sticker_cache_mb = cache_mb
+        module._cache.clear()
+        module._cache_bytes = 0
+        result = asyncio.run(measure(sent, stickers, args.concurrency, args.latency))
+        print(
+            f"{str(cache_mb) + 'MB':<9} {result['seconds']:>7.1f}s {result['converted']:>10} "
+            f"{result['hit_rate']:>9.0%} {result['hit_p50'] * 1000:>7.1f}ms {result['miss_p50']:>8.2f}s "
+            f"{result['miss_p99']:>8.2f}s {result['convert_avg']:>8.2f}s {result['lag_p99'] * 1000:>7.1f}ms "
+            f"{result['size'] / 1024:>7.0f}KB"
+        )
+        module._pool.shutdown()  # the semaphore of the pool belongs to the loop of the case
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--unique", type=int, default=40, help="different stickers in the messages")
+    parser.add_argument("--concurrency", type=int, default=8, help="stickers that are sent at the same time")
+    parser.add_argument("--workers", type=int, default=1, help="STICKER_WORKERS")
+    parser.add_argument("--cache-mb", type=int, default=50, help="STICKER_CACHE_MB")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds of a download from telegram")
+    args = parser.parse_args()
+
+    # before the bot modules are imported, the settings are read once
+    os.environ["STICKER_CONVERT"] = "true"
+    os.environ["STICKER_WORKERS"] = str(args.workers)
+    os.environ["STICKER_QUEUE_SIZE"] = str(max(args.messages, 1))
+    os.environ["STICKER_TIMEOUT"] = "300"
+    os.environ.setdefault("LOG_FILE_LEVEL", "WARNING")
+    run(args)
+
+
+if __name__ == "__main__":
+    main_cli()
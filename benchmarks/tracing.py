@@ -0,0 +1,119 @@
+"""
+Benchmark of the tracing of the bridged messages (TRACE_SLOW_SECONDS and OTLP_ENDPOINT, see data/tracing.py): the
+cost of a trace in the event loop without and with the OTLP exporter, and a check of the exports on a local
+collector (benchmarks/fakes.FakeCollector).
+
+--messages traces are finished, --rate per second, with the stages of a message from whatsapp. The exporter sends
+them every --interval seconds to the collector, that takes --latency seconds and fails --errors of the exports.
+When they are finished the bot shuts down (tracing.close), so the spans that are still buffered are sent too. It
+fails when an export is not valid OTLP, or when a span that was not dropped or failed didn't arrive.
+
+Usage:
+    python -m benchmarks.tracing --messages 5000 --rate 1000 --interval 1 --errors 0.05
+"""
+
+import argparse
+import asyncio
+import datetime
+import os
+import sys
+import time
+
+STAGES = ("resolve_user", "download", "upload", "db_write")
+
+
+def _trace(module, origin: datetime.datetime):
+    trace = module.Trace("wa_to_tg", origin=origin)
+    for stage in STAGES:
+        trace.mark(stage)
+    return trace
+
+
+async def measure(messages: int, rate: float) -> list[float]:
+    """Finish the traces at the rate, returns the seconds of every finish"""
+    from data import tracing as module
+
+    seconds = []
+    for _ in range(messages):
+        trace = _trace(module, datetime.datetime.now() - datetime.timedelta(seconds=1))
+        started = time.perf_counter()
+        trace.finish()
+        seconds.append(time.perf_counter() - started)
+        await asyncio.sleep(1 / rate)
+    return seconds
+
+
+async def export(args: argparse.Namespace, collector) -> tuple[list[float], dict[str, int], float]:
+    import httpx
+
+    from data import tracing as module
+
+    module._session = httpx.AsyncClient(transport=collector.transport)
+    seconds = await measure(args.messages, args.rate)
+    buffered = module.get_stats()["buffered"]
+    started = time.perf_counter()
+    await module.close()
+    close = time.perf_counter() - started
+    return seconds, {**module.get_stats(), "buffered_at_close": buffered}, close
+
+
+def run(args: argparse.Namespace) -> int:
+    from benchmarks import fakes
+    from data import tracing as module
+
+    module.EXPORT_INTERVAL = args.interval
+    print(
+        f"{args.messages} traces of {len(STAGES) + 2} spans at {args.rate:g}/s, export every {args.interval:g}s, "
+        f"collector latency {args.latency * 1000:g}ms, {args.errors:.0%} errors"
+    )
+    print(f"{'exporter':<9} {'p50':>8} {'p99':>8} {'max':>8}")
+
+    module.settings.otlp_endpoint = None
+    seconds = asyncio.run(measure(args.messages, args.rate))
+    print(
+        f"{'off':<9} {fakes.percentile(seconds, 0.5) * 1e6:>6.1f}us {fakes.percentile(seconds, 0.99) * 1e6:>6.1f}us "
+        f"{max(seconds) * 1e6:>6.1f}us"
+    )
+
+    module.settings.otlp_endpoint = "http://collector:4318/v1/traces"
+    collector = fakes.FakeCollector(fakes.Faults(latency=args.latency, error_rate=args.errors))
+    seconds, stats, close = asyncio.run(export(args, collector))
+    print(
+        f"{'otlp':<9} {fakes.percentile(seconds, 0.5) * 1e6:>6.1f}us {fakes.percentile(seconds, 0.99) * 1e6:>6.1f}us "
+        f"{max(seconds) * 1e6:>6.1f}us"
+    )
+    print(
+        f"\nexports {collector.requests}, spans exported {stats['exported']}, failed {stats['failed']}, "
+        f"dropped {stats['dropped']}, received {collector.received}"
+    )
+    print(f"buffered at shutdown {stats['buffered_at_close']}, sent in {close * 1000:.1f}ms, left {stats['buffered']}")
+
+    problems = list(dict.fromkeys(collector.invalid))
+    if collector.received != stats["exported"]:
+        problems.append(f"the collector received {collector.received} spans of {stats['exported']} exported")
+    if stats["buffered"]:
+        problems.append(f"{stats['buffered']} spans were not sent at shutdown")
+    incomplete = sum(len(spans) != len(STAGES) + 2 for spans in collector.spans.values())
+    if incomplete:
+        problems.append(f"{incomplete} traces arrived without all their spans")
+    for problem in problems[:20]:
+        print(f"INVALID: {problem}")
+    return 1 if problems else 0
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--rate", type=float, default=1000, help="traces that are finished every second")
+    parser.add_argument("--interval", type=float, default=1, help="seconds between the exports")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds of an export to the collector")
+    parser.add_argument("--errors", type=float, default=0.0, help="share of the exports that fail")
+    args = parser.parse_args()
+
+    os.environ.setdefault("LOG_FILE_LEVEL", "WARNING")
+    os.environ["TRACE_SLOW_SECONDS"] = "3600"  # the traces are not logged
+    sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main_cli()
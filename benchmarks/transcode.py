@@ -0,0 +1,148 @@
+"""
+Benchmark of the conversion of the photos and the stickers that are above the limits of whatsapp
+(IMAGE_TRANSCODE, see data/transcode.py): the images per second of concurrent conversions, and the lag of the
+event loop of the bot while they run.
+
+Every case converts --images images, --concurrency at a time, in the pool of processes of the bot
+(TRANSCODE_WORKERS), in threads (asyncio.to_thread) and in the event loop itself. A ticker measures how late
+the event loop wakes up every 10ms, the time that an update of the bridge would wait.
+
+Usage:
+    python -m benchmarks.transcode --images 40 --concurrency 8 --workers 2
+"""
+
+import argparse
+import asyncio
+import io
+import os
+import random
+import time
+
+TICK = 0.01
+
+
+def make_photo(width: int, height: int, seed: int) -> bytes:
+    """A JPEG with noise over a gradient, noise compresses badly like the details of a real photo"""
+    from PIL import Image
+
+    rng = random.Random(seed)
+    noise = Image.frombytes("RGB", (width, height), rng.randbytes(width * height * 3))
+    gradient = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    output = io.BytesIO()
+    Image.blend(gradient, noise, 0.5).save(output, format="JPEG", quality=98)
+    return output.getvalue()
+
+
+def make_sticker(seed: int) -> bytes:
+    """A lossless WebP sticker of 1024x1024 with some noise, above the 100KB of whatsapp"""
+    from PIL import Image
+
+    rng = random.Random(seed)
+    noise = Image.frombytes("RGBA", (1024, 1024), rng.randbytes(1024 * 1024 * 4))
+    gradient = Image.radial_gradient("L").resize((1024, 1024)).convert("RGBA")
+    output = io.BytesIO()
+    Image.blend(gradient, noise, 0.2).save(output, format="WEBP", lossless=True)
+    return output.getvalue()
+
+
+async def measure(mode: str, images: list[tuple[str, bytes]], concurrency: int) -> dict[str, float]:
+    """Convert the images, returns the images per second and the lag of the event loop"""
+    from benchmarks import fakes
+    from pyrogram import enums
+
+    from data import transcode
+
+    limits = {"photo": 5 * 1024, "sticker": 100}
+    media_types = {"photo": enums.MessageMediaType.PHOTO, "sticker": enums.MessageMediaType.STICKER}
+    functions = {"photo": transcode._to_photo, "sticker": transcode._to_sticker}
+    lags = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(TICK)
+            lags.append(time.perf_counter() - started - TICK)
+
+    async def convert(kind: str, data: bytes) -> int:
+        match mode:
+            case "process":
+                result = await transcode.transcode(media_types[kind], io.BytesIO(data), limits[kind])
+                return len(result.getvalue())
+            case "thread":
+                return len(await asyncio.to_thread(functions[kind], data, limits[kind] * 1024))
+            case _:
+                await asyncio.sleep(0)  # let the ticker run between the images
+                return len(functions[kind](data, limits[kind] * 1024))
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(kind: str, data: bytes) -> int:
+        async with semaphore:
+            return await convert(kind, data)
+
+    if mode == "process":  # start the processes before the measure, the bot starts them on the first image
+        await convert(*images[0])
+    tick = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    sizes = await asyncio.gather(*(run_one(kind, data) for kind, data in images))
+    seconds = time.perf_counter() - started
+    done.set()
+    await tick
+    return {
+        "images_per_second": len(images) / seconds,
+        "lag_p50": fakes.percentile(lags, 0.5),
+        "lag_p99": fakes.percentile(lags, 0.99),
+        "lag_max": max(lags, default=0.0),
+        "size_in": sum(len(data) for _, data in images) / len(images),
+        "size_out": sum(sizes) / len(sizes),
+    }
+
+
+def run(args: argparse.Namespace):
+    from benchmarks import fakes  # noqa: F401, sets the environment of the bot before it's imported
+
+    photos = max(1, int(args.images * (1 - args.stickers)))
+    images = [("photo", make_photo(args.width, args.height, i)) for i in range(photos)] + [
+        ("sticker", make_sticker(i)) for i in range(args.images - photos)
+    ]
+    random.Random(0).shuffle(images)
+    average = sum(len(data) for _, data in images) / len(images)
+    print(
+        f"{len(images)} images ({photos} photos of {args.width}x{args.height}), avg {average / 1024 / 1024:.1f}MB, "
+        f"concurrency {args.concurrency}, {args.workers} workers, {os.cpu_count()} cpus"
+    )
+    print(f"{'mode':<8} {'images/s':>9} {'lag p50':>9} {'lag p99':>9} {'lag max':>9} {'avg size':>17}")
+    for mode in args.modes:
+        result = asyncio.run(measure(mode, images, args.concurrency))
+        print(
+            f"{mode:<8} {result['images_per_second']:>9.2f} {result['lag_p50'] * 1000:>7.1f}ms "
+            f"{result['lag_p99'] * 1000:>7.1f}ms {result['lag_max'] * 1000:>7.1f}ms "
+            f"{result['size_in'] / 1024:>7.0f}KB>{result['size_out'] / 1024:.0f}KB"
+        )
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=40)
+    parser.add_argument("--stickers", type=float, default=0.25, help="share of stickers in the images")
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--concurrency", type=int, default=8, help="images that are converted at the same time")
+    parser.add_argument("--workers", type=int, default=2, help="TRANSCODE_WORKERS")
+    parser.add_argument(
+        "--modes", type=lambda value: value.split(","), default=["process", "thread", "inline"],
+        help="process (the bot), thread or inline (in the event loop)",
+    )
+    args = parser.parse_args()
+
+    # before the bot modules are imported, the settings are read once
+    os.environ["IMAGE_TRANSCODE"] = "true"
+    os.environ["TRANSCODE_WORKERS"] = str(args.workers)
+    os.environ["TRANSCODE_QUEUE_SIZE"] = str(max(args.concurrency, 1))
+    os.environ.setdefault("LOG_FILE_LEVEL", "WARNING")
+    run(args)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,4 +1,9 @@
 import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 from typing import Any, Optional, Tuple, Dict, Hashable, Iterable, Callable, Union
 
@@ -33,6 +38,8 @@ class MemoryCache:
     def __init__(self):
         logger.debug("memory cache initialized")
         self._cache = {}
+        self._hits = 0
+        self._misses = 0
 
     @staticmethod
     def build_cache_id(*args, **kwargs) -> Tuple[Tuple[Any, ...], ...]:
@@ -153,7 +160,12 @@ class MemoryCache:
         :param cache_id: The cache id to get the data from
         :return: The cached data
         """
-        return self._cache.get(cache_name, {}).get(cache_id)
+        cache_data = self._cache.get(cache_name, {}).get(cache_id)
+        if cache_data is None:
+            self._misses += 1
+        else:
+            self._hits += 1
+        return cache_data
 
     def set(self, cache_name: Hashable, cache_id: Hashable, cache_data: Any):
         """
@@ -188,5 +200,217 @@ class MemoryCache:
             for cache_name, cache in self._cache.items()
         }
 
+    def get_items(self) -> Dict[Hashable, Dict[Hashable, Any]]:
+        """Return the cached data in this process, by cache name and cache id"""
+        return self._cache
+
+    def get_hit_stats(self) -> Dict[str, Union[int, float]]:
+        """Return the hits and the misses of get"""
+        total = self._hits + self._misses
+        return {"hits": self._hits, "misses": self._misses, "hit_rate": self._hits / total if total else 0.0}
+
+
+class TwoLevelCache(MemoryCache):
+    """
+    Two level cache for several processes
+        - A local LRU in every process, in front of a shared redis, so a process that restarts or that sees
+          a user for the first time gets it without the database
+        - Every delete is published to all the processes, that drop the local copy. The local copy is also
+          trusted only for `local_ttl` seconds, that bounds the staleness if an invalidation is lost
+        - If redis is down the cache works like a miss, the caller reads the database. The client is blocking
+          and runs in the event loop, so after an error the gets and the sets skip redis for `RETRY_AFTER`
+          seconds instead of waiting for its timeout on every lookup
+        - The items are pickled (the rows of the database), so redis must be trusted like the database: anyone
+          that can write to it can run code in the bot. Don't share it with other applications, and protect it
+          with a password or a private network
+    """
+
+    PREFIX = "whatsgram:cache:"
+    CHANNEL = "whatsgram:cache:invalidate"
+    RETRY_AFTER = 5  # seconds that redis is skipped after an error
+
+    def __init__(self, url: str, local_size: int = 10_000, local_ttl: float = 60, shared_ttl: float = 3600):
+        """
+        :param url: the redis url, example: redis://localhost:6379/0
+        :param local_size: max items in the local LRU
+        :param local_ttl: seconds that a local item is used without checking redis
+        :param shared_ttl: seconds that an item is kept in redis
+        """
+        import redis  # only needed with a shared cache
+
+        super().__init__()
+        self._redis = redis.Redis.from_url(url, socket_timeout=1, socket_connect_timeout=1)
+        self._redis_errors = (redis.RedisError, OSError)
+        self._local: OrderedDict[str, Tuple[float, Any]] = OrderedDict()
+        """example: {redis key: (expires_at, data)}"""
+        self._lock = threading.Lock()  # the invalidations arrive in the subscriber thread
+        self.local_size = local_size
+        self.local_ttl = local_ttl
+        self.shared_ttl = shared_ttl
+        self._origin = f"{os.getpid()}-{id(self)}".encode()
+        self._down_until = 0.0
+        """redis is skipped until this time (monotonic), after an error"""
+        self._stats = {
+            "local_hits": 0,
+            "shared_hits": 0,
+            "misses": 0,
+            "errors": 0,
+            "skipped": 0,
+            "invalidations_sent": 0,
+            "invalidations_received": 0,
+            "invalidation_lag_total": 0.0,
+            "invalidation_lag_max": 0.0,
+        }
+        self._pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{self.CHANNEL: self._on_invalidate})
+        self._thread = self._pubsub.run_in_thread(
+            sleep_time=1, daemon=True, exception_handler=self._on_subscriber_error
+        )
+
+    def _is_down(self) -> bool:
+        if time.monotonic() < self._down_until:
+            self._stats["skipped"] += 1
+            return True
+        return False
+
+    def _on_error(self, action: str, e: Exception):
+        self._stats["errors"] += 1
+        self._down_until = time.monotonic() + self.RETRY_AFTER
+        logger.warning(f"shared cache {action} failed, skipping redis for {self.RETRY_AFTER}s: {e!r}")
+
+    def _key(self, cache_name: Hashable, cache_id: Optional[Hashable] = None) -> str:
+        return f"{self.PREFIX}{cache_name}:" + (repr(cache_id) if cache_id is not None else "")
+
+    def get(self, cache_name: Hashable, cache_id: Hashable) -> Optional[Any]:
+        key = self._key(cache_name, cache_id)
+        now = time.monotonic()
+        with self._lock:
+            item = self._local.get(key)
+            if item is not None and item[0] > now:
+                self._local.move_to_end(key)
+                self._stats["local_hits"] += 1
+                return item[1]
+        data = None
+        if not self._is_down():
+            try:
+                data = self._redis.get(key)
+            except self._redis_errors as e:
+                self._on_error("get", e)
+        if data is None:
+            self._stats["misses"] += 1
+            return None
+        self._stats["shared_hits"] += 1
+        cache_data = pickle.loads(data)
+        self._set_local(key, cache_data)
+        return cache_data
+
+    def set(self, cache_name: Hashable, cache_id: Hashable, cache_data: Any):
+        if cache_data is None:  # None is a miss, like in the memory cache
+            return
+        key = self._key(cache_name, cache_id)
+        self._set_local(key, cache_data)
+        if self._is_down():
+            return
+        try:
+            self._redis.set(key, pickle.dumps(cache_data), px=int(self.shared_ttl * 1000))
+        except self._redis_errors as e:
+            self._on_error("set", e)
+
+    def _set_local(self, key: str, cache_data: Any):
+        with self._lock:
+            self._local[key] = (time.monotonic() + self.local_ttl, cache_data)
+            self._local.move_to_end(key)
+            while len(self._local) > self.local_size:
+                self._local.popitem(last=False)
+
+    def delete(self, cache_name: Hashable, cache_id: Optional[Hashable] = None):
+        key = self._key(cache_name, cache_id)
+        self._delete_local(key, prefix=cache_id is None)
+        # tried also when redis is skipped, a delete that is lost keeps the old item in redis for shared_ttl
+        try:
+            if cache_id is not None:
+                self._redis.delete(key)
+            else:
+                for shared_key in self._redis.scan_iter(match=f"{key}*", count=1000):
+                    self._redis.delete(shared_key)
+            self._redis.publish(
+                self.CHANNEL, pickle.dumps((self._origin, time.time(), key, cache_id is None))
+            )
+            self._stats["invalidations_sent"] += 1
+        except self._redis_errors as e:
+            self._on_error("delete", e)
+            logger.warning(f"the other processes see the delete after {self.local_ttl}s")
+
+    def _delete_local(self, key: str, prefix: bool):
+        with self._lock:
+            if prefix:
+                for local_key in [local_key for local_key in self._local if local_key.startswith(key)]:
+                    del self._local[local_key]
+            else:
+                self._local.pop(key, None)
+
+    def _on_invalidate(self, message: dict):
+        origin, sent_at, key, prefix = pickle.loads(message["data"])
+        if origin == self._origin:
+            return
+        self._delete_local(key, prefix=prefix)
+        lag = max(time.time() - sent_at, 0.0)
+        self._stats["invalidations_received"] += 1
+        self._stats["invalidation_lag_total"] += lag
+        self._stats["invalidation_lag_max"] = max(self._stats["invalidation_lag_max"], lag)
+
+    def _on_subscriber_error(self, e: Exception, pubsub, thread):
+        # invalidations could be missed until the subscriber reconnects, so nothing local is trusted
+        self._stats["errors"] += 1
+        logger.warning(f"shared cache subscriber disconnected: {e!r}")
+        with self._lock:
+            self._local.clear()
+        time.sleep(1)
 
-my_cache = MemoryCache()
+    def clear(self):
+        """Clear the local items of this process"""
+        with self._lock:
+            self._local.clear()
+
+    def get_stats(self) -> Dict[Hashable, int]:
+        """Return cache stats, the number of local items per cache name"""
+        stats: Dict[Hashable, int] = {}
+        for cache_name in self.get_items():
+            stats[cache_name] = len(self.get_items()[cache_name])
+        return stats
+
+    def get_items(self) -> Dict[Hashable, Dict[Hashable, Any]]:
+        items: Dict[Hashable, Dict[Hashable, Any]] = {}
+        with self._lock:
+            for key, (_, data) in self._local.items():
+                cache_name, _, cache_id = key[len(self.PREFIX):].partition(":")
+                items.setdefault(cache_name, {})[cache_id] = data
+        return items
+
+    def get_hit_stats(self) -> Dict[str, Union[int, float]]:
+        """Return the hits of every level, the invalidations and the time they took to arrive (the staleness)"""
+        stats = dict(self._stats)
+        lag_total = stats.pop("invalidation_lag_total")
+        received = stats["invalidations_received"]
+        stats["invalidation_lag_avg"] = lag_total / received if received else 0.0
+        stats["hits"] = stats["local_hits"] + stats["shared_hits"]
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / total if total else 0.0
+        return stats
+
+
+def _create_cache() -> MemoryCache:
+    from data import config
+
+    settings = config.get_settings()
+    if not settings.redis_url:
+        return MemoryCache()
+    return TwoLevelCache(
+        url=settings.redis_url,
+        local_size=settings.cache_local_size,
+        local_ttl=settings.cache_local_ttl,
+        shared_ttl=settings.cache_shared_ttl,
+    )
+
+
+my_cache = _create_cache()
@@ -14,4 +14,12 @@ settings = config.get_settings()
 
 # telegram
 tg_bot: Client = None
-wa_bot: WhatsApp = None
+wa_bot: WhatsApp = None  # the client of the primary number, it receives the webhooks of all the numbers
+
+wa_bots: dict[str, WhatsApp] = {}
+"""example: {phone_id: WhatsApp} - the client of every number, see data/numbers.py"""
+
+
+def get_wa_bot(phone_id: str) -> WhatsApp:
+    """Get the client that sends from the number"""
+    return wa_bots[phone_id]
@@ -0,0 +1,133 @@
+import datetime
+import hashlib
+import io
+import logging
+import time
+
+from pyrogram import types as tg_types
+from pywa_async import types as wa_types
+from sqlalchemy.exc import NoResultFound
+
+from data import config, modules, numbers
+from db import repositoy
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+WA_MEDIA_TTL = datetime.timedelta(
+    days=29
+)  # whatsapp keeps uploaded media for 30 days https://developers.facebook.com/docs/whatsapp/cloud-api/reference/media#upload-media
+EVICT_INTERVAL = 60 * 60  # seconds between deletions of expired media
+
+_ttl = {
+    modules.MediaKeyType.TG_FILE_UNIQUE_ID: WA_MEDIA_TTL,
+    modules.MediaKeyType.TG_CONTENT_SHA256: WA_MEDIA_TTL,
+    modules.MediaKeyType.WA_SHA256: None,  # telegram file ids never expire
+}
+
+_stats = {
+    "hits": {key_type: 0 for key_type in modules.MediaKeyType},
+    "misses": {key_type: 0 for key_type in modules.MediaKeyType},
+    "evicted": 0,
+}
+_last_evict = 0.0
+
+
+def _get_key(*, key_type: modules.MediaKeyType, key: str, phone_id: str | None) -> str:
+    """
+    Media that was uploaded to whatsapp can be sent only by the number that uploaded it, the keys of the other
+    numbers are hashed with the phone id (the keys of the primary number are kept, as before WA_NUMBERS)
+    """
+    if key_type == modules.MediaKeyType.WA_SHA256 or phone_id is None or phone_id == numbers.primary.phone_id:
+        return key
+    return hashlib.sha256(f"{phone_id}:{key}".encode()).hexdigest()
+
+
+def get_wa_key(msg: wa_types.Message) -> str:
+    """
+    The key of whatsapp media (WA_SHA256), with the type of the message: the same file that is sent as a document
+    and as an image is uploaded to telegram as a document and as a photo, and a file id can't be sent as another type
+    """
+    return f"{msg.type}:{msg.media.sha256}"
+
+
+def get_media_id(
+    *, key_type: modules.MediaKeyType, key: str | None, phone_id: str | None = None
+) -> str | None:
+    """
+    Get the id of media that was already uploaded
+    :param key_type: the type of the key
+    :param key: the file_unique_id or the sha256 of the media
+    :param phone_id: the number that sends the media to whatsapp (for the telegram keys)
+    :return: the whatsapp media id or the telegram file id, None if not cached
+    """
+    if not settings.media_cache or key is None:
+        return None
+    key = _get_key(key_type=key_type, key=key, phone_id=phone_id)
+
+    try:
+        media_id = repositoy.get_media_cache(key_type=key_type, key=key).media_id
+    except NoResultFound:
+        _stats["misses"][key_type] += 1
+        return None
+
+    _stats["hits"][key_type] += 1
+    return media_id
+
+
+def save_media_id(
+    *, key_type: modules.MediaKeyType, key: str | None, media_id: str | None, phone_id: str | None = None
+):
+    """
+    Save the id of uploaded media, so the next time the same media is sent it will not be uploaded again
+    :param key_type: the type of the key
+    :param key: the file_unique_id or the sha256 of the media
+    :param media_id: the whatsapp media id or the telegram file id
+    :param phone_id: the number that uploaded the media to whatsapp (for the telegram keys)
+    """
+    if not settings.media_cache or key is None or media_id is None:
+        return
+    key = _get_key(key_type=key_type, key=key, phone_id=phone_id)
+
+    ttl = _ttl[key_type]
+    repositoy.create_media_cache(
+        key_type=key_type,
+        key=key,
+        media_id=media_id,
+        expires_at=datetime.datetime.now() + ttl if ttl else None,
+    )
+    _evict_expired()
+
+
+def _evict_expired():
+    global _last_evict
+    if time.monotonic() - _last_evict < EVICT_INTERVAL:
+        return
+    _last_evict = time.monotonic()
+    _stats["evicted"] += repositoy.delete_expired_media_cache()
+
+
+def get_file_id(msg: tg_types.Message) -> str | None:
+    """Get the file id of the media of a message that was sent to telegram"""
+    if not msg.media:
+        return None
+    return getattr(getattr(msg, msg.media.name.lower()), "file_id", None)
+
+
+def get_content_hash(download: io.BytesIO) -> str:
+    """Get the sha256 of downloaded media"""
+    return hashlib.sha256(download.getbuffer()).hexdigest()
+
+
+def get_stats() -> dict[str, int]:
+    """Return media cache stats, the hits and misses of every key type"""
+    hits = sum(_stats["hits"].values())
+    misses = sum(_stats["misses"].values())
+    return {
+        **{f"hits_{key_type.name.lower()}": count for key_type, count in _stats["hits"].items()},
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+        "evicted": _stats["evicted"],
+    }
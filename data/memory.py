@@ -0,0 +1,198 @@
+import asyncio
+import datetime
+import gc
+import io
+import logging
+import pathlib
+import sys
+import tracemalloc
+import weakref
+
+from data import config, cache_memory, utils
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+"""
+Memory diagnostics.
+
+The sizes of the caches and the in-flight media buffers are always available.
+tracemalloc is started only on demand (the /memory command) or for the periodic snapshots,
+because it slows down every allocation.
+"""
+
+TRACE_FRAMES = 5  # frames that are kept for every allocation
+TOP_STATS = 20
+
+_buffers: weakref.WeakKeyDictionary[io.BytesIO, str] = weakref.WeakKeyDictionary()
+"""example: {buffer: "wa_to_tg"}"""
+_last_snapshot: tracemalloc.Snapshot | None = None
+_snapshot_task: asyncio.Task | None = None
+
+
+def track(buffer: io.BytesIO, subsystem: str) -> io.BytesIO:
+    """
+    Count the buffer as in-flight media until it is garbage collected
+    :param buffer: the downloaded media
+    :param subsystem: the name of the subsystem that holds the buffer
+    :return: the same buffer
+    """
+    _buffers[buffer] = subsystem
+    return buffer
+
+
+def _deep_sizeof(obj, seen: set[int]) -> int:
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_sizeof(k, seen) + _deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(_deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__") and not isinstance(obj, type):
+        # public attributes only, the private ones (like the sqlalchemy state) are shared by all the objects
+        size += sum(
+            _deep_sizeof(value, seen)
+            for name, value in vars(obj).items()
+            if not name.startswith("_")
+        )
+    return size
+
+
+def get_sizes() -> dict[str, dict[str, int]]:
+    """
+    Return the approximate sizes in bytes of the caches and the in-flight media buffers
+    :return: example: {"cache": {"get_user_by_wa_id": 1024}, "buffers": {"wa_to_tg": 2048}, "counts": {...}}
+    """
+    seen: set[int] = set()
+    cache = {
+        str(cache_name): _deep_sizeof(items, seen)
+        for cache_name, items in cache_memory.my_cache.get_items().items()
+    }
+    cache["user_id_to_state"] = _deep_sizeof(utils.user_id_to_state, seen)
+
+    buffers: dict[str, int] = {}
+    counts: dict[str, int] = {}
+    for buffer, subsystem in list(_buffers.items()):
+        try:
+            with buffer.getbuffer() as view:
+                size = view.nbytes
+        except ValueError:  # closed
+            continue
+        buffers[subsystem] = buffers.get(subsystem, 0) + size
+        counts[subsystem] = counts.get(subsystem, 0) + 1
+    return {"cache": cache, "buffers": buffers, "counts": counts}
+
+
+def _format_size(size: float) -> str:
+    for unit in ("B", "KB", "MB"):
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+def start_tracing():
+    """Start tracemalloc and take the first snapshot to compare to, call it in a thread"""
+    global _last_snapshot
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACE_FRAMES)
+    _last_snapshot = _take_snapshot()
+
+
+def stop_tracing():
+    """Stop tracemalloc, if the periodic snapshots are disabled"""
+    global _last_snapshot
+    _last_snapshot = None
+    if _snapshot_task is None:
+        tracemalloc.stop()
+
+
+def is_tracing() -> bool:
+    return tracemalloc.is_tracing()
+
+
+def _take_snapshot() -> tracemalloc.Snapshot:
+    return tracemalloc.take_snapshot().filter_traces(
+        (tracemalloc.Filter(False, tracemalloc.__file__),)
+    )
+
+
+def get_report() -> str:
+    """
+    Report the sizes of the caches and the buffers, and if tracemalloc is tracing,
+    the allocations that grew since the previous report. It takes a snapshot, call it in a thread
+    """
+    global _last_snapshot
+    sizes = get_sizes()
+    lines = [f"Memory report {datetime.datetime.now():%Y-%m-%d %H:%M:%S}", ""]
+
+    lines.append("Caches:")
+    for name, size in sorted(sizes["cache"].items(), key=lambda item: -item[1]):
+        lines.append(f"  {name}: {_format_size(size)}")
+    lines.extend(["", "In-flight media buffers:"])
+    for name, size in sizes["buffers"].items():
+        lines.append(f"  {name}: {sizes['counts'][name]} buffers, {_format_size(size)}")
+    lines.extend(["", f"Garbage collector objects: {len(gc.get_objects())}"])
+
+    if not tracemalloc.is_tracing():
+        lines.extend(["", "tracemalloc is not tracing"])
+        return "\n".join(lines) + "\n"
+
+    current, peak = tracemalloc.get_traced_memory()
+    snapshot = _take_snapshot()
+    lines.extend(["", f"Traced memory: {_format_size(current)}, peak: {_format_size(peak)}"])
+    if _last_snapshot is not None:
+        for key_type in ("filename", "lineno"):
+            lines.extend(["", f"Top {TOP_STATS} growth by {key_type} since the previous report:"])
+            for stat in snapshot.compare_to(_last_snapshot, key_type)[:TOP_STATS]:
+                lines.append(f"  {stat}")
+    lines.extend(["", f"Top {TOP_STATS} allocations:"])
+    for stat in snapshot.statistics("traceback")[:TOP_STATS]:
+        lines.append(f"  {_format_size(stat.size)} in {stat.count} blocks")
+        lines.extend(f"    {line}" for line in stat.traceback.format())
+    _last_snapshot = snapshot
+    return "\n".join(lines) + "\n"
+
+
+async def _dump_snapshots(interval: float, directory: pathlib.Path):
+    while True:
+        await asyncio.sleep(interval)
+        path = directory / f"{datetime.datetime.now():%Y%m%d_%H%M%S}.snapshot"
+        try:
+            snapshot = await asyncio.to_thread(_take_snapshot)
+            await asyncio.to_thread(snapshot.dump, str(path))
+        except OSError as e:
+            _logger.error(f"Error dumping memory snapshot to {path}: {e}")
+            continue
+        _logger.debug(f"memory snapshot dumped to {path}")
+
+
+def start_snapshots(interval_minutes: float, directory: str):
+    """
+    Dump a tracemalloc snapshot to the directory periodically, compare them with `python -m data.memory old new`
+    :param interval_minutes: minutes between snapshots
+    :param directory: the directory of the snapshots
+    """
+    global _snapshot_task
+    if _snapshot_task is not None:
+        return
+    path = pathlib.Path(directory)
+    path.mkdir(parents=True, exist_ok=True)
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACE_FRAMES)
+    _snapshot_task = asyncio.create_task(_dump_snapshots(interval_minutes * 60, path))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("usage: python -m data.memory <old.snapshot> <new.snapshot>")
+        sys.exit(1)
+    old, new = (tracemalloc.Snapshot.load(path) for path in sys.argv[1:])
+    for key_type in ("filename", "lineno"):
+        print(f"Top {TOP_STATS} growth by {key_type}:")
+        for stat in new.compare_to(old, key_type)[:TOP_STATS]:
+            print(f"  {stat}")
+        print()
@@ -0,0 +1,272 @@
+import bisect
+import contextlib
+import threading
+import time
+import typing
+from functools import wraps
+
+import httpx
+from pyrogram import Client
+
+from data import config
+
+settings = config.get_settings()
+
+"""
+Prometheus metrics in the text exposition format, without dependencies.
+
+The handlers run in the event loop, but the queries of the database also run in threads (asyncio.to_thread, see
+@timed_query), so every metric is updated and rendered under its own lock.
+"""
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labelnames: tuple[str, ...], labels: tuple[str, ...], **extra: str) -> str:
+    pairs = [*zip(labelnames, labels), *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """A value that only goes up"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels: typing.Any):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Distribution of values (in seconds) in buckets"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values: dict[tuple[str, ...], list] = {}
+        """example: {labels: [[count per bucket..., count of +Inf], sum]}"""
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: typing.Any):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            values[0][bisect.bisect_left(self.buckets, value)] += 1
+            values[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels: typing.Any):
+        """Observe the time of the block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, le=str(bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """A value that is read from a callback when the metrics are rendered"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        callback: typing.Callable[[], float],
+        metric_type: typing.Literal["gauge", "counter"] = "gauge",
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.metric_type = metric_type
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.metric_type}",
+            f"{self.name} {self.callback()}",
+        ]
+
+
+messages = Counter(
+    "whatsgram_messages_total",
+    "Messages that arrived to the bridge",
+    ("direction", "type"),
+)
+handler_seconds = Histogram(
+    "whatsgram_handler_seconds",
+    "Time spent in the bot handlers",
+    ("handler",),
+)
+db_query_seconds = Histogram(
+    "whatsgram_db_query_seconds",
+    "Time spent in database queries",
+    ("query",),
+)
+api_request_seconds = Histogram(
+    "whatsgram_api_request_seconds",
+    "Latency of requests to WhatsApp and Telegram",
+    ("api", "method"),
+)
+api_errors = Counter(
+    "whatsgram_api_errors_total",
+    "Failed requests to WhatsApp and Telegram",
+    ("api", "method", "error"),
+)
+
+log_dropped = Gauge(
+    "whatsgram_log_dropped_total",
+    "Logs that were dropped because the logging queue was full",
+    lambda: config.get_logging_stats()["dropped"],
+    metric_type="counter",
+)
+log_queued = Gauge(
+    "whatsgram_log_queued",
+    "Logs that wait to be written by the logging thread",
+    lambda: config.get_logging_stats()["queued"],
+)
+
+_registry: list[Counter | Histogram | Gauge] = [
+    messages,
+    handler_seconds,
+    db_query_seconds,
+    api_request_seconds,
+    api_errors,
+    log_dropped,
+    log_queued,
+]
+
+M = typing.TypeVar("M", Counter, Histogram, Gauge)
+
+
+def register(metric: M) -> M:
+    """Add a metric to the /metrics endpoint"""
+    _registry.append(metric)
+    return metric
+
+
+def render() -> str:
+    """Render all the metrics in the prometheus text format"""
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+def timed_handler(func: typing.Callable) -> typing.Callable:
+    """Decorator to measure the time of async handler, the handler is returned as is without METRICS"""
+    if not settings.metrics:
+        return func
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, handler=func.__name__)
+
+    return wrapper
+
+
+def timed_query(func: typing.Callable) -> typing.Callable:
+    """Decorator to measure the time of database query, should be under the cache decorator, the query is returned
+    as is without METRICS"""
+    if not settings.metrics:
+        return func
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            db_query_seconds.observe(time.perf_counter() - start, query=func.__name__)
+
+    return wrapper
+
+
+# whatsapp (httpx event hooks)
+
+
+def _get_wa_method(request: httpx.Request) -> str:
+    if not request.url.host.startswith("graph."):
+        return "media_download"
+    endpoint = request.url.path.rstrip("/").rsplit("/", maxsplit=1)[-1]
+    return f"{request.method} {'{id}' if endpoint.isdigit() else endpoint}"
+
+
+async def on_wa_request(request: httpx.Request):
+    request.extensions["whatsgram_start"] = time.perf_counter()
+
+
+async def on_wa_response(response: httpx.Response):
+    request = response.request
+    start = request.extensions.get("whatsgram_start")
+    method = _get_wa_method(request)
+    if start is not None:
+        api_request_seconds.observe(time.perf_counter() - start, api="whatsapp", method=method)
+    if response.is_error:
+        api_errors.inc(api="whatsapp", method=method, error=response.status_code)
+
+
+wa_event_hooks = {"request": [on_wa_request], "response": [on_wa_response]}
+
+
+# telegram
+
+
+def instrument_tg_client(client: Client):
+    """Measure every request of the telegram client"""
+    invoke = client.invoke
+
+    @wraps(invoke)
+    async def timed_invoke(query, *args, **kwargs):
+        method = type(query).__name__
+        start = time.perf_counter()
+        try:
+            return await invoke(query, *args, **kwargs)
+        except Exception as e:
+            api_errors.inc(api="telegram", method=method, error=type(e).__name__)
+            raise
+        finally:
+            api_request_seconds.observe(time.perf_counter() - start, api="telegram", method=method)
+
+    client.invoke = timed_invoke
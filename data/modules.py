@@ -16,3 +16,20 @@ class EventType(str, enum.Enum):
     """Event types."""
 
     MSG_WELCOME = enum.auto()
+    BROADCAST = enum.auto()
+
+
+class MediaKeyType(str, enum.Enum):
+    """Media cache key types."""
+
+    TG_FILE_UNIQUE_ID = enum.auto()  # telegram file -> whatsapp media id
+    TG_CONTENT_SHA256 = enum.auto()  # telegram file content -> whatsapp media id
+    WA_SHA256 = enum.auto()  # whatsapp media (with its type) -> telegram file id
+
+
+class BroadcastStatus(str, enum.Enum):
+    """Broadcast status."""
+
+    RUNNING = enum.auto()  # resumed when the bot starts
+    DONE = enum.auto()
+    STOPPED = enum.auto()
@@ -0,0 +1,145 @@
+import dataclasses
+import logging
+import ssl
+
+import httpx
+
+from data import config, utils
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+"""
+The whatsapp numbers that the bot serves (WA_PHONE_ID and WA_NUMBERS).
+
+Every number has its own forum group in telegram (and overflow groups for its new topics, see
+data/placement.py), the users, the topics and the messages in the database belong to a number by its phone id. The webhooks of all the numbers arrive to one endpoint and the number is
+read from the metadata of the update, the messages from the group of a number are sent from that number.
+
+Every number has its own token, its own limit of messages per second (RateLimitedTransport) and its own
+connection pool to the Graph API, the pools share one ssl context (see create_transport).
+"""
+
+
+@dataclasses.dataclass(frozen=True)
+class Number:
+    phone_id: str
+    tg_group_id: int
+    tg_group_ids: tuple[int, ...]  # the group and the overflow groups of the number
+    token: str
+    rate: float  # max messages per second, 0 for no limit
+
+
+def _load() -> dict[str, Number]:
+    numbers = [
+        Number(
+            phone_id=str(settings.wa_phone_id),
+            tg_group_id=settings.tg_group_topic_id,
+            tg_group_ids=(settings.tg_group_topic_id, *settings.tg_overflow_group_ids),
+            token=settings.wa_token,
+            rate=settings.wa_rate,
+        )
+    ] + [
+        Number(
+            phone_id=number.phone_id,
+            tg_group_id=number.tg_group_id,
+            tg_group_ids=(number.tg_group_id, *number.tg_overflow_group_ids),
+            token=number.token or settings.wa_token,
+            rate=settings.wa_rate if number.rate is None else number.rate,
+        )
+        for number in settings.wa_numbers
+    ]
+    phone_ids = [number.phone_id for number in numbers]
+    group_ids = [group_id for number in numbers for group_id in number.tg_group_ids]
+    for field, values in (("phone_id", phone_ids), ("telegram group", group_ids)):
+        if len(set(values)) != len(values):
+            raise ValueError(f"Every whatsapp number needs its own {field}, check WA_NUMBERS")
+    return {number.phone_id: number for number in numbers}
+
+
+_numbers = _load()
+"""example: {phone_id: Number}"""
+
+_by_group = {group_id: number for number in _numbers.values() for group_id in number.tg_group_ids}
+"""example: {tg_group_id: Number}"""
+
+primary = next(iter(_numbers.values()))
+"""the number of WA_PHONE_ID, the users from before WA_NUMBERS belong to it"""
+
+_stats: dict[str, dict[str, float]] = {
+    phone_id: {"messages": 0, "throttled": 0, "wait_total": 0.0} for phone_id in _numbers
+}
+
+
+def get(phone_id: str) -> Number | None:
+    """
+    Get the number of a phone id
+    :param phone_id: the phone number id of the business number
+    :return: None if the bot doesn't serve this number
+    """
+    return _numbers.get(phone_id)
+
+
+def get_by_group(chat_id: int) -> Number | None:
+    """
+    Get the number of a telegram group
+    :param chat_id: the id of the group (or an overflow group of the number)
+    :return: None if the group isn't a group of a number
+    """
+    return _by_group.get(chat_id)
+
+
+def get_all() -> list[Number]:
+    return list(_numbers.values())
+
+
+def get_group_ids() -> list[int]:
+    return list(_by_group)
+
+
+_ssl_context: ssl.SSLContext | None = None
+
+
+def create_transport() -> httpx.AsyncHTTPTransport:
+    """
+    Create the connection pool of a number.
+    A pool for every number and not one for all: httpcore checks every connection of the pool for every request,
+    so the cpu of a request grows with the pool. The pools share the ssl context, every context loads the
+    certificates again (~0.9MB), and the connections are kept open up to the max (httpx keeps 20 by default).
+    """
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = httpx.create_ssl_context()
+    return httpx.AsyncHTTPTransport(
+        verify=_ssl_context,
+        limits=httpx.Limits(
+            max_connections=settings.wa_max_connections,
+            max_keepalive_connections=settings.wa_max_connections,
+        ),
+    )
+
+
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+    """The transport of the session of a number: limits the messages that the number sends, and sends the requests with the pool"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, number: Number):
+        self._transport = transport
+        self._phone_id = number.phone_id
+        self._limiter = utils.RateLimiter(number.rate) if number.rate > 0 else None
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if request.method == "POST" and request.url.path.rstrip("/").endswith("/messages"):
+            stats = _stats[self._phone_id]
+            stats["messages"] += 1
+            if self._limiter is not None:
+                waited = await self._limiter.wait()
+                if waited:
+                    stats["throttled"] += 1
+                    stats["wait_total"] += waited
+        return await self._transport.handle_async_request(request)
+
+
+def get_stats() -> dict[str, dict[str, float]]:
+    """Return the messages of every number, and how many waited for the rate limit"""
+    return {phone_id: dict(stats) for phone_id, stats in _stats.items()}
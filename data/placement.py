@@ -0,0 +1,91 @@
+import logging
+
+from data import config, numbers
+from db import repositoy
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+"""
+The group of the topic of a new user (TG_OVERFLOW_GROUP_IDS and the "tg_overflow_group_ids" of WA_NUMBERS).
+
+A number can have overflow groups in addition to its group, so the topics of many users are split between
+several forum groups: every group is easier to browse, and the messages that are sent to telegram are split
+between the limits of the groups. The group of a topic is saved with the topic (Topic.chat_id), the messages of
+the user go to that group, and the replies in a group are sent from the number of the group.
+
+The placement (TG_PLACEMENT) picks one of the groups of the number:
+- least_loaded: the group with the fewest topics
+- round_robin: the groups one after the other
+- country: the group of the country of the user in TG_GROUP_COUNTRIES (by the prefix of the bsuid, "IL.123..."),
+  the least loaded group for the other countries
+
+A group with TG_GROUP_MAX_TOPICS topics is skipped (0 for no limit), when all the groups of a number are full
+the least loaded group is used.
+"""
+
+_topics: dict[int, int] | None = None
+"""example: {chat_id: topics} - read from the database once, then counted by every process (WORKERS)"""
+
+_round_robin: dict[str, int] = {}
+"""example: {phone_id: the index of the next group}"""
+
+_stats = {"placed": 0, "full": 0}
+
+
+def _get_topics() -> dict[int, int]:
+    global _topics
+    if _topics is None:
+        _topics = repositoy.count_topics_by_chat()
+    return _topics
+
+
+def _get_country(bsuid: str | None) -> str | None:
+    """The country of the user, the bsuid starts with it (example: "IL.13491208655302741918")"""
+    if bsuid is None or "." not in bsuid:
+        return None
+    return bsuid.split(".", 1)[0].upper()
+
+
+def get_group(number: numbers.Number, bsuid: str | None) -> int:
+    """
+    Get the group for the topic of a new user, and count the topic in it
+    :param number: the number that the user wrote to
+    :param bsuid: the bsuid of the user, for the "country" placement
+    :return: the chat id of the group
+    """
+    _stats["placed"] += 1
+    topics = _get_topics()
+    groups = [
+        chat_id
+        for chat_id in number.tg_group_ids
+        if not settings.tg_group_max_topics or topics.get(chat_id, 0) < settings.tg_group_max_topics
+    ]
+    if not groups:
+        _stats["full"] += 1
+        _logger.warning(
+            f"All the groups of {number.phone_id} have {settings.tg_group_max_topics} topics, "
+            f"add a group to its overflow groups"
+        )
+        groups = list(number.tg_group_ids)
+
+    chat_id = None
+    if settings.tg_placement == "round_robin":
+        index = _round_robin.get(number.phone_id, 0)
+        _round_robin[number.phone_id] = index + 1
+        chat_id = groups[index % len(groups)]
+    elif settings.tg_placement == "country":
+        chat_id = settings.tg_group_countries.get(_get_country(bsuid))
+        if chat_id not in groups:  # another country, a group of another number or a full group
+            chat_id = None
+    if chat_id is None:
+        chat_id = min(groups, key=lambda group_id: topics.get(group_id, 0))
+
+    topics[chat_id] = topics.get(chat_id, 0) + 1
+    return chat_id
+
+
+def get_stats() -> dict:
+    """Return the topics in every group (known to this process) and how many placements found all the groups full"""
+    return {**_stats, "groups": dict(_get_topics())}
@@ -0,0 +1,111 @@
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
+import typing
+from concurrent.futures.process import BrokenProcessPool
+
+_logger = logging.getLogger(__name__)
+
+"""
+A bounded pool of processes for the CPU work of the bot (the conversions of data/transcode.py and
+data/stickers.py), so the event loop keeps handling the updates while it runs (in a thread it would hold the GIL).
+
+The jobs that wait or run are limited to the queue size, above it a job is rejected instead of waiting behind the
+others. A job is sent to a process when one is free, so the timeout is the time of the job and not of its wait. A
+job that takes longer fails, and keeps its process until it ends.
+
+A process that dies (killed by the OOM killer on a huge image) breaks the pool: its jobs fail, and the next job
+starts a new pool.
+
+The processes are started by a forkserver, a clean process that doesn't have the threads of the bot (the logging
+queue, the watchdog, the redis pub/sub): a fork of the bot could copy a lock that one of them holds, and hang on it.
+The processes import main.py as __mp_main__, that imports only the standard library there: the job imports its
+own module (without the database, the redis subscriber or the logging of the bot).
+"""
+
+T = typing.TypeVar("T")
+
+
+class PoolBusy(Exception):
+    """The queue of the pool is full"""
+
+
+class Pool:
+    """A pool of processes that runs up to queue_size jobs, workers at a time"""
+
+    def __init__(self, *, workers: int, queue_size: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.pending = 0
+        """the jobs that wait or run"""
+        self.restarts = 0
+        self._executor: concurrent.futures.ProcessPoolExecutor | None = None
+        self._free: asyncio.Semaphore | None = None
+        """the processes that don't run a job, the jobs of a broken pool free them when they fail"""
+
+    def _get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("forkserver")
+            )
+        return self._executor
+
+    def _restart(self, executor: concurrent.futures.ProcessPoolExecutor):
+        """Drop a broken pool, once for all its failed jobs"""
+        if self._executor is not executor:
+            return
+        _logger.warning("A process of the pool died, starting a new pool")
+        self.restarts += 1
+        self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    async def run(self, fn: typing.Callable[..., T], *args: typing.Any, timeout: float) -> T:
+        """
+        Run a function in a process, when one is free
+        :param fn: a function of a module (it's pickled by its name)
+        :param args: the arguments, pickled to the process
+        :param timeout: seconds of the job, without the wait for a process
+        :return: the result of the function
+        :raises PoolBusy: queue_size jobs are waiting or running
+        :raises TimeoutError: the job took longer than the timeout
+        :raises BrokenProcessPool: a process of the pool died
+        """
+        if self.pending >= self.queue_size:
+            raise PoolBusy(f"{self.pending} jobs are waiting or running")
+
+        self.pending += 1
+        try:
+            if self._free is None:
+                self._free = asyncio.Semaphore(self.workers)
+            free = self._free
+            await free.acquire()
+            loop = asyncio.get_running_loop()
+            executor = None
+            try:
+                executor = self._get_executor()
+                future = executor.submit(fn, *args)
+            except BaseException as e:
+                free.release()
+                if isinstance(e, BrokenProcessPool):
+                    self._restart(executor)
+                raise
+
+            # the process is free when the job ends, also after a timeout
+            future.add_done_callback(
+                lambda _: loop.is_closed() or loop.call_soon_threadsafe(free.release)
+            )
+            try:
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+            except BrokenProcessPool:
+                self._restart(executor)
+                raise
+        finally:
+            self.pending -= 1
+
+    def shutdown(self):
+        """Stop the processes, the next job starts a new pool (also in another event loop)"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        self._free = None
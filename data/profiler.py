@@ -0,0 +1,152 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+"""
+On demand profiler of the event loop.
+
+Nothing runs until profile() is called: a thread samples the stack of the event loop thread,
+a task measures the event loop lag, and the asyncio debug mode reports the slow callbacks.
+"""
+
+SAMPLE_INTERVAL = 0.005  # seconds between stack samples
+LAG_INTERVAL = 0.1  # seconds between event loop lag checks
+TOP_STACKS = 25
+MAX_SECONDS = 300
+
+_path_prefixes = sorted({*sys.path, os.getcwd()} - {""}, key=len, reverse=True)
+
+_running = False
+
+
+class ProfilerBusy(Exception):
+    """Another profile is already running"""
+
+
+class _Sampler(threading.Thread):
+    """Sample the stack of a thread"""
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="whatsgram-profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: collections.Counter[tuple[str, ...]] = collections.Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{_short_path(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class _SlowCallbacks(logging.Handler):
+    """Collect the slow callbacks that asyncio reports in debug mode"""
+
+    def __init__(self):
+        super().__init__(level=logging.WARNING)
+        self.callbacks: list[str] = []
+
+    def emit(self, record: logging.LogRecord):
+        message = record.getMessage()
+        if message.startswith("Executing "):
+            self.callbacks.append(message)
+
+
+def _short_path(path: str) -> str:
+    for prefix in _path_prefixes:
+        if path.startswith(prefix):
+            return path[len(prefix) :].lstrip(os.sep)
+    return path
+
+
+async def _measure_lag(lags: list[float], stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(loop.time() - start - LAG_INTERVAL)
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile))]
+
+
+async def profile(seconds: float, slow_callback_ms: int) -> str:
+    """
+    Profile the event loop
+    :param seconds: how long to profile, up to MAX_SECONDS
+    :param slow_callback_ms: callbacks that block the loop longer than this are reported
+    :return: the report, top stacks, event loop lag, slow callbacks and all the stacks in folded format
+    :raises ProfilerBusy: if another profile is running
+    """
+    global _running
+    if _running:
+        raise ProfilerBusy()
+    _running = True
+    seconds = min(seconds, MAX_SECONDS)
+
+    loop = asyncio.get_running_loop()
+    debug, slow_callback_duration = loop.get_debug(), loop.slow_callback_duration
+    asyncio_logger = logging.getLogger("asyncio")
+    slow_callbacks = _SlowCallbacks()
+    sampler = _Sampler(threading.get_ident(), SAMPLE_INTERVAL)
+    lags: list[float] = []
+    stop_lag = asyncio.Event()
+
+    _logger.info(f"profiling for {seconds} seconds")
+    started_at = time.perf_counter()
+    asyncio_logger.addHandler(slow_callbacks)
+    loop.slow_callback_duration = slow_callback_ms / 1000
+    loop.set_debug(True)
+    sampler.start()
+    lag_task = asyncio.create_task(_measure_lag(lags, stop_lag))
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stop_lag.set()
+        await lag_task
+        loop.set_debug(debug)
+        loop.slow_callback_duration = slow_callback_duration
+        asyncio_logger.removeHandler(slow_callbacks)
+        await asyncio.to_thread(sampler.stop)
+        _running = False
+    duration = time.perf_counter() - started_at
+
+    samples = sum(sampler.stacks.values())
+    lines = [
+        f"Profile of {duration:.1f}s, {samples} samples every {SAMPLE_INTERVAL * 1000:.0f}ms",
+        "",
+        f"Event loop lag (checked every {LAG_INTERVAL * 1000:.0f}ms):",
+        f"  p50: {_percentile(lags, 0.5) * 1000:.1f}ms",
+        f"  p99: {_percentile(lags, 0.99) * 1000:.1f}ms",
+        f"  max: {max(lags, default=0) * 1000:.1f}ms",
+        "",
+        f"Slow callbacks (over {slow_callback_ms}ms): {len(slow_callbacks.callbacks)}",
+        *(f"  {callback}" for callback in slow_callbacks.callbacks),
+        "",
+        f"Top {TOP_STACKS} stacks:",
+    ]
+    for stack, count in sampler.stacks.most_common(TOP_STACKS):
+        lines.append(f"  {count / samples:.1%} ({count} samples)")
+        lines.extend(f"    {frame}" for frame in stack[-10:])
+    lines.extend(["", "All stacks (folded, for flamegraph.pl / speedscope):"])
+    lines.extend(f"{';'.join(stack)} {count}" for stack, count in sampler.stacks.items())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+
+from pywa_async import errors as wa_errors
+
+from data import clients, config
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+
+_unread: dict[tuple[str, str], str] = {}
+"""example: {(phone_id, wa_user_id): wa_msg_id} - the newest message from the user that was not marked as read yet"""
+
+_pending: dict[tuple[str, str], asyncio.Task] = {}
+"""example: {(phone_id, wa_user_id): task} - the scheduled mark as read of the user"""
+
+_stats = {"requested": 0, "sent": 0, "saved": 0, "failed": 0}
+
+
+def set_unread(*, wa_user_id: str, wa_msg_id: str, phone_id: str):
+    """
+    Remember the newest message from the user, called for every message that arrives from WhatsApp
+    :param wa_user_id: the bsuid or the wa_id of the user
+    :param wa_msg_id: the id of the message in whatsapp
+    :param phone_id: the number that received the message
+    """
+    _unread[(phone_id, wa_user_id)] = wa_msg_id
+
+
+def mark_as_read(*, wa_user_id: str, phone_id: str):
+    """
+    Schedule mark as read of the newest unread message of the user.
+    Every call restarts the quiet window, so a burst of replies ends with a single request to WhatsApp.
+    :param wa_user_id: the bsuid or the wa_id of the user
+    :param phone_id: the number that received the messages
+    """
+    _stats["requested"] += 1
+    key = (phone_id, wa_user_id)
+    if key not in _unread:  # nothing to read
+        return
+
+    task = _pending.pop(key, None)
+    if task is not None:  # folded into the scheduled mark as read
+        task.cancel()
+        _stats["saved"] += 1
+    _pending[key] = asyncio.create_task(_mark_later(key))
+
+
+async def _mark_later(key: tuple[str, str]):
+    await asyncio.sleep(settings.wa_mark_as_read_delay)
+
+    # from here the task is no longer cancelable by a new reply
+    _pending.pop(key, None)
+    wa_msg_id = _unread.pop(key, None)
+    if wa_msg_id is None:
+        return
+
+    try:
+        await clients.get_wa_bot(key[0]).mark_message_as_read(message_id=wa_msg_id)
+        _stats["sent"] += 1
+    except wa_errors.WhatsAppError as e:
+        _stats["failed"] += 1
+        _logger.debug(f"Error marking message {wa_msg_id} as read: {e.message}")
+
+
+def get_stats() -> dict[str, int]:
+    """
+    Return mark as read stats, how many requests were saved by the debounce (folded into a scheduled mark as read),
+    and the marks that are scheduled
+    """
+    return {**_stats, "pending": len(_pending)}
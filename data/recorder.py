@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+
+from pyrogram import Client, types as tg_types
+from sqlalchemy.exc import NoResultFound
+
+from data import config, numbers, utils
+from db import repositoy
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+"""
+Record the incoming traffic, to replay it later with `python -m benchmarks.replay`.
+
+Every line of the file is a json event with the time it arrived:
+    {"t": 1700000000.123, "src": "wa", "body": {...}}  # the webhook body
+    {"t": 1700000000.456, "src": "tg", "kind": "message", ...}  # what the bot reads from the update
+
+The events are sanitized: the phone numbers and the ids of the users are replaced by hashes, so the same user gets
+the same fake id in all the file, and every other string that isn't an id, a type or a time (`_KEEP_KEYS`) is masked,
+the length is kept.
+"""
+
+FLUSH_INTERVAL = 1  # seconds between writes to the file
+
+_PHONE_KEYS = {"wa_id", "from", "recipient_id", "input", "phone"}
+_USER_ID_KEYS = {"user_id", "parent_user_id", "recipient_user_id", "from_user_id"}
+_KEEP_KEYS = {"object", "field", "messaging_product", "id", "message_id", "timestamp", "expiration_timestamp",
+              "type", "status", "mime_type", "sha256", "animated", "voice", "emoji", "forwarded",
+              "frequently_forwarded", "category", "pricing_model", "source_type", "media_type"}  # fmt: skip
+"""the keys of the structure of the webhooks, their strings are kept and every other string is masked"""
+_DROP_KEYS = {"identity_key_hash", "display_phone_number", "phone_number_id", "vcard"}
+
+_buffer: list[str] = []
+_flush_task: asyncio.Task | None = None
+_stats = {"wa": 0, "tg": 0, "failed": 0}
+
+
+def _hash(value: str) -> str:
+    return hashlib.sha256(value.encode()).hexdigest()
+
+
+def fake_phone(phone: str) -> str:
+    """The same fake phone number for the same phone number"""
+    return "999" + str(int(_hash(phone)[:12], 16))[:9].zfill(9)
+
+
+def _fake_user_id(user_id: str) -> str:
+    country, _, _ = user_id.rpartition(".")
+    return f"{country or 'XX'}.{int(_hash(user_id)[:12], 16)}"
+
+
+def mask(text: str) -> str:
+    """Replace the characters of the text, keep the length and the spaces"""
+    return re.sub(r"\S", "x", text)
+
+
+def sanitize(value):
+    """Sanitize a webhook body (recursively)"""
+    if isinstance(value, dict):
+        sanitized = {}
+        for key, item in value.items():
+            if key in _DROP_KEYS:
+                continue
+            if isinstance(item, str) and key in _PHONE_KEYS:
+                sanitized[key] = fake_phone(item)
+            elif isinstance(item, str) and key in _USER_ID_KEYS:
+                sanitized[key] = _fake_user_id(item)
+            elif isinstance(item, str) and key == "filename":
+                sanitized[key] = "file" + (re.search(r"\.\w{1,5}$", item) or [""])[0]
+            elif isinstance(item, str) and key not in _KEEP_KEYS:
+                sanitized[key] = mask(item)
+            elif isinstance(item, float) and key in ("latitude", "longitude"):
+                sanitized[key] = 0.0
+            else:
+                sanitized[key] = sanitize(item)
+        return sanitized
+    if isinstance(value, list):
+        return [sanitize(item) for item in value]
+    return value
+
+
+def _write(event: dict):
+    global _flush_task
+    _buffer.append(json.dumps(event, separators=(",", ":"), ensure_ascii=False))
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.create_task(_flush_later())
+
+
+async def _flush_later():
+    await asyncio.sleep(FLUSH_INTERVAL)
+    await flush()
+
+
+def _append(lines: list[str]):
+    with open(settings.record_traffic_file, "a", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+async def flush():
+    """Write the buffered events to the file"""
+    if not _buffer:
+        return
+    lines = _buffer.copy()
+    _buffer.clear()
+    try:
+        await asyncio.to_thread(_append, lines)
+    except OSError as e:
+        _stats["failed"] += len(lines)
+        _logger.error(f"Error recording {len(lines)} events: {e}")
+
+
+def record_wa(body: bytes, received_at: float):
+    """Record a whatsapp webhook body"""
+    try:
+        update = json.loads(body)
+    except ValueError:
+        return
+    _stats["wa"] += 1
+    _write({"t": round(received_at, 3), "src": "wa", "body": sanitize(update)})
+
+
+class WebhookRecorder:
+    """ASGI middleware that records the bodies of the whatsapp webhook when they arrive"""
+
+    def __init__(self, app, path: str):
+        self.app = app
+        self.path = path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] != self.path:
+            await self.app(scope, receive, send)
+            return
+
+        received_at = time.time()
+        chunks = []
+
+        async def receive_and_record():
+            message = await receive()
+            if message["type"] == "http.request":
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body"):
+                    record_wa(b"".join(chunks), received_at)
+            return message
+
+        await self.app(scope, receive_and_record, send)
+
+
+# telegram
+
+
+def _get_topic_user(chat_id: int, topic_id: int | None) -> str | None:
+    if numbers.get_by_group(chat_id) is None:
+        return None
+    try:
+        user = repositoy.get_topic_by_topic_id(topic_id=topic_id, chat_id=chat_id).user
+    except NoResultFound:
+        return None
+    return fake_phone(user.wa_id) if user.wa_id else _fake_user_id(user.bsuid)
+
+
+async def record_tg_message(_: Client, msg: tg_types.Message):
+    """Record a message that was sent in a topic (pyrogram handler, in a group before the bot handlers)"""
+    if not msg.is_topic_message or msg.service or (msg.text and msg.text.startswith("/")):
+        return
+    text = msg.text or msg.caption
+    media = getattr(msg, msg.media.name.lower(), None) if msg.media else None
+    _stats["tg"] += 1
+    _write(
+        {
+            "t": round(time.time(), 3),
+            "src": "tg",
+            "kind": "message",
+            "id": msg.id,
+            "user": _get_topic_user(msg.chat.id, msg.message_thread_id),
+            "reply_to": msg.reply_to_message_id
+            if msg.reply_to_message_id != msg.message_thread_id
+            else None,
+            "text": mask(text) if msg.text else None,
+            "caption": mask(text) if msg.caption else None,
+            "media": msg.media.name.lower() if msg.media else None,
+            "file_size": getattr(utils.get_media_file(media), "file_size", None),
+            "mime_type": getattr(media, "mime_type", None),
+            "media_group_id": msg.media_group_id,
+        }
+    )
+
+
+async def record_tg_reaction(_: Client, reaction: tg_types.MessageReactionUpdated):
+    """Record a reaction in the group (pyrogram handler, in a group before the bot handlers)"""
+    if numbers.get_by_group(reaction.chat.id) is None:
+        return
+    _stats["tg"] += 1
+    _write(
+        {
+            "t": round(time.time(), 3),
+            "src": "tg",
+            "kind": "reaction",
+            "message_id": reaction.message_id,
+            "emoji": reaction.new_reaction[-1].emoji if reaction.new_reaction else None,
+        }
+    )
+
+
+def get_stats() -> dict[str, int]:
+    """Return the recorded events"""
+    return {**_stats, "buffered": len(_buffer)}
@@ -0,0 +1,132 @@
+import asyncio
+import datetime
+import gzip
+import itertools
+import json
+import logging
+import os
+import sys
+import time
+
+from data import config
+from db import repositoy, tables
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+"""
+The retention of the messages and the maintenance of the database, in the background (DB_MAINTENANCE_INTERVAL).
+
+The message table maps the messages of telegram to the messages of whatsapp, for the replies and the reactions.
+The messages older than MESSAGE_RETENTION_DAYS are appended to gzip json lines files in MESSAGE_ARCHIVE_DIR
+(a file per month) and deleted, in batches of RETENTION_BATCH_SIZE with a pause between them, so the live queries
+wait at most for one batch. A batch is archived before it's deleted, a crash between them archives it twice.
+
+After the retention the WAL of sqlite is checkpointed without waiting for the readers, and the free pages of
+the deleted rows are returned to the disk in small steps (incremental vacuum, for a database that was created
+with auto_vacuum=INCREMENTAL, see db/tables.py). A full VACUUM blocks the writes of the bot until it's done, run
+it while the bot is stopped: `python -m data.retention vacuum` (also switches an old database to incremental).
+"""
+
+BATCH_PAUSE = 0.1  # seconds between the batches and the vacuum steps, the live queries use the database between them
+VACUUM_STEP_PAGES = 256  # pages returned to the disk at once (1MB with pages of 4KB)
+MIN_RETENTION = datetime.timedelta(days=2)  # the 24h window of the broadcasts is read from the messages
+
+_task: asyncio.Task | None = None
+
+_stats = {"runs": 0, "archived": 0, "deleted": 0, "vacuumed_pages": 0, "last_run_seconds": 0.0, "errors": 0}
+
+
+def _archive(rows: list[dict]):
+    """Append the messages to the archive files of their months"""
+    by_month: dict[str, list[dict]] = {}
+    for row in rows:
+        by_month.setdefault(f"{row['created_at']:%Y-%m}", []).append(row)
+    os.makedirs(settings.message_archive_dir, exist_ok=True)
+    for month, month_rows in by_month.items():
+        path = os.path.join(settings.message_archive_dir, f"messages-{month}.jsonl.gz")
+        with gzip.open(path, "at", encoding="utf-8") as f:  # every batch is a gzip member, readable as one file
+            f.writelines(json.dumps(row, default=str) + "\n" for row in month_rows)
+
+
+async def _delete_old_messages() -> int:
+    """Archive and delete the messages that are older than the retention, returns the deleted messages"""
+    before = datetime.datetime.now() - max(
+        datetime.timedelta(days=settings.message_retention_days), MIN_RETENTION
+    )
+    deleted = 0
+    while True:
+        rows = await asyncio.to_thread(repositoy.get_oldest_messages, limit=settings.retention_batch_size)
+        old = list(itertools.takewhile(lambda row: row["created_at"] < before, rows))
+        if not old:
+            break
+        if settings.message_archive_dir:
+            await asyncio.to_thread(_archive, old)
+            _stats["archived"] += len(old)
+        deleted += await asyncio.to_thread(repositoy.delete_messages, ids=[row["id"] for row in old])
+        if len(old) < len(rows):  # the rest is newer
+            break
+        await asyncio.sleep(BATCH_PAUSE)
+    _stats["deleted"] += deleted
+    return deleted
+
+
+async def run_once():
+    """Run the retention and the maintenance once"""
+    start = time.monotonic()
+    if settings.message_retention_days and await _delete_old_messages():
+        for table in ("message", "message_text"):
+            await asyncio.to_thread(repositoy.vacuum_table, table=table)
+
+    await asyncio.to_thread(repositoy.checkpoint)
+    free_pages = await asyncio.to_thread(repositoy.get_free_pages)
+    for _ in range(-(-free_pages // VACUUM_STEP_PAGES)):
+        await asyncio.to_thread(repositoy.incremental_vacuum, pages=VACUUM_STEP_PAGES)
+        await asyncio.sleep(BATCH_PAUSE)
+    _stats["vacuumed_pages"] += free_pages
+
+    _stats["runs"] += 1
+    _stats["last_run_seconds"] = time.monotonic() - start
+    _logger.info(
+        f"Database maintenance took {_stats['last_run_seconds']:.1f}s, "
+        f"{_stats['deleted']} messages deleted and {_stats['vacuumed_pages']} pages vacuumed since the start"
+    )
+
+
+async def _run_periodically():
+    while True:
+        try:
+            await run_once()
+        except Exception:  # noqa
+            _stats["errors"] += 1
+            _logger.exception("Error in the database maintenance: ")
+        await asyncio.sleep(settings.db_maintenance_interval * 60)
+
+
+def start():
+    """Run the retention and the maintenance every DB_MAINTENANCE_INTERVAL minutes, from one process (see main.py)"""
+    global _task
+    if _task is not None or not settings.db_maintenance_interval:
+        return
+    _task = asyncio.create_task(_run_periodically())
+
+
+def get_stats() -> dict[str, float]:
+    """Return the messages that were archived and deleted, and the pages that were returned to the disk"""
+    return dict(_stats)
+
+
+if __name__ == "__main__":
+    tables.create_tables()
+    if sys.argv[1:] == ["vacuum"]:
+        print("Rebuilding the database, the bot should be stopped...")
+        started = time.monotonic()
+        repositoy.vacuum()
+        print(f"Done in {time.monotonic() - started:.1f}s")
+    elif sys.argv[1:] == ["run"]:
+        asyncio.run(run_once())
+        print(get_stats())
+    else:
+        print("usage: python -m data.retention vacuum|run")
+        sys.exit(1)
@@ -0,0 +1,463 @@
+import asyncio
+import bisect
+import hashlib
+import io
+import json
+import logging
+import os
+import pickle
+import struct
+
+from fastapi import FastAPI, Header, Query, Request
+from fastapi.responses import PlainTextResponse
+from pyrogram import Client, raw, utils as tg_utils
+from pyrogram.raw.core import TLObject
+from pywa_async import utils as wa_utils
+from sqlalchemy.exc import NoResultFound
+
+from data import clients, config, metrics, numbers, utils
+from db import repositoy
+from tg import handlers as tg_handlers
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+"""
+Run the bridge in several worker processes (WORKERS=n).
+
+The main process is the router: it receives the WhatsApp webhooks and the Telegram updates, and forwards
+every update over a unix socket to the worker that owns the conversation. The conversations are assigned
+to the workers by consistent hashing of the number and the user (the bsuid, or the wa_id of old users), the
+Telegram updates are mapped to the number by the group and to the user by the topic. The updates of a
+conversation are handled by one worker, one at a time and in the order they arrived, the other conversations
+of the worker run concurrently.
+
+The updates without a conversation (the general topic, other chats) go to worker 0, it also resumes the
+broadcasts. A worker that exits is restarted, the updates that it didn't handle yet are lost.
+
+An admin that was asked for a message (the new welcome message, the broadcast) can answer in any topic, so the
+worker that asked tells the router, and the messages and the buttons of the admin go to that worker until it got
+the answer (the state of the listener is in the memory of the worker, see data/utils.py).
+"""
+
+WORKER_ENV = "WHATSGRAM_WORKER"  # the index of the worker, set by the router
+ROUTER_ENV = "WHATSGRAM_ROUTER"  # the path of the router socket
+VIRTUAL_NODES = 100  # points of every worker on the ring, more points spread the conversations more evenly
+MAX_QUEUED = 10_000  # updates that wait for a worker, above this the router waits
+RESTART_DELAY = 1  # seconds before a worker that exited is started again
+
+_HEADER = struct.Struct(">I")
+
+_locks: dict[str, asyncio.Lock] = {}
+"""example: {conversation: lock} - the update of the conversation that is handled, in the worker"""
+
+_pending: dict[str, int] = {}
+"""example: {conversation: 2} - the updates of the conversation that arrived and were not handled yet"""
+
+_tasks: set[asyncio.Task] = set()
+
+_stats = {"handled": 0, "failed": 0}
+
+forwarded = metrics.register(
+    metrics.Counter(
+        "whatsgram_router_updates_total",
+        "Updates that the router forwarded to the workers",
+        ("worker", "source"),
+    )
+)
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing of the conversations, a new worker takes only 1/n of the conversations of the others"""
+
+    def __init__(self, workers: int, virtual_nodes: int = VIRTUAL_NODES):
+        ring = sorted(
+            (_hash(f"worker-{worker}-{node}"), worker)
+            for worker in range(workers)
+            for node in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in ring]
+        self._workers = [worker for _, worker in ring]
+
+    def get(self, key: str | None) -> int:
+        """
+        Get the worker of the conversation
+        :param key: the conversation, None for the updates without a conversation
+        :return: the index of the worker
+        """
+        if key is None:
+            return 0
+        return self._workers[bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)]
+
+
+def _get_user_key(user: repositoy.WaUser) -> str:
+    return f"{user.phone_id}:{user.bsuid or user.wa_id}"
+
+
+def get_wa_key(update: dict) -> str | None:
+    """
+    Get the conversation of a webhook update
+    :param update: the webhook body
+    :return: the number and the bsuid of the user (the wa_id of users without bsuid), None if the update isn't of a user
+    """
+    try:
+        value = update["entry"][0]["changes"][0]["value"]
+        phone_id = value["metadata"]["phone_number_id"]
+    except (KeyError, IndexError, TypeError):
+        return None
+    contact = (value.get("contacts") or [{}])[0]
+    wa_id = contact.get("wa_id") or (value.get("statuses") or [{}])[0].get("recipient_id")
+    bsuid = contact.get("user_id")
+    for user_id in (wa_id, bsuid):
+        if not user_id:
+            continue
+        try:  # the key of the user in the database, like the telegram updates of the user
+            return _get_user_key(repositoy.get_user_by_wa_id(wa_id=user_id, phone_id=phone_id))
+        except NoResultFound:
+            continue
+    if not (bsuid or wa_id):
+        return None
+    return f"{phone_id}:{bsuid or wa_id}"  # a new user, the bsuid is saved when the user is created
+
+
+def _get_topic_id(message: raw.base.Message) -> int | None:
+    """The topic of the message, like message_thread_id of pyrogram"""
+    reply_to = getattr(message, "reply_to", None)
+    if isinstance(reply_to, raw.types.MessageReplyHeader) and reply_to.forum_topic:
+        return reply_to.reply_to_top_id or reply_to.reply_to_msg_id
+    if isinstance(getattr(message, "action", None), raw.types.MessageActionTopicCreate):
+        return message.id
+    return None
+
+
+async def get_tg_key(client: Client, update: TLObject) -> str | None:
+    """
+    Get the conversation of a telegram update
+    :param client: the client of the router, to get the message of a callback query
+    :param update: the raw update
+    :return: the key of the user of the topic, None if the update isn't in a topic of a user
+    """
+    topic_id = None
+    peer = getattr(getattr(update, "message", None), "peer_id", None) or getattr(update, "peer", None)
+    if not isinstance(peer, raw.types.PeerChannel):
+        return None
+    chat_id = tg_utils.get_channel_id(peer.channel_id)
+    if numbers.get_by_group(chat_id) is None:
+        return None
+    if isinstance(update, (raw.types.UpdateNewChannelMessage, raw.types.UpdateEditChannelMessage)):
+        topic_id = _get_topic_id(update.message)
+    elif isinstance(update, raw.types.UpdateBotMessageReaction):
+        try:
+            topic_id = repositoy.get_message(
+                topic_msg_id=update.msg_id, wa_msg_id=None, chat_id=chat_id
+            ).topic.topic_id
+        except NoResultFound:
+            pass
+    elif isinstance(update, raw.types.UpdateBotCallbackQuery):
+        message = await client.get_messages(
+            chat_id=chat_id, message_ids=update.msg_id, replies=0
+        )
+        topic_id = message.message_thread_id if message and message.is_topic_message else None
+
+    if topic_id is None:
+        return None
+    try:
+        user = repositoy.get_topic_by_topic_id(topic_id=topic_id, chat_id=chat_id).user
+    except NoResultFound:
+        return None
+    return _get_user_key(user) if user else None
+
+
+def _get_tg_sender(update: TLObject) -> int | None:
+    """The user that sent the message or pressed the button of the update"""
+    if isinstance(update, raw.types.UpdateBotCallbackQuery):
+        return update.user_id
+    from_id = getattr(getattr(update, "message", None), "from_id", None)
+    return from_id.user_id if isinstance(from_id, raw.types.PeerUser) else None
+
+
+def _pack(*values) -> bytes:
+    data = pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(len(data)) + data
+
+
+async def _read(reader: asyncio.StreamReader) -> tuple:
+    (size,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    return pickle.loads(await reader.readexactly(size))
+
+
+# router
+
+
+class Router:
+    """Start the workers and forward the updates to them, runs in the main process"""
+
+    def __init__(self, *, workers: int, command: list[str], path: str):
+        """
+        :param workers: the number of worker processes
+        :param command: the command that runs a worker, the index and the socket are passed in the environment
+        :param path: the path of the unix socket that the workers connect to
+        """
+        self.workers = workers
+        self.command = command
+        self.path = path
+        self.ring = HashRing(workers)
+        self._queues = [asyncio.Queue(maxsize=MAX_QUEUED) for _ in range(workers)]
+        self._writers: list[asyncio.StreamWriter | None] = [None] * workers
+        self._connected = [asyncio.Event() for _ in range(workers)]
+        self._processes: list[asyncio.subprocess.Process | None] = [None] * workers
+        self._tasks: list[asyncio.Task] = []
+        self._server: asyncio.AbstractServer | None = None
+        self._listeners: dict[int, int] = {}
+        """example: {admin_id: worker} - the admins that a worker waits for their answer"""
+        self._stopping = False
+        self._stats = {"restarts": 0}
+        metrics.register(
+            metrics.Gauge(
+                "whatsgram_router_queued",
+                "Updates that wait to be sent to the workers",
+                lambda: sum(queue.qsize() for queue in self._queues),
+            )
+        )
+
+    async def start(self):
+        """Start the workers, returns when all of them are connected"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._server = await asyncio.start_unix_server(self._on_connect, path=self.path)
+        for index in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._supervise(index)))
+            self._tasks.append(asyncio.create_task(self._send_loop(index)))
+        await asyncio.gather(*(connected.wait() for connected in self._connected))
+        _logger.info(f"{self.workers} workers are connected")
+
+    async def stop(self, timeout: float = 30):
+        """Send the queued updates, and let the workers finish the updates they got before they exit"""
+        self._stopping = True
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            _logger.warning("The workers didn't take all the queued updates")
+        for writer in self._writers:
+            if writer is not None:
+                writer.close()  # the worker exits after the updates it has
+        processes = [process for process in self._processes if process is not None]
+        try:
+            await asyncio.wait_for(asyncio.gather(*(process.wait() for process in processes)), timeout)
+        except asyncio.TimeoutError:
+            _logger.warning("The workers didn't exit, killing them")
+            for process in processes:
+                if process.returncode is None:
+                    process.kill()
+        for task in self._tasks:
+            task.cancel()
+        self._server.close()
+
+    async def _supervise(self, index: int):
+        """Run the worker, and start it again when it exits"""
+        while True:
+            process = self._processes[index] = await asyncio.create_subprocess_exec(
+                *self.command,
+                env={**os.environ, WORKER_ENV: str(index), ROUTER_ENV: self.path},
+            )
+            returncode = await process.wait()
+            if self._stopping:
+                return
+            _logger.error(f"Worker {index} exited with code {returncode}, starting it again")
+            self._stats["restarts"] += 1
+            await asyncio.sleep(RESTART_DELAY)
+
+    async def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        (index,) = await _read(reader)
+        self._writers[index] = writer
+        self._connected[index].set()
+        _logger.debug(f"Worker {index} connected")
+        try:
+            while True:  # the worker sends only the changes of its listeners, until it disconnects
+                user_id, listening = await _read(reader)
+                if listening:
+                    self._listeners[user_id] = index
+                elif self._listeners.get(user_id) == index:
+                    del self._listeners[user_id]
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if self._writers[index] is writer:
+                self._connected[index].clear()
+                self._writers[index] = None
+                # the listeners were in the memory of the worker
+                for user_id in [user_id for user_id, worker in self._listeners.items() if worker == index]:
+                    del self._listeners[user_id]
+            writer.close()
+
+    async def _send_loop(self, index: int):
+        queue = self._queues[index]
+        while True:
+            frame = await queue.get()
+            while True:  # until the worker gets it, a worker that exits is started again
+                await self._connected[index].wait()
+                writer = self._writers[index]
+                try:
+                    writer.write(frame)
+                    await writer.drain()
+                    break
+                except (ConnectionError, AttributeError):
+                    _logger.warning(f"Worker {index} disconnected, waiting for it to connect again")
+                    if self._writers[index] is writer:
+                        self._connected[index].clear()
+                        self._writers[index] = None
+            queue.task_done()
+
+    async def forward(self, *, key: str | None, source: str, payload, worker: int | None = None):
+        """
+        Forward an update to the worker of the conversation, the updates of a worker are sent in order
+        :param key: the conversation, see get_wa_key and get_tg_key
+        :param source: "wa" or "tg"
+        :param payload: the webhook body, or the raw telegram update (update, users, chats)
+        :param worker: the worker to send to instead of the worker of the conversation
+        """
+        index = self.ring.get(key) if worker is None else worker
+        forwarded.inc(worker=index, source=source)
+        await self._queues[index].put(_pack(source, key, payload))
+
+    async def on_tg_update(self, client: Client, update: TLObject, users: dict, chats: dict):
+        """Raw update handler of the router client"""
+        await self.forward(
+            key=await get_tg_key(client, update),
+            worker=self._listeners.get(_get_tg_sender(update)),
+            source="tg",
+            payload=(
+                update.write(),
+                [user.write() for user in users.values()],
+                [chat.write() for chat in chats.values()],
+            ),
+        )
+
+    def add_webhook_routes(self, app: FastAPI):
+        """Receive the whatsapp webhook in the router, instead of the routes that pywa adds"""
+
+        @app.get(settings.wa_webhook_endpoint, include_in_schema=False)
+        async def webhook_challenge(
+            vt: str = Query(alias=wa_utils.HUB_VT), ch: str = Query(alias=wa_utils.HUB_CH)
+        ) -> PlainTextResponse:
+            if vt != settings.wa_verify_token:
+                return PlainTextResponse("Forbidden", status_code=403)
+            return PlainTextResponse(ch)
+
+        @app.post(settings.wa_webhook_endpoint, include_in_schema=False)
+        async def webhook(
+            request: Request, hmac_header: str | None = Header(default=None, alias=wa_utils.HUB_SIG)
+        ) -> PlainTextResponse:
+            body = await request.body()
+            if not hmac_header or not wa_utils.webhook_updates_validator(
+                app_secret=settings.wa_app_secret, request_body=body, x_hub_signature=hmac_header
+            ):
+                return PlainTextResponse("Forbidden", status_code=403)
+            try:
+                update = json.loads(body)
+            except ValueError:
+                return PlainTextResponse("Bad Request", status_code=400)
+            await self.forward(key=get_wa_key(update), source="wa", payload=body)
+            return PlainTextResponse("ok")
+
+    def get_stats(self) -> dict[str, int]:
+        """Return the router stats: the updates that wait for the workers and the restarts of the workers"""
+        return {
+            "workers": self.workers,
+            "connected": sum(connected.is_set() for connected in self._connected),
+            "queued": sum(queue.qsize() for queue in self._queues),
+            "restarts": self._stats["restarts"],
+        }
+
+
+# worker
+
+
+async def serve(*, index: int, path: str):
+    """
+    Handle the updates that the router forwards to this worker, returns when the router closes the connection
+    :param index: the index of the worker
+    :param path: the socket of the router
+    """
+    for _ in range(100):
+        try:
+            reader, writer = await asyncio.open_unix_connection(path)
+            break
+        except (FileNotFoundError, ConnectionRefusedError):
+            await asyncio.sleep(0.1)
+    else:
+        raise ConnectionError(f"Can't connect to the router at {path}")
+    writer.write(_pack(index))
+    await writer.drain()
+    utils.on_listener_change = lambda user_id, listening: writer.write(_pack(user_id, listening))
+    _logger.info(f"Worker {index} is connected to the router")
+
+    while True:
+        try:
+            source, key, payload = await _read(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            break
+        if key is not None:
+            _pending[key] = _pending.get(key, 0) + 1
+        task = asyncio.create_task(_handle_in_order(key, source, payload))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+    _logger.info(f"The router closed the connection, finishing {len(_tasks)} updates")
+    utils.on_listener_change = None
+    if _tasks:
+        await asyncio.wait(set(_tasks))
+    writer.close()
+
+
+async def _handle_in_order(key: str | None, source: str, payload):
+    """Handle the update after the previous updates of the conversation, the tasks start in the order they were created"""
+    if key is None:  # the general topic, runs concurrently like in a single process
+        await _handle(source, payload)
+        return
+    lock = _locks.setdefault(key, asyncio.Lock())
+    try:
+        async with lock:
+            await _handle(source, payload)
+    finally:
+        _pending[key] -= 1
+        if not _pending[key]:
+            del _pending[key]
+            del _locks[key]
+
+
+async def _handle(source: str, payload):
+    try:
+        if source == "wa":
+            await clients.wa_bot.webhook_update_handler(update=payload)
+        else:
+            update, users, chats = (
+                TLObject.read(io.BytesIO(payload[0])),
+                [TLObject.read(io.BytesIO(user)) for user in payload[1]],
+                [TLObject.read(io.BytesIO(chat)) for chat in payload[2]],
+            )
+            await clients.tg_bot.fetch_peers(users + chats)  # like the client does with the updates it receives
+            parser = clients.tg_bot.dispatcher.update_parsers.get(type(update))
+            if parser is None:
+                return
+            parsed, handler_type = await parser(
+                update, {user.id: user for user in users}, {chat.id: chat for chat in chats}
+            )
+            for handler in tg_handlers.HANDLERS:  # the first handler that matches, like the pyrogram dispatcher
+                if isinstance(handler, handler_type) and await handler.check(clients.tg_bot, parsed):
+                    await handler.callback(clients.tg_bot, parsed)
+                    break
+        _stats["handled"] += 1
+    except Exception:  # noqa
+        _stats["failed"] += 1
+        _logger.exception(f"Error handling {source} update")
+
+
+def get_stats() -> dict[str, int]:
+    """Return the worker stats: the handled updates, and the conversations with updates that wait"""
+    return {**_stats, "in_flight": len(_tasks), "conversations": len(_locks)}
@@ -0,0 +1,268 @@
+import asyncio
+import collections
+import gzip
+import io
+import logging
+import time
+import typing
+
+from pyrogram import types as tg_types
+
+from data import config, metrics, pool
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+"""
+Convert the animated (TGS, Lottie) and the video (WebM) stickers of telegram to animated WebP stickers of
+whatsapp (STICKER_CONVERT), instead of rejecting them.
+
+An animated sticker is rendered by rlottie and a video sticker is decoded by PyAV, the frames are made 512x512
+and encoded by Pillow as an animated WebP below 500KB: with a lower quality, and then with fewer frames per
+second, until it fits. A sticker takes seconds of CPU, so the stickers are converted in a pool of STICKER_WORKERS
+processes (see data/pool.py), apart from the pool of IMAGE_TRANSCODE, so a burst of stickers doesn't delay the
+photos.
+
+The converted stickers are kept in memory up to STICKER_CACHE_MB by their file_unique_id, that is the same in
+every chat, so a popular sticker is downloaded and converted once for all the numbers (the media id of an upload
+is reused only by its number, see data/media_reuse.py). The same sticker that is sent again while it's converted
+waits for the conversion instead of starting another one.
+"""
+
+STICKER_SIZE = 512
+MAX_KB = 500  # https://developers.facebook.com/docs/whatsapp/cloud-api/reference/media#supported-media-types
+MAX_FPS = 30
+MIN_FPS = 5
+QUALITIES = (75, 50, 30)
+WEBP_METHOD = 2  # a quarter faster than the default 4 of libwebp, the stickers are a bit bigger
+
+
+class ConvertError(Exception):
+    """The sticker can't be converted within the limit"""
+
+
+class ConvertBusy(ConvertError):
+    """STICKER_QUEUE_SIZE stickers are already waiting or running"""
+
+
+_pool = pool.Pool(workers=settings.sticker_workers, queue_size=settings.sticker_queue_size)
+
+_cache: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+"""example: {file_unique_id: webp} - the least recently used first"""
+_cache_bytes = 0
+
+_converting: dict[str, asyncio.Future] = {}
+"""example: {file_unique_id: future} - the stickers that are converted now"""
+
+lookups = metrics.register(
+    metrics.Counter(
+        "whatsgram_sticker_cache_total",
+        "Animated and video stickers by the result of the lookup in the cache of the converted stickers",
+        ("result",),
+    )
+)
+convert_seconds = metrics.register(
+    metrics.Histogram(
+        "whatsgram_sticker_convert_seconds",
+        "Time of the conversion of a sticker, with the wait for a process",
+        ("type",),
+        buckets=(0.5, 1, 2, 3, 5, 10, 20, 30, 60),
+    )
+)
+
+_stats = {
+    "hits": 0,
+    "misses": 0,
+    "waited": 0,
+    "converted": 0,
+    "failed": 0,
+    "timeouts": 0,
+    "rejected": 0,
+    "evicted": 0,
+    "seconds": 0.0,
+    "max_seconds": 0.0,
+}
+
+
+def _get_lottie_frames(data: bytes) -> tuple[list, float]:
+    """The frames of a TGS sticker (gzipped Lottie), and their frames per second"""
+    from rlottie_python import LottieAnimation  # only needed with STICKER_CONVERT
+
+    with LottieAnimation.from_data(gzip.decompress(data).decode()) as animation:
+        fps = animation.lottie_animation_get_framerate()
+        step = max(1, round(fps / MAX_FPS))
+        frames = [
+            animation.render_pillow_frame(frame_num=i, width=STICKER_SIZE, height=STICKER_SIZE)
+            for i in range(0, animation.lottie_animation_get_totalframe(), step)
+        ]
+    return frames, fps / step
+
+
+def _get_video_frames(data: bytes) -> tuple[list, float]:
+    """The frames of a WebM sticker (VP9 with alpha), and their frames per second"""
+    import av  # only needed with STICKER_CONVERT
+    from PIL import Image
+
+    with av.open(io.BytesIO(data)) as container:
+        stream = container.streams.video[0]
+        fps = float(stream.average_rate or MAX_FPS)
+        step = max(1, round(fps / MAX_FPS))
+        # the native decoder of ffmpeg drops the alpha of VP9, libvpx keeps it
+        decoder = av.CodecContext.create("libvpx-vp9" if stream.codec_context.name == "vp9" else "libvpx", "r")
+        frames = []
+        for packet in container.demux(stream):
+            for frame in decoder.decode(packet):
+                # to_image of PyAV is RGB, the frame is read with its alpha
+                plane = frame.reformat(format="rgba").planes[0]
+                size = (frame.width, frame.height)
+                frames.append(Image.frombuffer("RGBA", size, bytes(plane), "raw", "RGBA", plane.line_size, 1))
+        frames = frames[::step]
+
+    stickers = []
+    for frame in frames:
+        frame.thumbnail((STICKER_SIZE, STICKER_SIZE), Image.Resampling.LANCZOS)
+        sticker = Image.new("RGBA", (STICKER_SIZE, STICKER_SIZE), (0, 0, 0, 0))
+        sticker.paste(frame, ((STICKER_SIZE - frame.width) // 2, (STICKER_SIZE - frame.height) // 2))
+        stickers.append(sticker)
+    return stickers, fps / step
+
+
+def _to_webp(data: bytes, is_video: bool, max_bytes: int) -> bytes:
+    """Runs in the pool, the sticker as an animated 512x512 WebP below max_bytes"""
+    frames, fps = _get_video_frames(data) if is_video else _get_lottie_frames(data)
+    if not frames:
+        raise ConvertError("The sticker has no frames")
+    step = 1
+    while fps / step >= MIN_FPS:
+        selected = frames[::step]
+        for quality in QUALITIES:
+            output = io.BytesIO()
+            selected[0].save(
+                output,
+                format="WEBP",
+                save_all=True,
+                append_images=selected[1:],
+                duration=round(1000 * step / fps),
+                loop=0,
+                quality=quality,
+                alpha_quality=quality,
+                method=WEBP_METHOD,
+            )
+            if output.tell() <= max_bytes:
+                return output.getvalue()
+        step *= 2
+    raise ConvertError(f"The sticker is above {max_bytes // 1024}KB at any quality")
+
+
+def can_convert(sticker: tg_types.Sticker | None) -> bool:
+    """Check if the sticker is animated or a video, and is converted instead of rejected"""
+    return settings.sticker_convert and sticker is not None and (sticker.is_animated or sticker.is_video)
+
+
+def _get_cached(file_unique_id: str) -> bytes | None:
+    webp = _cache.get(file_unique_id)
+    if webp is not None:
+        _cache.move_to_end(file_unique_id)
+    return webp
+
+
+def _save_cached(file_unique_id: str, webp: bytes):
+    global _cache_bytes
+    max_bytes = settings.sticker_cache_mb * 1024 * 1024
+    if len(webp) > max_bytes:
+        return
+    _cache[file_unique_id] = webp
+    _cache_bytes += len(webp)
+    while _cache_bytes > max_bytes:
+        _, evicted = _cache.popitem(last=False)
+        _cache_bytes -= len(evicted)
+        _stats["evicted"] += 1
+
+
+async def _convert(data: bytes, is_video: bool) -> bytes:
+    """Convert in the pool, when a process is free"""
+    start = time.monotonic()
+    try:
+        webp = await _pool.run(_to_webp, data, is_video, MAX_KB * 1024, timeout=settings.sticker_timeout)
+    except pool.PoolBusy:
+        _stats["rejected"] += 1
+        raise ConvertBusy(f"{_pool.pending} stickers are being converted, try again later")
+    except TimeoutError:
+        _stats["failed"] += 1
+        _stats["timeouts"] += 1
+        raise ConvertError(f"The conversion took more than {settings.sticker_timeout:g}s")
+    except ConvertError:
+        _stats["failed"] += 1
+        raise
+    except Exception as e:  # noqa
+        _stats["failed"] += 1
+        _logger.debug(f"Error converting sticker: {e!r}")
+        raise ConvertError("The sticker can't be converted") from e
+
+    seconds = time.monotonic() - start
+    convert_seconds.observe(seconds, type="video" if is_video else "animated")
+    _stats["converted"] += 1
+    _stats["seconds"] += seconds
+    _stats["max_seconds"] = max(_stats["max_seconds"], seconds)
+    return webp
+
+
+async def convert(
+    sticker: tg_types.Sticker, download: typing.Callable[[], typing.Awaitable[io.BytesIO]]
+) -> io.BytesIO:
+    """
+    Get an animated or a video sticker as an animated WebP, from the cache or converted in the pool
+    :param sticker: the sticker of the message
+    :param download: downloads the sticker, called only when it's not in the cache
+    :return: the WebP, with its name
+    :raises ConvertBusy: STICKER_QUEUE_SIZE stickers are waiting or running
+    :raises ConvertError: the sticker can't be read, can't fit or took longer than STICKER_TIMEOUT
+    """
+    key = sticker.file_unique_id
+    if (webp := _get_cached(key)) is not None:
+        _stats["hits"] += 1
+        lookups.inc(result="hit")
+    elif key in _converting:
+        _stats["waited"] += 1
+        lookups.inc(result="waited")
+        webp = await asyncio.shield(_converting[key])
+    else:
+        _stats["misses"] += 1
+        lookups.inc(result="miss")
+        future = asyncio.get_running_loop().create_future()
+        _converting[key] = future
+        try:
+            webp = await _convert((await download()).getvalue(), sticker.is_video)
+        except (Exception, asyncio.CancelledError) as e:
+            future.set_exception(
+                e if isinstance(e, Exception) else ConvertError("The conversion was cancelled")
+            )
+            future.exception()  # retrieved, also when no one waits for it
+            raise
+        else:
+            future.set_result(webp)
+            _save_cached(key, webp)
+        finally:
+            _converting.pop(key, None)
+
+    output = io.BytesIO(webp)
+    output.name = "sticker.webp"
+    return output
+
+
+def get_stats() -> dict[str, float]:
+    """
+    Return the hits of the cache (a sticker that waited for the same conversion is a hit), and the converted
+    stickers with the seconds of a conversion (with the wait for a process)
+    """
+    total = _stats["hits"] + _stats["misses"] + _stats["waited"]
+    return {
+        **_stats,
+        "hit_rate": (_stats["hits"] + _stats["waited"]) / total if total else 0.0,
+        "cached": len(_cache),
+        "cached_bytes": _cache_bytes,
+        "pending": _pool.pending,
+        "restarts": _pool.restarts,
+        "avg_seconds": _stats["seconds"] / _stats["converted"] if _stats["converted"] else 0.0,
+    }
@@ -0,0 +1,193 @@
+import asyncio
+import datetime
+import logging
+import os
+import time
+
+import httpx
+
+from data import config, metrics
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+EXPORT_INTERVAL = 5  # seconds between exports to the otlp collector
+MAX_BUFFERED_SPANS = 10_000  # spans above this are dropped if the collector is down
+
+stage_seconds = metrics.register(
+    metrics.Histogram(
+        "whatsgram_trace_stage_seconds",
+        "Time spent in every stage of a bridged message",
+        ("trace", "stage"),
+    )
+)
+total_seconds = metrics.register(
+    metrics.Histogram(
+        "whatsgram_trace_total_seconds",
+        "Time from the message was sent until it was delivered to the other side",
+        ("trace",),
+        buckets=(0.5, 1, 2, 3, 5, 10, 20, 30, 60, 120, 300),
+    )
+)
+
+
+class Trace:
+    """
+    Trace of one bridged message, from the time the message was sent by the user until it was delivered.
+
+    Usage:
+        >>> trace = Trace("wa_to_tg", origin=msg.timestamp)  # the first stage is "webhook", until now
+        >>> user = repositoy.get_user_by_wa_id(wa_id=wa_id, phone_id=phone_id)
+        >>> trace.mark("resolve_user")  # the time since the previous mark was spent in "resolve_user"
+        >>> trace.finish()
+    """
+
+    def __init__(
+        self, name: str, origin: datetime.datetime | None = None, first_stage: str = "webhook"
+    ):
+        """
+        :param name: the name of the trace (the direction of the message)
+        :param origin: when the message was sent, if None, now
+        :param first_stage: the name of the stage from the origin until now
+        """
+        self.name = name
+        self.trace_id = os.urandom(16).hex()
+        self.origin_ns = int(origin.timestamp() * 1e9) if origin else time.time_ns()
+        self.spans: list[tuple[str, int, int]] = []
+        """example: [(stage, start_ns, end_ns)]"""
+        self._last_ns = self.origin_ns
+        self.mark(first_stage)
+
+    def mark(self, stage: str):
+        """
+        End the current stage
+        :param stage: the name of the stage that was just finished
+        """
+        now = time.time_ns()
+        self.spans.append((stage, self._last_ns, now))
+        self._last_ns = now
+
+    def finish(self):
+        """Export the trace to the metrics, log it if it's slow and send it to the otlp collector"""
+        total = (self._last_ns - self.origin_ns) / 1e9
+        for stage, start_ns, end_ns in self.spans:
+            stage_seconds.observe((end_ns - start_ns) / 1e9, trace=self.name, stage=stage)
+        total_seconds.observe(total, trace=self.name)
+
+        if total > settings.trace_slow_seconds:
+            _logger.warning(
+                f"slow {self.name} trace {self.trace_id} took {total:.2f}s: "
+                + ", ".join(
+                    f"{stage}={(end_ns - start_ns) / 1e9:.2f}s"
+                    for stage, start_ns, end_ns in self.spans
+                )
+            )
+
+        if settings.otlp_endpoint:
+            _export(self)
+
+
+# otlp exporter (OTLP/HTTP with JSON encoding)
+
+
+_buffer: list[dict] = []
+_flush_task: asyncio.Task | None = None
+_session: httpx.AsyncClient | None = None
+_stats = {"exported": 0, "dropped": 0, "failed": 0}
+
+
+def _to_otlp_spans(trace: Trace) -> list[dict]:
+    root_id = os.urandom(8).hex()
+    attributes = [{"key": "whatsgram.trace", "value": {"stringValue": trace.name}}]
+    spans = [
+        {
+            "traceId": trace.trace_id,
+            "spanId": root_id,
+            "name": trace.name,
+            "kind": 1,  # internal
+            "startTimeUnixNano": str(trace.origin_ns),
+            "endTimeUnixNano": str(trace._last_ns),
+            "attributes": attributes,
+        }
+    ]
+    for stage, start_ns, end_ns in trace.spans:
+        spans.append(
+            {
+                "traceId": trace.trace_id,
+                "spanId": os.urandom(8).hex(),
+                "parentSpanId": root_id,
+                "name": stage,
+                "kind": 1,
+                "startTimeUnixNano": str(start_ns),
+                "endTimeUnixNano": str(end_ns),
+                "attributes": attributes,
+            }
+        )
+    return spans
+
+
+def _export(trace: Trace):
+    global _flush_task
+    spans = _to_otlp_spans(trace)
+    if len(_buffer) + len(spans) > MAX_BUFFERED_SPANS:
+        _stats["dropped"] += len(spans)
+        return
+    _buffer.extend(spans)
+
+    if _flush_task is None or _flush_task.done():
+        _flush_task = asyncio.create_task(_flush_later())
+
+
+async def _flush_later():
+    await asyncio.sleep(EXPORT_INTERVAL)
+    await flush()
+
+
+async def flush():
+    """Send the buffered spans to the otlp collector"""
+    global _session
+    if not _buffer:
+        return
+    spans = _buffer.copy()
+    _buffer.clear()
+
+    if _session is None:
+        _session = httpx.AsyncClient(timeout=settings.httpx_timeout)
+    body = {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": {"stringValue": "whatsgrambot"}}
+                    ]
+                },
+                "scopeSpans": [{"scope": {"name": __name__}, "spans": spans}],
+            }
+        ]
+    }
+    try:
+        res = await _session.post(settings.otlp_endpoint, json=body)
+        res.raise_for_status()
+        _stats["exported"] += len(spans)
+    except httpx.HTTPError as e:
+        _stats["failed"] += len(spans)
+        _logger.debug(f"Error exporting {len(spans)} spans: {e}")
+
+
+async def close():
+    """Send the spans that are still buffered and close the session, when the bot shuts down"""
+    global _session, _flush_task
+    if _flush_task is not None and not _flush_task.done():
+        _flush_task.cancel()
+    _flush_task = None
+    if settings.otlp_endpoint:
+        await flush()
+    if _session is not None:
+        await _session.aclose()
+        _session = None
+
+
+def get_stats() -> dict[str, int]:
+    """Return otlp exporter stats"""
+    return {**_stats, "buffered": len(_buffer)}
@@ -0,0 +1,141 @@
+import io
+import logging
+import time
+
+from pyrogram import enums
+
+from data import config, pool
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+"""
+Re-encode the photos and the stickers that are above the limits of whatsapp (IMAGE_TRANSCODE), instead of
+rejecting them.
+
+A photo is re-encoded as JPEG with a lower quality, and made smaller until it fits. A sticker is made a 512x512
+WebP (the size of the stickers of whatsapp) with a lower quality until it fits. Pillow decodes and encodes the
+images in a pool of TRANSCODE_WORKERS processes (see data/pool.py), so the bot keeps handling the updates while
+they run.
+
+The images that wait or run are limited to TRANSCODE_QUEUE_SIZE, above it an image is rejected instead of
+waiting behind the others. TRANSCODE_TIMEOUT is the time of a conversion and not of its wait for a process, a
+conversion that takes longer fails (Pillow refuses the images above its MAX_IMAGE_PIXELS, so it ends).
+"""
+
+PHOTO_QUALITIES = (90, 80, 70)
+PHOTO_SCALE = 0.75  # the photo is made smaller by this when the lowest quality is still too big
+PHOTO_MAX_SIDE = 4096
+STICKER_SIZE = 512
+STICKER_QUALITIES = (80, 60, 40, 20)
+
+
+class TranscodeError(Exception):
+    """The image can't be re-encoded within the limit"""
+
+
+class TranscodeBusy(TranscodeError):
+    """TRANSCODE_QUEUE_SIZE images are already waiting or running"""
+
+
+_pool = pool.Pool(workers=settings.transcode_workers, queue_size=settings.transcode_queue_size)
+
+_stats = {"converted": 0, "failed": 0, "timeouts": 0, "rejected": 0, "seconds": 0.0, "bytes_in": 0, "bytes_out": 0}
+
+
+def _to_photo(data: bytes, max_bytes: int) -> bytes:
+    """Runs in the pool, the photo as JPEG below max_bytes"""
+    from PIL import Image, ImageOps  # only needed with IMAGE_TRANSCODE
+
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert("RGB")
+    image.thumbnail((PHOTO_MAX_SIDE, PHOTO_MAX_SIDE))
+    while True:
+        for quality in PHOTO_QUALITIES:
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=quality, optimize=True)
+            if output.tell() <= max_bytes:
+                return output.getvalue()
+        if min(image.size) < 100:
+            raise TranscodeError(f"The photo is above {max_bytes // 1024}KB at any size")
+        image = image.resize(
+            (int(image.width * PHOTO_SCALE), int(image.height * PHOTO_SCALE)), Image.Resampling.LANCZOS
+        )
+
+
+def _to_sticker(data: bytes, max_bytes: int) -> bytes:
+    """Runs in the pool, the sticker as a 512x512 WebP below max_bytes"""
+    from PIL import Image  # only needed with IMAGE_TRANSCODE
+
+    image = Image.open(io.BytesIO(data)).convert("RGBA")
+    image.thumbnail((STICKER_SIZE, STICKER_SIZE), Image.Resampling.LANCZOS)
+    sticker = Image.new("RGBA", (STICKER_SIZE, STICKER_SIZE), (0, 0, 0, 0))
+    sticker.paste(image, ((STICKER_SIZE - image.width) // 2, (STICKER_SIZE - image.height) // 2))
+    for quality in STICKER_QUALITIES:
+        output = io.BytesIO()
+        sticker.save(output, format="WEBP", quality=quality, alpha_quality=quality, method=6)
+        if output.tell() <= max_bytes:
+            return output.getvalue()
+    raise TranscodeError(f"The sticker is above {max_bytes // 1024}KB at any quality")
+
+
+def can_transcode(media: enums.MessageMediaType, is_static: bool = True) -> bool:
+    """
+    Check if the media can be re-encoded instead of rejected
+    :param media: the type of the media
+    :param is_static: false for the animated and the video stickers, Pillow can't read them
+    """
+    return settings.image_transcode and (
+        media == enums.MessageMediaType.PHOTO or (media == enums.MessageMediaType.STICKER and is_static)
+    )
+
+
+async def transcode(media: enums.MessageMediaType, download: io.BytesIO, max_kb: int) -> io.BytesIO:
+    """
+    Re-encode a photo or a sticker below the limit, in the pool
+    :param media: PHOTO or STICKER
+    :param download: the downloaded media
+    :param max_kb: the limit of whatsapp
+    :return: the new image, with the name of its format
+    :raises TranscodeBusy: TRANSCODE_QUEUE_SIZE images are waiting or running
+    :raises TranscodeError: the image can't be read, can't fit or took longer than TRANSCODE_TIMEOUT
+    """
+    data = download.getvalue()
+    is_sticker = media == enums.MessageMediaType.STICKER
+    start = time.monotonic()
+    try:
+        result = await _pool.run(
+            _to_sticker if is_sticker else _to_photo, data, max_kb * 1024, timeout=settings.transcode_timeout
+        )
+    except pool.PoolBusy:
+        _stats["rejected"] += 1
+        raise TranscodeBusy(f"{_pool.pending} images are being converted, try again later")
+    except TimeoutError:
+        _stats["failed"] += 1
+        _stats["timeouts"] += 1
+        raise TranscodeError(f"The conversion took more than {settings.transcode_timeout:g}s")
+    except TranscodeError:
+        _stats["failed"] += 1
+        raise
+    except Exception as e:  # noqa
+        _stats["failed"] += 1
+        _logger.debug(f"Error converting {media.name.lower()}: {e!r}")
+        raise TranscodeError(f"The {media.name.lower()} can't be converted") from e
+
+    _stats["converted"] += 1
+    _stats["seconds"] += time.monotonic() - start
+    _stats["bytes_in"] += len(data)
+    _stats["bytes_out"] += len(result)
+    output = io.BytesIO(result)
+    output.name = "sticker.webp" if is_sticker else "photo.jpg"
+    return output
+
+
+def get_stats() -> dict[str, float]:
+    """Return the converted images, and the average seconds of a conversion (with the wait for a process)"""
+    return {
+        **_stats,
+        "pending": _pool.pending,
+        "restarts": _pool.restarts,
+        "avg_seconds": _stats["seconds"] / _stats["converted"] if _stats["converted"] else 0.0,
+    }
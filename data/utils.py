@@ -1,4 +1,7 @@
+import asyncio
 import re
+import time
+import typing
 
 from pyrogram import types as tg_types, Client
 
@@ -52,6 +55,30 @@ def get_user_name_from_topic_name(topic_name: str) -> str:
     return " | ".join(parts[:-1])
 
 
+def get_media_file(media):
+    """The file of the media of a telegram message: the largest size of a photo (the file fields of Photo are
+    deprecated and log a warning), the media itself otherwise"""
+    if isinstance(media, tg_types.Photo) and media.sizes:
+        return media.sizes[-1]
+    return media
+
+
+class RateLimiter:
+    """Space the calls of `wait` by 1 / rate seconds, returns the seconds it waited"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = 0.0
+
+    async def wait(self) -> float:
+        now = time.monotonic()
+        at = max(now, self._next)
+        self._next = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+        return at - now
+
+
 def get_wa_text_to_tg(text: str) -> str:
     """Convert WhatsApp text formatting to Telegram text formatting.
     Args:
@@ -72,14 +99,14 @@ def get_wa_text_to_tg(text: str) -> str:
     return text
 
 
-async def create_topic(tg_bot: Client, wa_id: str, name: str, is_new: bool) -> int:
+async def create_topic(tg_bot: Client, wa_id: str, name: str, is_new: bool, chat_id: int) -> int:
     topic = await tg_bot.create_forum_topic(
-        chat_id=settings.tg_group_topic_id,
+        chat_id=chat_id,
         name=get_topic_name(wa_id, name),
     )
 
     sent = await tg_bot.send_message(
-        chat_id=settings.tg_group_topic_id,
+        chat_id=chat_id,
         text=f"User {name} | {wa_id} {'' if is_new else 're-'}created topic {topic.id}",
         reply_parameters=tg_types.ReplyParameters(message_id=topic.id),
         reply_markup=tg_types.InlineKeyboardMarkup(
@@ -103,6 +130,9 @@ async def create_topic(tg_bot: Client, wa_id: str, name: str, is_new: bool) -> i
 user_id_to_state: dict[str | int : dict] = {}
 """example: {user_id: {answer_type: modules.EventType.MSG_WELCOME}}"""
 
+on_listener_change: typing.Callable[[str | int, bool], None] | None = None
+"""called with the user and if the user is listening now, the workers tell the router (see data/sharding.py)"""
+
 
 def is_answer(**kwargs):
     """example: is_answer(answer_type=modules.EventType.MSG_WELCOME)"""
@@ -120,13 +150,17 @@ def is_answer(**kwargs):
 def add_listener(*, user_id: str | int, data: dict):
     """example: {9721234567: {answer_type: modules.EventType.MSG_WELCOME}}"""
     user_id_to_state.update({user_id: data})
+    if on_listener_change is not None:
+        on_listener_change(user_id, True)
 
 
 def remove_listener(*, user_id: str | int):
     try:
         del user_id_to_state[user_id]
     except KeyError:
-        pass
+        return
+    if on_listener_change is not None:
+        on_listener_change(user_id, False)
 
 
 def get_listener(user_id: str | int) -> dict:
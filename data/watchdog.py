@@ -0,0 +1,128 @@
+import asyncio
+import collections
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from data import config, metrics
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+"""
+Event loop watchdog.
+
+A task wakes up every LAG_INTERVAL and measures how late it woke up (the event loop lag).
+A thread checks that the task keeps waking up, if the loop is blocked longer than the threshold,
+it logs the stack of the event loop thread, the code that blocks it.
+"""
+
+LAG_INTERVAL = 0.1  # seconds between event loop lag checks
+LAG_WINDOW = 3000  # lag samples for the percentiles, 5 minutes
+MAX_BLOCKS = 20  # last blocks that are kept for the stats
+
+lag_seconds = metrics.register(
+    metrics.Histogram(
+        "whatsgram_event_loop_lag_seconds",
+        "Delay of the event loop in running a ready callback",
+        buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+    )
+)
+
+_lags: collections.deque[float] = collections.deque(maxlen=LAG_WINDOW)
+_blocks: collections.deque[dict] = collections.deque(maxlen=MAX_BLOCKS)
+"""example: [{"at": time.time(), "seconds": 0.5, "stack": "..."}]"""
+_stats = {"blocked": 0}
+_last_beat = 0.0
+_task: asyncio.Task | None = None
+
+
+def _get_lag_percentile(percentile: float) -> float:
+    if not _lags:
+        return 0.0
+    lags = sorted(_lags)
+    return lags[min(len(lags) - 1, int(len(lags) * percentile))]
+
+
+for _name, _percentile in (("p50", 0.5), ("p99", 0.99), ("max", 1.0)):
+    metrics.register(
+        metrics.Gauge(
+            f"whatsgram_event_loop_lag_{_name}_seconds",
+            f"The {_name} of the event loop lag in the last {LAG_WINDOW * LAG_INTERVAL:.0f} seconds",
+            lambda percentile=_percentile: _get_lag_percentile(percentile),
+        )
+    )
+metrics.register(
+    metrics.Gauge(
+        "whatsgram_event_loop_blocked_total",
+        "Times the event loop was blocked longer than the threshold",
+        lambda: _stats["blocked"],
+        metric_type="counter",
+    )
+)
+
+
+async def _measure_lag():
+    global _last_beat
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LAG_INTERVAL)
+        lag = max(loop.time() - start - LAG_INTERVAL, 0.0)
+        _last_beat = time.monotonic()
+        _lags.append(lag)
+        lag_seconds.observe(lag)
+
+
+def _watch(loop_thread_id: int, threshold: float):
+    reported_beat = 0.0
+    while True:
+        time.sleep(threshold / 4)
+        last_beat = _last_beat
+        blocked = time.monotonic() - last_beat - LAG_INTERVAL
+        if blocked < threshold or last_beat == reported_beat:
+            continue
+
+        # report every block once, with the stack of the code that blocks the loop right now
+        reported_beat = last_beat
+        frame = sys._current_frames().get(loop_thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        _stats["blocked"] += 1
+        _blocks.append({"at": time.time(), "seconds": blocked, "stack": stack})
+        _logger.warning(f"the event loop is blocked for over {blocked:.2f}s, at:\n{stack}")
+
+
+def start(threshold_ms: int):
+    """
+    Start to watch the event loop, should be called from the event loop
+    :param threshold_ms: log the stack when the loop is blocked longer than this
+    """
+    global _task, _last_beat
+    if _task is not None:
+        return
+    _last_beat = time.monotonic()
+    _task = asyncio.create_task(_measure_lag())
+    threading.Thread(
+        target=_watch,
+        args=(threading.get_ident(), threshold_ms / 1000),
+        name="whatsgram-watchdog",
+        daemon=True,
+    ).start()
+
+
+def get_last_blocks() -> list[dict]:
+    """Return the last times the event loop was blocked, with the stacks"""
+    return list(_blocks)
+
+
+def get_stats() -> dict[str, float]:
+    """Return the event loop lag percentiles (in seconds) and how many times it was blocked"""
+    return {
+        "lag_p50": _get_lag_percentile(0.5),
+        "lag_p99": _get_lag_percentile(0.99),
+        "lag_max": _get_lag_percentile(1.0),
+        "blocked": _stats["blocked"],
+    }
@@ -1,18 +1,36 @@
 import logging
 import datetime
-
-from sqlalchemy import or_
-
-from data import modules, cache_memory
-from db.tables import get_session, WaUser, Topic, Message, MessageToSend, Settings
+import re
+import unicodedata
+
+from sqlalchemy import or_, exists, func, text as sql_text
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from data import config, modules, cache_memory, metrics
+from db.tables import (
+    engine,
+    get_session,
+    WaUser,
+    Topic,
+    Message,
+    MessageText,
+    MessageToSend,
+    Settings,
+    MediaCache,
+    Broadcast,
+)
 
 
 _logger = logging.getLogger(__name__)
 cache = cache_memory.my_cache
 
+settings = config.get_settings()
 
+
+@metrics.timed_query
 def create_user_and_topic(
-    wa_id: str | None, bsuid: str, name: str, username: str | None, topic_id: int
+    wa_id: str | None, bsuid: str, name: str, username: str | None, topic_id: int, phone_id: str, chat_id: int
 ):
     """
     Create user and topic
@@ -21,29 +39,22 @@ def create_user_and_topic(
     :param name: the name of the user and the topic
     :param username: the username of the user
     :param topic_id: the id of the topic
+    :param phone_id: the business number that the user wrote to
+    :param chat_id: the group of the topic
     :return:
     """
 
-    _logger.debug(f"create user {wa_id=}, {bsuid=}, {name=}, {username=}, {topic_id=}")
-    if wa_id is not None:
-        cache.delete(
-            cache_name="get_user_by_wa_id", cache_id=cache.build_cache_id(wa_id=wa_id)
-        )
-    cache.delete(
-        cache_name="get_user_by_wa_id", cache_id=cache.build_cache_id(wa_id=bsuid)
-    )
-    cache.delete(
-        cache_name="get_topic_by_topic_id",
-        cache_id=cache.build_cache_id(topic_id=topic_id),
-    )
-
+    _logger.debug(f"create user {wa_id=}, {bsuid=}, {name=}, {username=}, {topic_id=}, {phone_id=}, {chat_id=}")
     with get_session() as session:
         topic = Topic(
+            phone_id=phone_id,
+            chat_id=chat_id,
             topic_id=topic_id,
             name=name,
             created_at=datetime.datetime.now(),
         )
         user = WaUser(
+            phone_id=phone_id,
             wa_id=wa_id,
             bsuid=bsuid,
             name=name,
@@ -54,90 +65,158 @@ def create_user_and_topic(
 
         session.add_all((user, topic))
         session.commit()
+    _invalidate_user(wa_id=wa_id, bsuid=bsuid, topic_id=topic_id, phone_id=phone_id, chat_id=chat_id)
+
+
+def _invalidate_user(
+    *, wa_id: str | None, bsuid: str | None, topic_id: int | None, phone_id: str, chat_id: int
+):
+    """
+    Delete the cached user (by both of its ids) and its topic, after the change is committed
+    (with a shared cache, another process could read the old row between an earlier delete and the commit)
+    :param wa_id: the number of the user
+    :param bsuid: the bsuid of the user
+    :param topic_id: the id of the topic of the user
+    :param phone_id: the number of the user
+    :param chat_id: the group of the topic
+    :return:
+    """
+    for user_id in {wa_id, bsuid} - {None}:
+        cache.delete(
+            cache_name="get_user_by_wa_id",
+            cache_id=cache.build_cache_id(wa_id=user_id, phone_id=phone_id),
+        )
+    if topic_id is not None:
+        cache.delete(
+            cache_name="get_topic_by_topic_id",
+            cache_id=cache.build_cache_id(topic_id=topic_id, chat_id=chat_id),
+        )
 
 
-@cache.cachable(cache_name="get_user_by_wa_id", params=("wa_id",))
-def get_user_by_wa_id(*, wa_id: str) -> WaUser:
+@cache.cachable(cache_name="get_user_by_wa_id", params=("wa_id", "phone_id"))
+@metrics.timed_query
+def get_user_by_wa_id(*, wa_id: str, phone_id: str) -> WaUser:
     """
     Get user by wa_id
     :param wa_id: the number of the user
+    :param phone_id: the business number that the user writes to
     :return: the user
     """
 
     with get_session() as session:
         return (
             session.query(WaUser)
-            .filter(or_(WaUser.wa_id == wa_id, WaUser.bsuid == wa_id))
+            .filter(
+                or_(WaUser.wa_id == wa_id, WaUser.bsuid == wa_id),
+                WaUser.phone_id == phone_id,
+            )
             .one()
         )
 
 
-@cache.cachable(cache_name="get_topic_by_topic_id", params=("topic_id",))
-def get_topic_by_topic_id(*, topic_id: int) -> Topic:
+@cache.cachable(cache_name="get_topic_by_topic_id", params=("topic_id", "chat_id"))
+@metrics.timed_query
+def get_topic_by_topic_id(*, topic_id: int, chat_id: int) -> Topic:
     """
     Get topic by topic_id
     :param topic_id: the id of the topic
+    :param chat_id: the group of the topic
     :return: the topic
     """
     with get_session() as session:
-        return session.query(Topic).filter(Topic.topic_id == topic_id).one()
+        return (
+            session.query(Topic)
+            .filter(Topic.topic_id == topic_id, Topic.chat_id == chat_id)
+            .one()
+        )
 
 
-def update_user(*, wa_user_id: str, **kwargs):
+@metrics.timed_query
+def update_user(*, wa_user_id: str, phone_id: str, **kwargs):
     """
     Update user
     :param wa_user_id: the number of the user or the bsuid of the user to update (wa_id is preferred, if the user has wa_id)
+    :param phone_id: the business number of the user
     :param kwargs: the fields to update
     :return:
     """
 
-    _logger.debug(f"update user {wa_user_id=}, {kwargs=}")
-    user = get_user_by_wa_id(wa_id=wa_user_id)
-    cache.delete(
-        cache_name="get_topic_by_topic_id",
-        cache_id=cache.build_cache_id(topic_id=user.topic.topic_id),
-    )
-    cache.delete(
-        cache_name="get_user_by_wa_id", cache_id=cache.build_cache_id(wa_id=wa_user_id)
-    )
+    _logger.debug(f"update user {wa_user_id=}, {phone_id=}, {kwargs=}")
+    user = get_user_by_wa_id(wa_id=wa_user_id, phone_id=phone_id)
 
     with get_session() as session:
         session.query(WaUser).filter(
-            or_(WaUser.wa_id == wa_user_id, WaUser.bsuid == wa_user_id)
+            or_(WaUser.wa_id == wa_user_id, WaUser.bsuid == wa_user_id),
+            WaUser.phone_id == phone_id,
         ).update(kwargs)
         session.commit()
+    _invalidate_user(
+        wa_id=user.wa_id,
+        bsuid=user.bsuid,
+        topic_id=user.topic.topic_id,
+        phone_id=phone_id,
+        chat_id=user.topic.chat_id,
+    )
 
 
-def update_topic(*, tg_topic_id: int, **kwargs):
+@metrics.timed_query
+def update_topic(*, tg_topic_id: int, chat_id: int, **kwargs):
     """
     Update topic
     :param tg_topic_id: the id of the topic
+    :param chat_id: the group of the topic
     :param kwargs: the fields to update
     :return:
     """
 
-    _logger.debug(f"update topic tg_topic_id:{tg_topic_id}, kwargs:{kwargs}")
+    _logger.debug(f"update topic tg_topic_id:{tg_topic_id}, chat_id:{chat_id}, kwargs:{kwargs}")
 
-    topic = get_topic_by_topic_id(topic_id=tg_topic_id)
-    cache.delete(
-        cache_name="get_user_by_wa_id",
-        cache_id=cache.build_cache_id(wa_id=topic.user.wa_id),
+    topic = get_topic_by_topic_id(topic_id=tg_topic_id, chat_id=chat_id)
+
+    with get_session() as session:
+        session.query(Topic).filter(
+            Topic.topic_id == tg_topic_id, Topic.chat_id == chat_id
+        ).update(kwargs)
+        session.commit()
+    _invalidate_user(
+        wa_id=topic.user.wa_id,
+        bsuid=topic.user.bsuid,
+        topic_id=kwargs.get("topic_id"),
+        phone_id=topic.phone_id,
+        chat_id=kwargs.get("chat_id", chat_id),
     )
     cache.delete(
         cache_name="get_topic_by_topic_id",
-        cache_id=cache.build_cache_id(topic_id=tg_topic_id),
+        cache_id=cache.build_cache_id(topic_id=tg_topic_id, chat_id=chat_id),
     )
 
+
+@metrics.timed_query
+def count_topics_by_chat() -> dict[int, int]:
+    """
+    Count the topics in every group
+    :return: {chat_id: topics}
+    """
     with get_session() as session:
-        session.query(Topic).filter(Topic.topic_id == tg_topic_id).update(kwargs)
-        session.commit()
+        return dict(
+            session.query(Topic.chat_id, func.count(Topic.id)).group_by(Topic.chat_id).all()
+        )
 
 
 # message
 
 
+@metrics.timed_query
 def create_message(
-    *, wa_id: str, topic_id: int, wa_msg_id: str, topic_msg_id: int, sent_from_tg: bool
+    *,
+    wa_id: str,
+    topic_id: int,
+    wa_msg_id: str,
+    topic_msg_id: int,
+    sent_from_tg: bool,
+    phone_id: str,
+    chat_id: int,
+    text: str | None = None,
 ):
     """
     Create message
@@ -146,19 +225,38 @@ def create_message(
     :param wa_msg_id: the id of the message in whatsapp
     :param topic_msg_id: the id of the message in topic
     :param sent_from_tg: true if the message was sent from telegram
+    :param phone_id: the business number of the conversation
+    :param chat_id: the group of the topic
+    :param text: the text or the caption of the message, saved for /search with MESSAGE_SEARCH
     :return:
     """
     _logger.debug(
-        f"create message wa_id:{wa_id}, topic_id:{topic_id}, wa_msg_id:{wa_msg_id}, topic_msg_id:{topic_msg_id}, sent_from_tg:{sent_from_tg}"
-    )
+        "create message wa_id:%s, topic_id:%s, wa_msg_id:%s, topic_msg_id:%s, sent_from_tg:%s, phone_id:%s, chat_id:%s",
+        wa_id,
+        topic_id,
+        wa_msg_id,
+        topic_msg_id,
+        sent_from_tg,
+        phone_id,
+        chat_id,
+    )  # called for every message, formatted only if debug is enabled
     with get_session() as session:
         user = (
             session.query(WaUser)
-            .filter(or_(WaUser.wa_id == wa_id, WaUser.bsuid == wa_id))
+            .filter(
+                or_(WaUser.wa_id == wa_id, WaUser.bsuid == wa_id),
+                WaUser.phone_id == phone_id,
+            )
+            .one()
+        )
+        topic = (
+            session.query(Topic)
+            .filter(Topic.topic_id == topic_id, Topic.chat_id == chat_id)
             .one()
         )
-        topic = session.query(Topic).filter(Topic.topic_id == topic_id).one()
         message = Message(
+            phone_id=phone_id,
+            chat_id=chat_id,
             wa_msg_id=wa_msg_id,
             topic_msg_id=topic_msg_id,
             topic=topic,
@@ -168,35 +266,45 @@ def create_message(
         )
 
         session.add(message)
+        if text and settings.message_search:
+            session.add(MessageText(message=message, text=str(text)))
         session.commit()
 
 
-@cache.cachable(cache_name="get_message", params=("topic_msg_id", "wa_msg_id"))
-def get_message(*, topic_msg_id: int | None, wa_msg_id: str | None) -> Message:
+@cache.cachable(cache_name="get_message", params=("topic_msg_id", "wa_msg_id", "chat_id"))
+@metrics.timed_query
+def get_message(*, topic_msg_id: int | None, wa_msg_id: str | None, chat_id: int | None) -> Message:
     """
     Get message by topic_msg_id or wa_msg_id
     :param topic_msg_id: the id of the message in topic
-    :param wa_msg_id: the id of the message in whatsapp
+    :param wa_msg_id: the id of the message in whatsapp (unique in all the numbers)
+    :param chat_id: the group of the topic, needed with topic_msg_id
     :return: the message
     """
     with get_session() as session:
         if topic_msg_id:
             return (
                 session.query(Message)
-                .filter(Message.topic_msg_id == topic_msg_id)
+                .filter(Message.topic_msg_id == topic_msg_id, Message.chat_id == chat_id)
                 .one()
             )
-        return session.query(Message).filter(Message.wa_msg_id == wa_msg_id).one()
+        return (
+            session.query(Message)
+            .filter(Message.wa_msg_id == wa_msg_id)
+            .one()
+        )
 
 
-def get_last_message(*, wa_id: str) -> Message:
+@metrics.timed_query
+def get_last_message(*, wa_id: str, phone_id: str) -> Message:
     """
     Get last message by wa_id
     :param wa_id: the number of the user
+    :param phone_id: the business number of the user
     :return: the last message
     """
     with get_session() as session:
-        user = get_user_by_wa_id(wa_id=wa_id)
+        user = get_user_by_wa_id(wa_id=wa_id, phone_id=phone_id)
         return (
             session.query(Message)
             .filter(Message.user == user)
@@ -205,9 +313,162 @@ def get_last_message(*, wa_id: str) -> Message:
         )
 
 
+@metrics.timed_query
+def get_topic_messages(*, topic_id: int, after_id: int, limit: int) -> list[dict]:
+    """
+    Get a page of the messages of a topic, for /export (by the id, so every page reads only its rows)
+    :param topic_id: the id of the topic in the database (Topic.id)
+    :param after_id: the id of the last message of the previous page, 0 for the first page
+    :param limit: the max messages to get
+    :return: the columns of the messages with their text (None without MESSAGE_SEARCH), the oldest first
+    """
+    with get_session() as session:
+        return [
+            row._asdict()
+            for row in session.query(*Message.__table__.columns, MessageText.text)
+            .outerjoin(MessageText, MessageText.message_id == Message.id)
+            .filter(Message.topic_id == topic_id, Message.id > after_id)
+            .order_by(Message.id)
+            .limit(limit)
+        ]
+
+
+@metrics.timed_query
+def get_oldest_messages(*, limit: int) -> list[dict]:
+    """
+    Get the oldest messages, for the retention (by the id and not by created_at, so it reads the start of the
+    primary key instead of scanning the table, the messages are created in the order of the time)
+    :param limit: the max messages to get
+    :return: the columns of the messages, the oldest first
+    """
+    with get_session() as session:
+        return [
+            row._asdict()
+            for row in session.query(*Message.__table__.columns).order_by(Message.id).limit(limit)
+        ]
+
+
+@metrics.timed_query
+def delete_messages(*, ids: list[int]) -> int:
+    """
+    Delete messages, the cached messages are dropped by the cache when they expire
+    :param ids: the ids of the rows
+    :return: the number of deleted rows
+    """
+    with get_session() as session:
+        session.query(MessageText).filter(MessageText.message_id.in_(ids)).delete(synchronize_session=False)
+        deleted = (
+            session.query(Message)
+            .filter(Message.id.in_(ids))
+            .delete(synchronize_session=False)
+        )
+        session.commit()
+    return deleted
+
+
+SEARCH_MAX_MATCHES = 5000  # the newest matches that are ranked, a common word doesn't rank the whole index
+SNIPPET_WORDS = 16
+
+
+def _fold(text: str) -> str:
+    """The text without case and accents, as the full-text index compares the words"""
+    return "".join(c for c in unicodedata.normalize("NFKD", text.casefold()) if not unicodedata.combining(c))
+
+
+def _to_fts_query(query: str) -> str | None:
+    """
+    The words of the query for FTS5, quoted so the syntax of FTS5 (AND, NEAR, "-"...) is searched as text. A word
+    that ends with * is a prefix, it reads the messages of all the words that start with it (slower)
+    :param query: the words as the admin typed them
+    :return: the query, None if it has no words
+    """
+    words = re.findall(r"(\w+)(\*?)", query)
+    if not words:
+        return None
+    return " ".join(f'"{word}"{prefix}' for word, prefix in words)
+
+
+def _get_snippet(text: str, query: str) -> str:
+    """
+    The words of the text around the first match, the matched words between \\x02 and \\x03 (snippet() of FTS5
+    reads the whole list of the messages of a common word again for every result)
+    :param text: the text of the message
+    :param query: the words that were searched
+    :return: the snippet
+    """
+    words = [(_fold(word), prefix) for word, prefix in re.findall(r"(\w+)(\*?)", query)]
+    tokens = text.split()
+    hits = [
+        any(
+            part.startswith(word) if prefix else part == word
+            for part in re.findall(r"\w+", _fold(token))
+            for word, prefix in words
+        )
+        for token in tokens
+    ]
+    start = max(0, hits.index(True) - SNIPPET_WORDS // 4) if any(hits) else 0
+    end = start + SNIPPET_WORDS
+    snippet = " ".join(
+        f"\x02{token}\x03" if hit else token for token, hit in zip(tokens[start:end], hits[start:end])
+    )
+    return f"{'…' if start else ''}{snippet}{'…' if end < len(tokens) else ''}"
+
+
+@metrics.timed_query
+def search_messages(*, query: str, phone_id: str, limit: int) -> list[tuple[Message, str]]:
+    """
+    Search the text of the messages (MESSAGE_SEARCH), the best matches of the newest SEARCH_MAX_MATCHES first
+    :param query: the words to search, all of them must be in the message
+    :param phone_id: the business number of the conversations
+    :param limit: the max results
+    :return: the messages and their snippets, the matched words between \\x02 and \\x03
+    """
+    if engine.dialect.name == "sqlite":
+        fts_query = _to_fts_query(query)
+        if fts_query is None:
+            return []
+        # fts5 returns the matches by the rowid, the newest are read without reading all of them
+        statement = sql_text(
+            "SELECT id FROM ("
+            "SELECT message_text_fts.rowid AS id, rank FROM message_text_fts "
+            "JOIN message ON message.id = message_text_fts.rowid "
+            "WHERE message_text_fts MATCH :query AND message.phone_id = :phone_id "
+            "ORDER BY message_text_fts.rowid DESC LIMIT :max_matches"
+            ") ORDER BY rank LIMIT :limit"
+        )
+        params = {"query": fts_query}
+    else:
+        statement = sql_text(
+            "SELECT id FROM ("
+            "SELECT message_text.message_id AS id, ts_rank(to_tsvector('simple', message_text.text), q) AS rank "
+            "FROM message_text JOIN message ON message.id = message_text.message_id, "
+            "websearch_to_tsquery('simple', :query) q "
+            "WHERE to_tsvector('simple', message_text.text) @@ q AND message.phone_id = :phone_id "
+            "ORDER BY message_text.message_id DESC LIMIT :max_matches"
+            ") best ORDER BY rank DESC LIMIT :limit"
+        )
+        params = {"query": query}
+    params.update(phone_id=phone_id, max_matches=SEARCH_MAX_MATCHES, limit=limit)
+
+    with get_session() as session:
+        ids = session.execute(statement, params).scalars().all()
+        if not ids:
+            return []
+        found = {
+            message.id: (message, message_text)
+            for message, message_text in session.query(Message, MessageText.text)
+            .join(MessageText, MessageText.message_id == Message.id)
+            .filter(Message.id.in_(ids))
+        }
+    return [
+        (found[message_id][0], _get_snippet(found[message_id][1], query)) for message_id in ids if message_id in found
+    ]
+
+
 # message to send
 
 
+@metrics.timed_query
 def create_message_to_send(*, type_event: modules.EventType, text: str):
     """
     Create message to send
@@ -217,11 +478,6 @@ def create_message_to_send(*, type_event: modules.EventType, text: str):
     """
 
     _logger.debug(f"create message to send, type_event:{type_event}, text:{text}")
-    cache.delete(
-        cache_name="get_message_to_send",
-        cache_id=cache.build_cache_id(type_event=type_event),
-    )
-
     with get_session() as session:
         message_to_send = MessageToSend(
             type_event=type_event,
@@ -231,9 +487,14 @@ def create_message_to_send(*, type_event: modules.EventType, text: str):
 
         session.add(message_to_send)
         session.commit()
+    cache.delete(
+        cache_name="get_message_to_send",
+        cache_id=cache.build_cache_id(type_event=type_event),
+    )
 
 
 @cache.cachable(cache_name="get_message_to_send", params=("type_event",))
+@metrics.timed_query
 def get_message_to_send(*, type_event: str) -> MessageToSend:
     """
     Get message to send by type_event
@@ -248,6 +509,7 @@ def get_message_to_send(*, type_event: str) -> MessageToSend:
         )
 
 
+@metrics.timed_query
 def update_message_to_send(*, type_event: str, **kwargs):
     """
     Update message to send
@@ -257,21 +519,21 @@ def update_message_to_send(*, type_event: str, **kwargs):
     """
 
     _logger.debug(f"update message to send, type_event:{type_event}, kwargs:{kwargs}")
-    cache.delete(
-        cache_name="get_message_to_send",
-        cache_id=cache.build_cache_id(type_event=type_event),
-    )
-
     with get_session() as session:
         session.query(MessageToSend).filter(
             MessageToSend.type_event == type_event
         ).update(kwargs)
         session.commit()
+    cache.delete(
+        cache_name="get_message_to_send",
+        cache_id=cache.build_cache_id(type_event=type_event),
+    )
 
 
 # settings
 
 
+@metrics.timed_query
 def create_settings(
     *,
     welcome_msg: bool = False,
@@ -285,8 +547,6 @@ def create_settings(
     """
 
     _logger.debug(f"create settings, {welcome_msg=}, {mark_as_read=}")
-    cache.delete(cache_name="get_settings")
-
     with get_session() as session:
         settings = Settings(
             wa_welcome_msg=welcome_msg,
@@ -295,9 +555,11 @@ def create_settings(
 
         session.add(settings)
         session.commit()
+    cache.delete(cache_name="get_settings")
 
 
 @cache.cachable(cache_name="get_settings")
+@metrics.timed_query
 def get_settings() -> Settings:
     """
     Get settings
@@ -307,6 +569,7 @@ def get_settings() -> Settings:
         return session.query(Settings).one()
 
 
+@metrics.timed_query
 def update_settings(**kwargs):
     """
     Update settings
@@ -315,7 +578,310 @@ def update_settings(**kwargs):
     """
 
     _logger.debug(f"update settings, kwargs:{kwargs}")
-    cache.delete(cache_name="get_settings")
     with get_session() as session:
         session.query(Settings).update(kwargs)
         session.commit()
+    cache.delete(cache_name="get_settings")
+
+
+# media cache
+
+
+@metrics.timed_query
+def create_media_cache(
+    *,
+    key_type: modules.MediaKeyType,
+    key: str,
+    media_id: str,
+    expires_at: datetime.datetime | None,
+):
+    """
+    Create media cache, replace the old one if exists (in one statement, the same media can be uploaded by two
+    messages at the same time)
+    :param key_type: the type of the key
+    :param key: the file_unique_id or the sha256 of the media
+    :param media_id: the id of the uploaded media (whatsapp media id or telegram file id)
+    :param expires_at: when the uploaded media will be deleted, None if never
+    :return:
+    """
+
+    _logger.debug(f"create media cache {key_type=}, {key=}, {media_id=}, {expires_at=}")
+    insert = sqlite_insert if engine.dialect.name == "sqlite" else postgresql_insert
+    statement = insert(MediaCache).values(
+        key_type=key_type,
+        key=key,
+        media_id=media_id,
+        created_at=datetime.datetime.now(),
+        expires_at=expires_at,
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[MediaCache.key_type, MediaCache.key],
+        set_={
+            "media_id": statement.excluded.media_id,
+            "created_at": statement.excluded.created_at,
+            "expires_at": statement.excluded.expires_at,
+        },
+    )
+    with get_session() as session:
+        session.execute(statement)
+        session.commit()
+
+
+@metrics.timed_query
+def get_media_cache(*, key_type: modules.MediaKeyType, key: str) -> MediaCache:
+    """
+    Get media cache that is not expired
+    :param key_type: the type of the key
+    :param key: the file_unique_id or the sha256 of the media
+    :return: the media cache
+    """
+    with get_session() as session:
+        return (
+            session.query(MediaCache)
+            .filter(
+                MediaCache.key_type == key_type,
+                MediaCache.key == key,
+                or_(
+                    MediaCache.expires_at.is_(None),
+                    MediaCache.expires_at > datetime.datetime.now(),
+                ),
+            )
+            .one()
+        )
+
+
+@metrics.timed_query
+def delete_expired_media_cache() -> int:
+    """
+    Delete the expired media cache
+    :return: the number of deleted rows
+    """
+    with get_session() as session:
+        deleted = (
+            session.query(MediaCache)
+            .filter(MediaCache.expires_at <= datetime.datetime.now())
+            .delete()
+        )
+        session.commit()
+
+    _logger.debug(f"deleted {deleted} expired media cache")
+    return deleted
+
+
+# broadcast
+
+
+@metrics.timed_query
+def create_broadcast(
+    *,
+    chat_id: int,
+    msg_id: int,
+    text: str | None,
+    media_type: str | None,
+    media_id: str | None,
+    mime_type: str | None,
+    filename: str | None,
+    template: str | None,
+    template_language: str | None,
+) -> int:
+    """
+    Create a running broadcast
+    :param chat_id: the telegram chat of the broadcast message
+    :param msg_id: the id of the broadcast message in telegram
+    :param text: the text or the caption to send
+    :param media_type: the type of the media (image, video, document, audio or sticker), None for text
+    :param media_id: the id of the media that was uploaded to whatsapp
+    :param mime_type: the mime type of the media
+    :param filename: the filename of a document
+    :param template: the template for the users outside the 24h window, None to skip them
+    :param template_language: the language of the template
+    :return: the id of the broadcast
+    """
+
+    _logger.debug(f"create broadcast {chat_id=}, {msg_id=}, {media_type=}, {template=}")
+    with get_session() as session:
+        broadcast = Broadcast(
+            chat_id=chat_id,
+            msg_id=msg_id,
+            status=modules.BroadcastStatus.RUNNING,
+            text=text,
+            media_type=media_type,
+            media_id=media_id,
+            mime_type=mime_type,
+            filename=filename,
+            template=template,
+            template_language=template_language,
+            created_at=datetime.datetime.now(),
+            updated_at=datetime.datetime.now(),
+        )
+
+        session.add(broadcast)
+        session.commit()
+        return broadcast.id
+
+
+@metrics.timed_query
+def get_broadcast(*, broadcast_id: int) -> Broadcast:
+    """
+    Get broadcast by id
+    :param broadcast_id: the id of the broadcast
+    :return: the broadcast
+    """
+    with get_session() as session:
+        return session.query(Broadcast).filter(Broadcast.id == broadcast_id).one()
+
+
+@metrics.timed_query
+def get_broadcasts(*, status: modules.BroadcastStatus) -> list[Broadcast]:
+    """
+    Get the broadcasts by status
+    :param status: the status of the broadcasts
+    :return: the broadcasts, the oldest first
+    """
+    with get_session() as session:
+        return (
+            session.query(Broadcast)
+            .filter(Broadcast.status == status)
+            .order_by(Broadcast.id)
+            .all()
+        )
+
+
+@metrics.timed_query
+def update_broadcast(*, broadcast_id: int, **kwargs):
+    """
+    Update broadcast
+    :param broadcast_id: the id of the broadcast
+    :param kwargs: the fields to update
+    :return:
+    """
+
+    _logger.debug(f"update broadcast {broadcast_id=}, {kwargs=}")
+    with get_session() as session:
+        session.query(Broadcast).filter(Broadcast.id == broadcast_id).update(
+            {**kwargs, "updated_at": datetime.datetime.now()}
+        )
+        session.commit()
+
+
+def _in_window(window_start: datetime.datetime):
+    """The user sent a message since window_start"""
+    return exists().where(
+        Message.user_id == WaUser.id,
+        Message.sent_from_tg.is_(False),
+        Message.created_at >= window_start,
+    )
+
+
+@metrics.timed_query
+def get_broadcast_users(
+    *, after_id: int, limit: int, window_start: datetime.datetime, phone_id: str
+) -> list[tuple[WaUser, bool]]:
+    """
+    Get a page of the active users that are not banned
+    :param after_id: the page starts after the user with this id
+    :param limit: the max users in the page
+    :param window_start: the users that sent a message since then can get any message, the others only a template
+    :param phone_id: the number of the broadcast
+    :return: the users, the lowest id first, and if they are in the window
+    """
+    with get_session() as session:
+        return [
+            (user, in_window)
+            for user, in_window in session.query(WaUser, _in_window(window_start))
+            .filter(
+                WaUser.active.is_(True),
+                WaUser.banned.is_(False),
+                WaUser.id > after_id,
+                WaUser.phone_id == phone_id,
+            )
+            .order_by(WaUser.id)
+            .limit(limit)
+            .all()
+        ]
+
+
+@metrics.timed_query
+def count_broadcast_users(*, window_start: datetime.datetime, phone_id: str) -> tuple[int, int]:
+    """
+    Count the active users that are not banned
+    :param window_start: see get_broadcast_users
+    :param phone_id: the number of the broadcast
+    :return: all the users, the users in the window
+    """
+    with get_session() as session:
+        return (
+            session.query(func.count(WaUser.id), func.count(WaUser.id).filter(_in_window(window_start)))
+            .filter(WaUser.active.is_(True), WaUser.banned.is_(False), WaUser.phone_id == phone_id)
+            .one()
+            .tuple()
+        )
+
+
+# maintenance
+
+
+@metrics.timed_query
+def checkpoint():
+    """
+    Copy the WAL of sqlite to the database without waiting for the readers (PASSIVE), the next writes reuse the WAL
+    instead of growing it. Does nothing with postgres
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA wal_checkpoint(PASSIVE)")
+
+
+@metrics.timed_query
+def get_free_pages() -> int:
+    """
+    Get the pages of sqlite that can be returned to the disk by incremental_vacuum
+    :return: the free pages, 0 if the database isn't sqlite with auto_vacuum=INCREMENTAL
+    """
+    if engine.dialect.name != "sqlite":
+        return 0
+    with engine.connect() as connection:
+        if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:  # 2 is INCREMENTAL
+            return 0
+        return connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+
+
+@metrics.timed_query
+def incremental_vacuum(*, pages: int):
+    """
+    Return free pages of sqlite to the disk, holds the write lock only for these pages
+    :param pages: the max pages to return
+    """
+    connection = engine.raw_connection()
+    try:
+        # python's sqlite3 steps the pragma once and every step returns one page, executescript steps it to the end
+        connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+    finally:
+        connection.close()
+
+
+@metrics.timed_query
+def vacuum_table(*, table: str):
+    """
+    Mark the space of the deleted rows of postgres for reuse and update the statistics of the planner (VACUUM
+    without FULL doesn't block the reads and the writes). Does nothing with sqlite, see incremental_vacuum
+    :param table: the name of the table
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql(f"VACUUM (ANALYZE) {table}")
+
+
+def vacuum():
+    """
+    Rebuild the whole database, blocks all the writes until it's done, sqlite also switches to auto_vacuum=INCREMENTAL
+    so the space of deleted rows can later be returned with incremental_vacuum
+    """
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        if engine.dialect.name == "sqlite":
+            connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            connection.exec_driver_sql("VACUUM")
+        else:
+            connection.exec_driver_sql("VACUUM FULL")
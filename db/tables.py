@@ -2,7 +2,20 @@ from __future__ import annotations
 import logging
 import datetime
 from contextlib import contextmanager
-from sqlalchemy import String, create_engine, ForeignKey, UniqueConstraint
+from sqlalchemy import (
+    BigInteger,
+    Engine,
+    ForeignKey,
+    Index,
+    String,
+    UniqueConstraint,
+    create_engine,
+    event,
+    inspect,
+    make_url,
+    text,
+)
+from sqlalchemy.schema import AddConstraint, CreateTable
 from sqlalchemy.orm import (
     Mapped,
     mapped_column,
@@ -11,17 +24,51 @@ from sqlalchemy.orm import (
     relationship,
 )
 
-from data import modules
+from data import config, modules, numbers
 
 
 _logger = logging.getLogger(__name__)
 
-engine = create_engine(
-    url="sqlite:///db.sqlite",
-    pool_size=20,
-    max_overflow=10,
-    pool_timeout=30,
-)
+settings = config.get_settings()
+
+
+def _create_engine() -> Engine:
+    """The engine of DATABASE_URL, the models and the queries don't depend on the database"""
+    url = make_url(settings.database_url)
+    pool_kwargs = dict(
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle,
+    )
+
+    if url.get_backend_name() == "sqlite":
+        new_engine = create_engine(url, **pool_kwargs)
+
+        @event.listens_for(new_engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, _):
+            cursor = dbapi_connection.cursor()
+            # only for a new database (before the WAL), so the space of deleted rows can be returned in steps
+            # (see data/retention.py)
+            cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            # readers don't wait for the writer, and a writer waits for another writer instead of failing
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute(f"PRAGMA busy_timeout={int(settings.db_pool_timeout * 1000)}")
+            cursor.close()
+
+        return new_engine
+
+    connect_args = {}
+    if url.get_driver_name() == "psycopg":
+        # the queries that run more than this are prepared on the server, once per connection
+        connect_args["prepare_threshold"] = settings.db_prepare_threshold
+    return create_engine(
+        url, **pool_kwargs, pool_pre_ping=True, connect_args=connect_args
+    )
+
+
+engine = _create_engine()
 
 Session = sessionmaker(bind=engine)
 
@@ -46,11 +93,12 @@ class WaUser(BaseTable):
     __tablename__ = "wa_user"
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    wa_id: Mapped[str | None] = mapped_column(String(15), unique=True, nullable=True)
+    phone_id: Mapped[str] = mapped_column(String(32))  # the business number of the conversation, see data/numbers.py
+    wa_id: Mapped[str | None] = mapped_column(String(15), nullable=True)
     bsuid: Mapped[str | None] = mapped_column(
-        String(15), unique=True, nullable=True
+        String(64), nullable=True
     )  # can be null for old users that were created before the bsuid was added, but should be unique and not null for new users
-    name: Mapped[str] = mapped_column(String(30))
+    name: Mapped[str] = mapped_column(String(128))
     username: Mapped[str | None] = mapped_column(String(32), nullable=True)
     active: Mapped[bool] = mapped_column(default=True)
     banned: Mapped[bool] = mapped_column(default=False)
@@ -59,7 +107,11 @@ class WaUser(BaseTable):
     topic: Mapped[Topic] = relationship(back_populates="user", lazy="joined")
     messages: Mapped[list[Message]] = relationship(back_populates="user")
 
-    __table_args__ = (UniqueConstraint("topic_id"),)
+    __table_args__ = (
+        UniqueConstraint("topic_id"),
+        UniqueConstraint("phone_id", "wa_id"),
+        UniqueConstraint("phone_id", "bsuid"),
+    )  # a user that writes to two numbers has a conversation with each of them
 
 
 class Topic(BaseTable):
@@ -68,12 +120,16 @@ class Topic(BaseTable):
     __tablename__ = "topic"
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    topic_id: Mapped[int] = mapped_column(unique=True)
-    name: Mapped[str] = mapped_column(String(30))
+    phone_id: Mapped[str] = mapped_column(String(32))  # the topic is in a group of the number
+    chat_id: Mapped[int] = mapped_column(BigInteger)  # the group of the topic, see data/placement.py
+    topic_id: Mapped[int]
+    name: Mapped[str] = mapped_column(String(128))
     created_at: Mapped[datetime.datetime]
     user: Mapped[WaUser] = relationship(back_populates="topic", lazy="joined")
     messages: Mapped[list[Message]] = relationship(back_populates="topic")
 
+    __table_args__ = (UniqueConstraint("chat_id", "topic_id"),)  # the ids of telegram are per group
+
 
 class Message(BaseTable):
     """Message details"""
@@ -81,7 +137,9 @@ class Message(BaseTable):
     __tablename__ = "message"
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    topic_msg_id: Mapped[int] = mapped_column(unique=True)
+    phone_id: Mapped[str] = mapped_column(String(32))
+    chat_id: Mapped[int] = mapped_column(BigInteger)  # the group of the topic
+    topic_msg_id: Mapped[int]
     wa_msg_id: Mapped[str] = mapped_column(unique=True)
     sent_from_tg: Mapped[bool]
     created_at: Mapped[datetime.datetime]
@@ -91,6 +149,29 @@ class Message(BaseTable):
     user_id: Mapped[int] = mapped_column(ForeignKey("wa_user.id"))
     user: Mapped[WaUser] = relationship(back_populates="messages", lazy="joined")
 
+    __table_args__ = (
+        UniqueConstraint("chat_id", "topic_msg_id"),
+        Index("ix_message_user_id_created_at", "user_id", "created_at"),  # the 24h window of a broadcast
+        Index("ix_message_topic_id_id", "topic_id", "id"),  # the pages of a topic (/export)
+    )
+
+
+class MessageText(BaseTable):
+    """The text of a message for /search (MESSAGE_SEARCH), in its own table so the message table stays small"""
+
+    __tablename__ = "message_text"
+
+    message_id: Mapped[int] = mapped_column(ForeignKey("message.id"), primary_key=True)
+    message: Mapped[Message] = relationship()
+    text: Mapped[str]
+
+    __table_args__ = (
+        # postgres: the full-text index, sqlite has the message_text_fts table instead (see _create_search_index)
+        Index(
+            "ix_message_text_search", text("to_tsvector('simple', text)"), postgresql_using="gin"
+        ).ddl_if(dialect="postgresql"),
+    )
+
 
 class MessageToSend(BaseTable):
     """Send message details"""
@@ -113,4 +194,155 @@ class Settings(BaseTable):
     wa_mark_as_read: Mapped[bool] = mapped_column(default=False)
 
 
-BaseTable.metadata.create_all(engine)
+class MediaCache(BaseTable):
+    """Uploaded media that can be sent again without uploading"""
+
+    __tablename__ = "media_cache"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    key_type: Mapped[modules.MediaKeyType]
+    key: Mapped[str] = mapped_column(String(64))
+    media_id: Mapped[str]
+    created_at: Mapped[datetime.datetime]
+    expires_at: Mapped[datetime.datetime | None]
+
+    __table_args__ = (UniqueConstraint("key_type", "key"),)
+
+
+class Broadcast(BaseTable):
+    """Message that is sent to all the active users, with the progress to resume after a restart"""
+
+    __tablename__ = "broadcast"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger)  # -100... doesn't fit in an integer column
+    msg_id: Mapped[int]  # the message in telegram that is broadcast, the progress is sent as a reply
+    status: Mapped[modules.BroadcastStatus]
+    text: Mapped[str | None]
+    media_type: Mapped[str | None]  # image, video, document, audio or sticker
+    media_id: Mapped[str | None]  # uploaded once to whatsapp
+    mime_type: Mapped[str | None]
+    filename: Mapped[str | None]
+    template: Mapped[str | None]  # sent to the users outside the 24h window, None to skip them
+    template_language: Mapped[str | None]
+    last_user_id: Mapped[int] = mapped_column(default=0)  # the users up to this id were sent
+    sent: Mapped[int] = mapped_column(default=0)
+    failed: Mapped[int] = mapped_column(default=0)
+    skipped: Mapped[int] = mapped_column(default=0)
+    created_at: Mapped[datetime.datetime]
+    updated_at: Mapped[datetime.datetime]
+
+
+def _get_migrated_values(existing: set[str]) -> dict[str, tuple[str, dict]]:
+    """
+    The columns that were added to the users, the topics and the messages, and their value in the rows from before
+    :param existing: the columns of the table in the database
+    :return: {column: (sql expression, parameters)}
+    """
+    chat_id = ":chat_id", {"chat_id": numbers.primary.tg_group_id}
+    if "phone_id" in existing:  # the topics of a number are in its group, from before the overflow groups
+        cases = " ".join(f"WHEN :phone_id_{i} THEN :chat_id_{i}" for i in range(len(numbers.get_all())))
+        chat_id = f"CASE phone_id {cases} ELSE :chat_id END", {
+            **chat_id[1],
+            **{f"phone_id_{i}": number.phone_id for i, number in enumerate(numbers.get_all())},
+            **{f"chat_id_{i}": number.tg_group_id for i, number in enumerate(numbers.get_all())},
+        }
+    return {
+        "phone_id": (":phone_id", {"phone_id": numbers.primary.phone_id}),
+        "chat_id": chat_id,
+    }
+
+
+def _migrate():
+    """
+    Add the new columns to a database from before them: the phone id (WA_NUMBERS, the rows belong to the primary
+    number) and the group of the topics and the messages (the overflow groups, the group of their number).
+    The unique ids become unique per number (the users) and per group (the topics and the messages)
+    """
+    inspector = inspect(engine)
+    if "wa_user" not in inspector.get_table_names():
+        return
+
+    with engine.begin() as connection:
+        for table in (WaUser.__table__, Topic.__table__, Message.__table__):
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            added = [column for column in table.columns if column.name not in existing]
+            if not added:
+                continue
+
+            _logger.info(f"Adding {', '.join(column.name for column in added)} to {table.name}")
+            values = _get_migrated_values(existing)
+            if engine.dialect.name == "sqlite":
+                # sqlite can't drop a constraint, the table is copied to a new table (https://www.sqlite.org/lang_altertable.html)
+                columns = ", ".join(column.name for column in table.columns if column.name in existing)
+                connection.exec_driver_sql(
+                    str(CreateTable(table).compile(engine)).replace(
+                        f"CREATE TABLE {table.name} (", f"CREATE TABLE {table.name}_new (", 1
+                    )
+                )
+                connection.execute(
+                    text(
+                        f"INSERT INTO {table.name}_new ({columns}, {', '.join(column.name for column in added)}) "
+                        f"SELECT {columns}, {', '.join(values[column.name][0] for column in added)} FROM {table.name}"
+                    ),
+                    {key: value for column in added for key, value in values[column.name][1].items()},
+                )
+                connection.exec_driver_sql(f"DROP TABLE {table.name}")
+                connection.exec_driver_sql(f"ALTER TABLE {table.name}_new RENAME TO {table.name}")
+                continue
+
+            for column in added:  # in the order of the model, the group of a topic is by its phone id
+                connection.exec_driver_sql(
+                    f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                )
+                connection.execute(
+                    text(f"UPDATE {table.name} SET {column.name} = {values[column.name][0]}"), values[column.name][1]
+                )
+                connection.exec_driver_sql(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} SET NOT NULL")
+            unique = [
+                list(constraint.columns.keys())
+                for constraint in table.constraints
+                if isinstance(constraint, UniqueConstraint)
+            ]
+            for constraint in inspector.get_unique_constraints(table.name):
+                if constraint["column_names"] not in unique:
+                    connection.exec_driver_sql(f'ALTER TABLE {table.name} DROP CONSTRAINT "{constraint["name"]}"')
+            existing_unique = [constraint["column_names"] for constraint in inspector.get_unique_constraints(table.name)]
+            for constraint in table.constraints:
+                if isinstance(constraint, UniqueConstraint) and list(constraint.columns.keys()) not in existing_unique:
+                    connection.execute(AddConstraint(constraint))
+
+
+def _create_search_index():
+    """
+    sqlite: the FTS5 index of message_text, without a copy of the text (external content) and kept up to date by
+    triggers, the words are matched without accents and case
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as connection:
+        connection.exec_driver_sql(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS message_text_fts USING fts5(text, content='message_text', "
+            "content_rowid='message_id', tokenize='unicode61 remove_diacritics 2')"
+        )
+        connection.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS message_text_ai AFTER INSERT ON message_text BEGIN "
+            "INSERT INTO message_text_fts(rowid, text) VALUES (new.message_id, new.text); END"
+        )
+        connection.exec_driver_sql(
+            "CREATE TRIGGER IF NOT EXISTS message_text_ad AFTER DELETE ON message_text BEGIN "
+            "INSERT INTO message_text_fts(message_text_fts, rowid, text) VALUES ('delete', old.message_id, old.text); END"
+        )
+
+
+
+def create_tables():
+    """
+    Migrate the database, create the missing tables, indexes and the search index. Called once when the bot starts
+    (see main.py), not when the module is imported: the processes of the pools and the workers import it too
+    """
+    _migrate()
+    BaseTable.metadata.create_all(engine)
+    for index in Message.__table__.indexes:  # create_all adds indexes only with new tables
+        index.create(engine, checkfirst=True)
+    _create_search_index()
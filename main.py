@@ -1,84 +1,286 @@
+from __future__ import annotations
+
 import asyncio
+import datetime
+import hmac
 import logging
+import os
+import sys
+import tempfile
+import typing
+
+_logger = logging.getLogger(__name__)
 
-import httpx
-import uvicorn
-from fastapi import FastAPI
-from pyrogram import __version__ as tg_version, raw, Client
-from pywa_async import __version__ as wa_version, WhatsApp
+# the processes of the pools import this file as __mp_main__ (see data/pool.py): they get only the definitions,
+# without the bot modules (the database, the redis subscriber) and the logging
+if __name__ != "__mp_main__":
+    import httpx
+    import uvicorn
+    from fastapi import APIRouter, Depends, FastAPI, Header, HTTPException
+    from fastapi.responses import PlainTextResponse
+    from pyrogram import __version__ as tg_version, raw, Client, handlers
+    from pywa_async import __version__ as wa_version, WhatsApp
 
-from data import config, clients
-from wa import wa_bot as wa_bot_handlers_module
-from tg import handlers as tg_handlers
+    from data import config, clients, metrics, profiler, watchdog, memory, recorder, sharding, numbers, retention, tracing
+    from db import tables
+    from wa import wa_bot as wa_bot_handlers_module
+    from tg import handlers as tg_handlers, broadcast
 
+    settings = config.get_settings()
 
-# log config
-config.setup_logging()
-_logger = logging.getLogger(__name__)
+    worker_index = os.environ.get(sharding.WORKER_ENV)  # set in the worker processes, see data/sharding.py
 
-settings = config.get_settings()
+    # log config
+    config.setup_logging(
+        use_queue=settings.log_queue,
+        queue_size=settings.log_queue_size,
+        file_level=settings.log_file_level,
+        filename="log.log" if worker_index is None else f"log.worker{worker_index}.log",
+    )
+
+    logging.info(
+        f"The bot is up and running on Pyrogram v{tg_version} (Layer {raw.all.layer}), PyWa v{wa_version}"
+    )
 
 
-logging.info(
-    f"The bot is up and running on Pyrogram v{tg_version} (Layer {raw.all.layer}), PyWa v{wa_version}"
-)
+async def get_metrics() -> PlainTextResponse:
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def check_admin_token(authorization: typing.Annotated[str | None, Header()] = None):
+    # compared as bytes, compare_digest raises on a non-ascii str
+    if not hmac.compare_digest((authorization or "").encode(), f"Bearer {settings.admin_token}".encode()):
+        raise HTTPException(status_code=401)
+
+
+async def get_profile(seconds: float = 30) -> PlainTextResponse:
+    try:
+        report = await profiler.profile(
+            seconds=seconds, slow_callback_ms=settings.profile_slow_callback_ms
+        )
+    except profiler.ProfilerBusy:
+        raise HTTPException(status_code=409, detail="The profiler is already running")
+    return PlainTextResponse(report)
+
+
+async def get_blocks() -> PlainTextResponse:
+    return PlainTextResponse(
+        "\n".join(
+            f"{datetime.datetime.fromtimestamp(block['at'])}: blocked for over {block['seconds']:.2f}s\n{block['stack']}"
+            for block in watchdog.get_last_blocks()
+        )
+    )
+
 
 async def start_telegram_bot(bot: Client):
     for tg_handler in tg_handlers.HANDLERS:
         bot.add_handler(tg_handler)
-
+    add_recorder_handlers(bot)
     await bot.start()
 
-async def main():
 
-    clients.tg_bot = Client(
-        name="whtsgram_bot",
+def add_recorder_handlers(bot: Client):
+    if settings.record_traffic_file:
+        # the group runs before the bot handlers
+        bot.add_handler(handlers.MessageHandler(recorder.record_tg_message), group=-1)
+        bot.add_handler(handlers.MessageReactionUpdatedHandler(recorder.record_tg_reaction), group=-1)
+
+
+def create_app() -> FastAPI:
+    """Create the web server of the whatsapp webhook, with the metrics and the debug endpoints"""
+    app = FastAPI()
+
+    if settings.metrics:
+        app.add_api_route(
+            "/metrics", get_metrics, methods=["GET"], response_class=PlainTextResponse
+        )
+
+    if settings.admin_token:
+        debug_router = APIRouter(prefix="/debug", dependencies=[Depends(check_admin_token)])
+        debug_router.add_api_route(
+            "/profile", get_profile, methods=["GET"], response_class=PlainTextResponse
+        )
+        debug_router.add_api_route(
+            "/blocks", get_blocks, methods=["GET"], response_class=PlainTextResponse
+        )
+        app.include_router(debug_router)
+
+    if settings.record_traffic_file:
+        app.add_middleware(recorder.WebhookRecorder, path=settings.wa_webhook_endpoint)
+
+    return app
+
+
+def create_wa_bots(
+    app: FastAPI | None, transport: httpx.AsyncBaseTransport | None = None
+) -> dict[str, WhatsApp]:
+    """
+    Create the whatsapp clients of the numbers (see data/numbers.py), every number with its own connection pool
+    (or all with the transport). The client of the primary number registers the webhook on the app (None in the
+    workers, the router gets it) and handles the updates of all the numbers.
+    """
+    wa_bots = {}
+    for number in numbers.get_all():
+        session = create_http_session(
+            numbers.RateLimitedTransport(transport or numbers.create_transport(), number)
+        )
+        if number is not numbers.primary:
+            wa_bots[number.phone_id] = WhatsApp(phone_id=number.phone_id, token=number.token, session=session)
+            continue
+        wa_bots[number.phone_id] = WhatsApp(
+            phone_id=number.phone_id,
+            token=number.token,
+            server=app,
+            verify_token=settings.wa_verify_token,
+            # callback_url=settings.wa_callback_url,
+            webhook_endpoint=settings.wa_webhook_endpoint,
+            app_id=settings.wa_app_id,
+            app_secret=settings.wa_app_secret,
+            webhook_challenge_delay=10,
+            session=session,
+            filter_updates=len(numbers.get_all()) == 1,  # with WA_NUMBERS it gets the updates of all the numbers
+            handlers_modules=[wa_bot_handlers_module],
+        )
+    return wa_bots
+
+
+def create_tg_bot(name: str, **kwargs) -> Client:
+    bot = Client(
+        name=name,
         api_id=settings.tg_api_id,
         api_hash=settings.tg_api_hash,
         bot_token=settings.tg_bot_token,
+        max_concurrent_transmissions=settings.tg_max_concurrent_transmissions,
+        **kwargs,
     )
+    if settings.metrics:
+        metrics.instrument_tg_client(bot)
+    return bot
+
+
+def create_http_session(transport: httpx.AsyncBaseTransport | None = None) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=httpx.Timeout(timeout=settings.httpx_timeout),
+        event_hooks=metrics.wa_event_hooks if settings.metrics else None,
+    )
+
+
+def start_monitoring():
+    if settings.loop_watchdog:
+        watchdog.start(threshold_ms=settings.loop_block_threshold_ms)
+    if settings.memory_snapshot_interval:
+        memory.start_snapshots(
+            interval_minutes=settings.memory_snapshot_interval,
+            directory=settings.memory_snapshot_dir,
+        )
 
-    # whatsapp
-    app = FastAPI()
 
-    httpx_session = httpx.AsyncClient(timeout=httpx.Timeout(timeout=settings.httpx_timeout))
-    clients.wa_bot = WhatsApp(
-        phone_id=settings.wa_phone_id,
-        token=settings.wa_token,
-        server=app,
-        verify_token=settings.wa_verify_token,
-        # callback_url=settings.wa_callback_url,
-        webhook_endpoint=settings.wa_webhook_endpoint,
-        app_id=settings.wa_app_id,
-        app_secret=settings.wa_app_secret,
-        webhook_challenge_delay=10,
-        session=httpx_session,
-        handlers_modules=[wa_bot_handlers_module],
+def create_server(app: FastAPI, port: int) -> uvicorn.Server:
+    return uvicorn.Server(
+        uvicorn.Config(
+            app=app,
+            port=port,
+            host="0.0.0.0",
+            access_log=False,
+            log_level=False,
+            log_config=None,
+        )
     )
 
 
+async def main():
+    tables.create_tables()
+    clients.tg_bot = create_tg_bot(name="whtsgram_bot")
+
+    # whatsapp
+    app = create_app()
+    clients.wa_bots = create_wa_bots(app=app)
+    clients.wa_bot = clients.wa_bots[numbers.primary.phone_id]
+
+    start_monitoring()
     await start_telegram_bot(clients.tg_bot)
+    broadcast.resume()
+    retention.start()
 
-    uvicorn_config = uvicorn.Config(
-        app=app,
-        port=settings.port,
-        host="0.0.0.0",
-        access_log=False,
-        log_level=False,
-        log_config=None,
+    server = create_server(app, settings.port)
+    try:
+        await server.serve()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        await recorder.flush()
+        await tracing.close()
+        await clients.tg_bot.stop()
+
+
+async def run_router():
+    """Receive the updates and forward them to the worker processes, see data/sharding.py"""
+    tables.create_tables()
+    router = sharding.Router(
+        workers=settings.workers,
+        command=[sys.executable, os.path.abspath(__file__)],
+        path=os.path.join(tempfile.mkdtemp(prefix="whatsgram-"), "router.sock"),
     )
-    server = uvicorn.Server(uvicorn_config)
+    await router.start()
+
+    # one handler task, so the updates are forwarded in the order they arrived
+    tg_bot = create_tg_bot(name="whtsgram_bot", workers=1)
+    if not settings.record_traffic_file:  # the workers parse the updates, the router parses only to record them
+        tg_bot.dispatcher.update_parsers.clear()
+    add_recorder_handlers(tg_bot)
+    tg_bot.add_handler(handlers.RawUpdateHandler(router.on_tg_update))
+
+    app = create_app()
+    router.add_webhook_routes(app)
 
+    start_monitoring()
+    await tg_bot.start()
+
+    server = create_server(app, settings.port)
     try:
         await server.serve()
     except asyncio.CancelledError:
         pass
     finally:
+        await tg_bot.stop()
+        await recorder.flush()
+        await router.stop()
+
+
+async def run_worker(index: int):
+    """Handle the updates of the conversations of this worker, the metrics and the debug endpoints are on PORT + 1 + index"""
+    # the router receives the updates, the worker client only sends
+    clients.tg_bot = create_tg_bot(name=f"whtsgram_bot_worker{index}", no_updates=True)
+    clients.wa_bots = create_wa_bots(app=None)
+    clients.wa_bot = clients.wa_bots[numbers.primary.phone_id]
+
+    start_monitoring()
+    await clients.tg_bot.start()
+    if index == 0:
+        broadcast.resume()
+        retention.start()
+
+    server = create_server(create_app(), settings.port + 1 + index)
+    server_task = asyncio.create_task(server.serve())
+    try:
+        await sharding.serve(index=index, path=os.environ[sharding.ROUTER_ENV])
+    finally:
+        server.should_exit = True
+        await server_task
+        await tracing.close()
         await clients.tg_bot.stop()
 
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if worker_index is not None:
+            asyncio.run(run_worker(int(worker_index)))
+        elif settings.workers:
+            asyncio.run(run_router())
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         pass
@@ -0,0 +1,139 @@
+import asyncio
+import dataclasses
+import logging
+import time
+import typing
+
+from pyrogram import types as tg_types
+
+from data import config
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+Handler = typing.Callable[[tg_types.Message, asyncio.Task | None], typing.Awaitable[None]]
+
+
+@dataclasses.dataclass
+class _Album:
+    """Messages of one telegram album that wait to be sent to whatsapp"""
+
+    handler: Handler
+    started_at: float
+    topic: tuple[int, int]  # (chat_id, topic_id)
+    messages: list[tuple[tg_types.Message, bool]] = dataclasses.field(default_factory=list)
+    task: asyncio.Task | None = None
+
+
+_albums: dict[str, _Album] = {}
+"""example: {media_group_id: _Album}"""
+
+_last: dict[tuple[int, int], asyncio.Future] = {}
+"""example: {(chat_id, topic_id): future} - the last album of the topic that is handled, done when it was sent"""
+
+_stats = {"albums": 0, "items": 0, "latency_total": 0.0, "latency_max": 0.0}
+
+
+def add(*, msg: tg_types.Message, handler: Handler, prefetch: bool):
+    """
+    Add a message of an album, the album is handled when no more messages arrive in the album window.
+    The media of all the album is downloaded concurrently, and the handler is called for every message by order,
+    so the upload of a message overlaps the download of the next ones.
+    :param msg: the message from the topic, must have media_group_id
+    :param handler: called with the message and the download task (or None if prefetch is False)
+    :param prefetch: true if the media of the message should be downloaded ahead
+    """
+    album = _albums.get(msg.media_group_id)
+    if album is None:
+        album = _albums[msg.media_group_id] = _Album(
+            handler=handler, started_at=time.perf_counter(), topic=_get_topic(msg)
+        )
+
+    album.messages.append((msg, prefetch))
+    if album.task is not None:
+        album.task.cancel()
+    album.task = asyncio.create_task(_handle_later(msg.media_group_id))
+
+
+def _get_topic(msg: tg_types.Message) -> tuple[int, int]:
+    return msg.chat.id, msg.message_thread_id or msg.reply_to_message_id
+
+
+async def _handle_later(media_group_id: str):
+    await asyncio.sleep(settings.tg_album_window)
+    await _handle(media_group_id)
+
+
+async def flush(*, msg: tg_types.Message):
+    """
+    Handle the albums of the topic of the message that wait, should be called before handling other message of the
+    topic. The albums of the topic that are being handled are waited for too, so the messages stay in order.
+    :param msg: the message from the topic
+    """
+    topic = _get_topic(msg)
+    for media_group_id in [media_group_id for media_group_id, album in _albums.items() if album.topic == topic]:
+        await _handle(media_group_id)
+    if (last := _last.get(topic)) is not None:
+        await asyncio.shield(last)
+
+
+async def _handle(media_group_id: str):
+    # from here the album is no longer cancelable by a new message
+    album = _albums.pop(media_group_id, None)
+    if album is None:
+        return
+    if album.task is not None and album.task is not asyncio.current_task():
+        album.task.cancel()
+
+    # after the previous album of the topic
+    previous = _last.get(album.topic)
+    done = _last[album.topic] = asyncio.get_running_loop().create_future()
+    try:
+        if previous is not None:
+            await asyncio.shield(previous)
+        await _send(media_group_id, album)
+    finally:
+        done.set_result(None)
+        if _last.get(album.topic) is done:
+            del _last[album.topic]
+
+
+async def _send(media_group_id: str, album: _Album):
+    messages = sorted(album.messages, key=lambda item: item[0].id)
+
+    downloads = [
+        asyncio.create_task(msg.download(in_memory=True)) if prefetch else None
+        for msg, prefetch in messages
+    ]
+    for (msg, _), download in zip(messages, downloads):
+        try:
+            await album.handler(msg, download)
+        except Exception:  # noqa
+            _logger.exception(
+                "Error handling album message: ",
+            )
+        finally:
+            if download is not None:
+                if not download.done():  # the handler didn't use it
+                    download.cancel()
+                elif not download.cancelled():
+                    download.exception()  # mark the error as retrieved, the handler already handled it
+
+    latency = time.perf_counter() - album.started_at
+    _stats["albums"] += 1
+    _stats["items"] += len(messages)
+    _stats["latency_total"] += latency
+    _stats["latency_max"] = max(_stats["latency_max"], latency)
+    _logger.debug(f"album {media_group_id} with {len(messages)} items handled in {latency:.2f}s")
+
+
+def get_stats() -> dict[str, int | float]:
+    """Return albums stats, the latency is from the first message of the album until the last one was sent"""
+    return {
+        "albums": _stats["albums"],
+        "items": _stats["items"],
+        "latency_avg": _stats["latency_total"] / _stats["albums"] if _stats["albums"] else 0.0,
+        "latency_max": _stats["latency_max"],
+        "pending": len(_albums),
+    }
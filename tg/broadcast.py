@@ -0,0 +1,379 @@
+import asyncio
+import collections
+import datetime
+import logging
+import time
+
+from pyrogram import types as tg_types, enums, errors as tg_errors
+from pywa_async import WhatsApp, errors as wa_errors
+from pywa_async.types.templates import TemplateLanguage
+
+from data import clients, config, media_reuse, memory, modules, numbers, utils
+from db import repositoy
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+"""
+Send a message from the group to all the active users in whatsapp.
+
+A broadcast from the group of a number (see data/numbers.py) is sent from that number to its users.
+
+The media is uploaded to whatsapp once and every user gets the same media id. The users are read from the
+database in pages by id, and the last id of every page that was sent is saved, so a broadcast that was
+running when the bot stopped is resumed from that page when the bot starts (the users of an unfinished
+page can get the message twice).
+
+WhatsApp allows free messages only to users that sent a message in the last 24 hours, the other users
+get BROADCAST_TEMPLATE, or are skipped if there is no template.
+"""
+
+WINDOW = datetime.timedelta(hours=24)
+PROGRESS_INTERVAL = 30  # seconds between updates of the progress message
+THROTTLING_RETRIES = 3
+THROTTLING_BACKOFF = 2  # seconds, doubled on every retry
+
+MEDIA_TYPES = {
+    enums.MessageMediaType.PHOTO: ("image", "image/jpeg"),
+    enums.MessageMediaType.VIDEO: ("video", "video/mp4"),
+    enums.MessageMediaType.ANIMATION: ("video", "video/mp4"),
+    enums.MessageMediaType.VIDEO_NOTE: ("video", "video/mp4"),
+    enums.MessageMediaType.DOCUMENT: ("document", "application/octet-stream"),
+    enums.MessageMediaType.AUDIO: ("audio", "audio/mpeg"),
+    enums.MessageMediaType.VOICE: ("audio", "audio/ogg"),
+    enums.MessageMediaType.STICKER: ("sticker", "image/webp"),
+}
+"""example: {telegram media type: (whatsapp media type, default mime type)}"""
+NO_CAPTION_TYPES = ("audio", "sticker")  # whatsapp media types that are sent without the caption
+
+_tasks: dict[int, asyncio.Task] = {}
+"""example: {broadcast_id: task}"""
+
+_stopped: set[int] = set()
+"""the broadcasts that an admin stopped, the others are cancelled only when the bot stops"""
+
+_stats = {"broadcasts": 0, "sent": 0, "failed": 0, "skipped": 0}
+
+
+class BroadcastBusy(Exception):
+    """Only one broadcast runs at a time"""
+
+
+def get_window_start() -> datetime.datetime:
+    return datetime.datetime.now() - WINDOW
+
+
+def is_running() -> bool:
+    return bool(_tasks)
+
+
+async def create(msg: tg_types.Message) -> int:
+    """
+    Upload the media of the message to whatsapp, save the broadcast and start it
+    :param msg: the message to broadcast, text or media of MEDIA_TYPES
+    :return: the id of the broadcast
+    """
+    if _tasks:
+        raise BroadcastBusy
+
+    phone_id = numbers.get_by_group(msg.chat.id).phone_id
+    text = (
+        utils.get_tg_text_to_wa((msg.text or msg.caption).markdown)
+        if msg.text or msg.caption
+        else None
+    )
+    media_type = media_id = mime_type = filename = None
+    if msg.media:
+        media = getattr(msg, msg.media.name.lower())
+        media_type, mime_type = MEDIA_TYPES[msg.media]
+        mime_type = getattr(media, "mime_type", None) or mime_type
+        filename = getattr(media, "file_name", None)
+        file_unique_id = getattr(utils.get_media_file(media), "file_unique_id", None)
+        media_id = media_reuse.get_media_id(
+            key_type=modules.MediaKeyType.TG_FILE_UNIQUE_ID, key=file_unique_id, phone_id=phone_id
+        )
+        if media_id is None:
+            download = memory.track(await msg.download(in_memory=True), "broadcast")
+            media_id = (
+                await clients.get_wa_bot(phone_id).upload_media(
+                    media=download.getvalue(), mime_type=mime_type, filename=filename
+                )
+            ).id
+            media_reuse.save_media_id(
+                key_type=modules.MediaKeyType.TG_FILE_UNIQUE_ID,
+                key=file_unique_id,
+                media_id=media_id,
+                phone_id=phone_id,
+            )
+
+    if _tasks:  # started while uploading
+        raise BroadcastBusy
+    broadcast_id = repositoy.create_broadcast(
+        chat_id=msg.chat.id,
+        msg_id=msg.id,
+        text=text,
+        media_type=media_type,
+        media_id=media_id,
+        mime_type=mime_type,
+        filename=filename,
+        template=settings.broadcast_template,
+        template_language=settings.broadcast_template_language,
+    )
+    _stats["broadcasts"] += 1
+    _start(broadcast_id)
+    return broadcast_id
+
+
+def resume():
+    """Start the broadcasts that were running when the bot stopped"""
+    for broadcast in repositoy.get_broadcasts(status=modules.BroadcastStatus.RUNNING):
+        if numbers.get_by_group(broadcast.chat_id) is None:  # the number was removed from WA_NUMBERS
+            _logger.warning(f"Stopping broadcast {broadcast.id}, {broadcast.chat_id} is not the group of a number")
+            repositoy.update_broadcast(broadcast_id=broadcast.id, status=modules.BroadcastStatus.STOPPED)
+            continue
+        _logger.info(f"Resuming broadcast {broadcast.id} after user {broadcast.last_user_id}")
+        _start(broadcast.id)
+
+
+async def stop() -> bool:
+    """
+    Stop the running broadcast, the summary is sent to the group
+    :return: False if no broadcast is running
+    """
+    if not _tasks:
+        return False
+    for broadcast_id, task in list(_tasks.items()):
+        _stopped.add(broadcast_id)
+        repositoy.update_broadcast(
+            broadcast_id=broadcast_id, status=modules.BroadcastStatus.STOPPED
+        )
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    return True
+
+
+def _start(broadcast_id: int):
+    task = asyncio.create_task(_run(broadcast_id))
+    _tasks[broadcast_id] = task
+    task.add_done_callback(lambda _: _tasks.pop(broadcast_id, None))
+
+
+async def _run(broadcast_id: int):
+    broadcast = repositoy.get_broadcast(broadcast_id=broadcast_id)
+    phone_id = numbers.get_by_group(broadcast.chat_id).phone_id
+    total, in_window = repositoy.count_broadcast_users(
+        window_start=get_window_start(), phone_id=phone_id
+    )
+    progress = {
+        "sent": broadcast.sent,
+        "failed": broadcast.failed,
+        "skipped": broadcast.skipped,
+        "total": total,
+        "in_window": in_window,
+        "errors": collections.Counter(),
+        "started_at": time.monotonic(),
+        "resumed": broadcast.sent + broadcast.failed + broadcast.skipped,
+    }
+    status_msg = await _send_progress(broadcast, progress, status_msg=None)
+
+    limiter = utils.RateLimiter(settings.broadcast_rate) if settings.broadcast_rate > 0 else None
+    semaphore = asyncio.Semaphore(settings.broadcast_concurrency)
+    last_user_id = broadcast.last_user_id
+    last_update = time.monotonic()
+    users, done = [], set()
+    try:
+        while True:
+            users = repositoy.get_broadcast_users(
+                after_id=last_user_id,
+                limit=settings.broadcast_page_size,
+                window_start=get_window_start(),
+                phone_id=phone_id,
+            )
+            if not users:
+                break
+            done = set()
+            await asyncio.gather(
+                *(
+                    _send(broadcast, user, in_window, progress, semaphore, limiter, done)
+                    for user, in_window in users
+                )
+            )
+            last_user_id = users[-1][0].id
+            repositoy.update_broadcast(
+                broadcast_id=broadcast_id,
+                last_user_id=last_user_id,
+                sent=progress["sent"],
+                failed=progress["failed"],
+                skipped=progress["skipped"],
+            )
+            if time.monotonic() - last_update > PROGRESS_INTERVAL:
+                last_update = time.monotonic()
+                await _send_progress(broadcast, progress, status_msg=status_msg)
+
+    except asyncio.CancelledError:
+        if broadcast_id in _stopped:  # else the bot stops, and the broadcast is resumed when it starts
+            _stopped.discard(broadcast_id)
+            for user, _ in users:  # the users of the page up to the first that was not sent yet
+                if user.id not in done:
+                    break
+                last_user_id = user.id
+            repositoy.update_broadcast(
+                broadcast_id=broadcast_id,
+                last_user_id=last_user_id,
+                sent=progress["sent"],
+                failed=progress["failed"],
+                skipped=progress["skipped"],
+            )
+            await _send_summary(broadcast, progress, stopped=True)
+        raise
+
+    except Exception as e:  # noqa
+        _logger.exception(f"Broadcast {broadcast_id} failed: {e}")
+        repositoy.update_broadcast(
+            broadcast_id=broadcast_id, status=modules.BroadcastStatus.STOPPED
+        )
+        await _send_summary(broadcast, progress, stopped=True)
+        return
+
+    repositoy.update_broadcast(broadcast_id=broadcast_id, status=modules.BroadcastStatus.DONE)
+    await _send_summary(broadcast, progress, stopped=False)
+
+
+async def _send(
+    broadcast: repositoy.Broadcast,
+    user: repositoy.WaUser,
+    in_window: bool,
+    progress: dict,
+    semaphore: asyncio.Semaphore,
+    limiter: utils.RateLimiter | None,
+    done: set[int],
+):
+    await _send_or_skip(broadcast, user, in_window, progress, semaphore, limiter)
+    done.add(user.id)
+
+
+async def _send_or_skip(
+    broadcast: repositoy.Broadcast,
+    user: repositoy.WaUser,
+    in_window: bool,
+    progress: dict,
+    semaphore: asyncio.Semaphore,
+    limiter: utils.RateLimiter | None,
+):
+    if not in_window and not broadcast.template:
+        progress["skipped"] += 1
+        _stats["skipped"] += 1
+        return
+
+    to = user.wa_id or user.bsuid
+    wa = clients.get_wa_bot(user.phone_id)
+    async with semaphore:
+        for attempt in range(THROTTLING_RETRIES + 1):
+            if limiter is not None:
+                await limiter.wait()
+            try:
+                if in_window:
+                    await _send_message(wa, broadcast, to)
+                else:
+                    await wa.send_template(
+                        to=to,
+                        name=broadcast.template,
+                        language=TemplateLanguage(broadcast.template_language),
+                    )
+            except wa_errors.ThrottlingError as e:
+                if attempt < THROTTLING_RETRIES:
+                    await asyncio.sleep(THROTTLING_BACKOFF * 2**attempt)
+                    continue
+                error = e
+            except wa_errors.WhatsAppError as e:
+                error = e
+            else:
+                progress["sent"] += 1
+                _stats["sent"] += 1
+                return
+            break
+
+    _logger.debug(f"Error broadcasting to {to}: {error.message}")
+    progress["failed"] += 1
+    progress["errors"][type(error).__name__] += 1
+    _stats["failed"] += 1
+
+
+async def _send_message(wa: WhatsApp, broadcast: repositoy.Broadcast, to: str):
+    media_kwargs = dict(to=to, mime_type=broadcast.mime_type)
+    match broadcast.media_type:
+        case None:
+            await wa.send_message(to=to, text=broadcast.text)
+        case "image":
+            await wa.send_image(
+                **media_kwargs, image=broadcast.media_id, caption=broadcast.text
+            )
+        case "video":
+            await wa.send_video(
+                **media_kwargs, video=broadcast.media_id, caption=broadcast.text
+            )
+        case "document":
+            await wa.send_document(
+                **media_kwargs,
+                document=broadcast.media_id,
+                filename=broadcast.filename,
+                caption=broadcast.text,
+            )
+        # with no caption
+        case "audio":
+            await wa.send_audio(**media_kwargs, audio=broadcast.media_id)
+        case "sticker":
+            await wa.send_sticker(**media_kwargs, sticker=broadcast.media_id)
+
+
+def _format_progress(progress: dict) -> str:
+    done = progress["sent"] + progress["failed"] + progress["skipped"]
+    elapsed = time.monotonic() - progress["started_at"]
+    rate = (done - progress["resumed"]) / elapsed if elapsed else 0.0
+    return (
+        f"> users: __{done}/{progress['total']}__ "
+        f"({progress['in_window']} in the 24h window)\n"
+        f"> sent: __{progress['sent']}__\n"
+        f"> failed: __{progress['failed']}__\n"
+        f"> skipped: __{progress['skipped']}__ (outside the window, no template)\n"
+        f"> rate: __{rate:.1f} msg/s__\n"
+    )
+
+
+async def _send_progress(
+    broadcast: repositoy.Broadcast, progress: dict, status_msg: tg_types.Message | None
+) -> tg_types.Message | None:
+    text = f"**Broadcast {'resumed' if progress['resumed'] else 'started'}**\n" + _format_progress(progress)
+    try:
+        if status_msg is None:
+            return await clients.tg_bot.send_message(
+                chat_id=broadcast.chat_id,
+                text=text,
+                reply_parameters=tg_types.ReplyParameters(message_id=broadcast.msg_id),
+            )
+        return await status_msg.edit_text(text)
+    except tg_errors.RPCError as e:
+        _logger.debug(f"Error sending the progress of broadcast {broadcast.id}: {e}")
+        return status_msg
+
+
+async def _send_summary(broadcast: repositoy.Broadcast, progress: dict, stopped: bool):
+    elapsed = time.monotonic() - progress["started_at"]
+    try:
+        await clients.tg_bot.send_message(
+            chat_id=broadcast.chat_id,
+            text=f"**Broadcast {'stopped' if stopped else 'done'}** in __{datetime.timedelta(seconds=int(elapsed))}__\n"
+            + _format_progress(progress)
+            + "".join(
+                f"> {error}: __{count}__\n" for error, count in progress["errors"].most_common(5)
+            ),
+            reply_parameters=tg_types.ReplyParameters(message_id=broadcast.msg_id),
+        )
+    except tg_errors.RPCError as e:
+        _logger.error(f"Error sending the summary of broadcast {broadcast.id}: {e}")
+
+
+def get_stats() -> dict[str, int]:
+    """Return broadcast stats, the messages of all the broadcasts since the bot started"""
+    return {**_stats, "running": len(_tasks)}
@@ -0,0 +1,214 @@
+import asyncio
+import datetime
+import html
+import json
+import logging
+import tempfile
+import time
+
+from pyrogram import types as tg_types, errors as tg_errors
+
+from data import clients, config, utils
+from db import repositoy
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+"""
+Export the conversation of a topic (/export), as a document that is sent to the topic.
+
+The messages are read from the database in pages of EXPORT_PAGE_SIZE by id, and the text and the media of the
+messages of a page are read from the topic in one request (get_messages). Every page is written to a spooled file,
+in memory up to EXPORT_SPOOL_MB and in a temporary file above it, so the memory of an export doesn't grow with
+the conversation. The export runs in the background, its queries and its writes run in threads, so the bridge
+keeps working.
+
+A message that was deleted from the topic is exported with its text from the database (MESSAGE_SEARCH), or
+without text.
+"""
+
+FORMATS = ("html", "jsonl")
+MAX_PAGE_SIZE = 200  # get_messages
+
+_HTML_HEAD = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>{title}</title>
+<style>
+body {{ font-family: sans-serif; max-width: 800px; margin: auto; background: #f4f4f5; }}
+.msg {{ margin: 8px 0; padding: 8px 12px; border-radius: 8px; background: #fff; white-space: pre-wrap; }}
+.out {{ margin-left: 15%; background: #e1f5d5; }}
+.meta {{ font-size: 12px; color: #777; }}
+.media {{ font-style: italic; color: #555; }}
+</style></head><body>
+<h2>{title}</h2>
+"""
+_HTML_TAIL = "</body></html>\n"
+
+_tasks: dict[int, asyncio.Task] = {}
+"""example: {topic_id: task} - one export of a topic at a time"""
+
+_stats = {"exports": 0, "messages": 0, "bytes": 0, "errors": 0}
+
+
+class ExportBusy(Exception):
+    """An export of the topic is already running"""
+
+
+class _ExportFile(tempfile.SpooledTemporaryFile):
+    """A spooled file with the name of the document, pyrogram sends a file object with its name"""
+
+    def __init__(self, name: str):
+        super().__init__(max_size=int(settings.export_spool_mb * 1024 * 1024))
+        self._name = name
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+
+def start(*, topic: repositoy.Topic, msg_id: int, fmt: str):
+    """
+    Start the export of a topic in the background, the document is sent as a reply
+    :param topic: the topic to export
+    :param msg_id: the /export message
+    :param fmt: one of FORMATS
+    """
+    if topic.id in _tasks:
+        raise ExportBusy
+    task = asyncio.create_task(_run(topic, msg_id, fmt))
+    _tasks[topic.id] = task
+    task.add_done_callback(lambda _: _tasks.pop(topic.id, None))
+
+
+async def _get_tg_messages(chat_id: int, msg_ids: list[int]) -> dict[int, tg_types.Message]:
+    """The messages of the topic that were not deleted, example: {msg_id: message}"""
+    while True:
+        try:
+            messages = await clients.tg_bot.get_messages(chat_id=chat_id, message_ids=msg_ids, replies=0)
+        except tg_errors.FloodWait as e:
+            await asyncio.sleep(e.value)
+            continue
+        return {message.id: message for message in messages if not message.empty}
+
+
+def _get_media(tg_msg: tg_types.Message | None) -> dict | None:
+    if tg_msg is None or not tg_msg.media:
+        return None
+    media = getattr(tg_msg, tg_msg.media.name.lower(), None)
+    return {
+        "type": tg_msg.media.name.lower(),
+        "file_name": getattr(media, "file_name", None),
+        "mime_type": getattr(media, "mime_type", None),
+        "file_size": getattr(utils.get_media_file(media), "file_size", None),
+    }
+
+
+def _get_record(row: dict, tg_msg: tg_types.Message | None, topic: repositoy.Topic) -> dict:
+    """The exported message, from the database and from its message in the topic"""
+    text = row["text"]
+    sender = topic.user.name
+    reply_to = None
+    if tg_msg is not None:
+        text = str(tg_msg.text or tg_msg.caption or "") or text
+        if row["sent_from_tg"] and tg_msg.from_user:
+            sender = tg_msg.from_user.full_name
+        if tg_msg.reply_to_message_id not in (None, topic.topic_id):  # a message in a topic replies to the topic
+            reply_to = tg_msg.reply_to_message_id
+    return {
+        "id": row["topic_msg_id"],
+        "date": row["created_at"].isoformat(timespec="seconds"),
+        "from": "telegram" if row["sent_from_tg"] else "whatsapp",
+        "sender": sender,
+        "text": text,
+        "media": _get_media(tg_msg),
+        "reply_to": reply_to,
+        "deleted": tg_msg is None,
+        "wa_msg_id": row["wa_msg_id"],
+        "link": f"https://t.me/c/{str(row['chat_id']).replace('-100', '')}/{topic.topic_id}/{row['topic_msg_id']}",
+    }
+
+
+def _to_html(record: dict) -> str:
+    meta = f'<a href="{record["link"]}">{record["date"]}</a> {html.escape(record["sender"])}'
+    if record["reply_to"]:
+        meta += f' · <a href="#m{record["reply_to"]}">reply</a>'
+    if record["deleted"]:
+        meta += " · deleted"
+    body = ""
+    if media := record["media"]:
+        body += f'<div class="media">[{media["type"]}'
+        if media["file_name"]:
+            body += f" {html.escape(media['file_name'])}"
+        if media["file_size"]:
+            body += f" {media['file_size'] / 1024:.0f}KB"
+        body += "]</div>"
+    if record["text"]:
+        body += f"<div>{html.escape(record['text'])}</div>"
+    css_class = "out" if record["from"] == "telegram" else "in"
+    return f'<div class="msg {css_class}" id="m{record["id"]}"><div class="meta">{meta}</div>{body}</div>\n'
+
+
+def _write(file: _ExportFile, records: list[dict], fmt: str):
+    """Write a page to the file, in a thread (the formatting of a page and a write to the disk)"""
+    if fmt == "jsonl":
+        file.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode())
+    else:
+        file.write("".join(_to_html(record) for record in records).encode())
+
+
+async def _run(topic: repositoy.Topic, msg_id: int, fmt: str):
+    start_time = time.monotonic()
+    name = f"{topic.user.wa_id or topic.user.bsuid}_{datetime.datetime.now():%Y%m%d_%H%M%S}.{fmt}"
+    page_size = min(settings.export_page_size, MAX_PAGE_SIZE)
+    exported = 0
+    with _ExportFile(name) as file:
+        try:
+            if fmt == "html":
+                user_id = topic.user.wa_id or topic.user.username or topic.user.bsuid
+                title = html.escape(f"{topic.user.name} ({user_id})")
+                await asyncio.to_thread(file.write, _HTML_HEAD.format(title=title).encode())
+            after_id = 0
+            while True:
+                rows = await asyncio.to_thread(
+                    repositoy.get_topic_messages, topic_id=topic.id, after_id=after_id, limit=page_size
+                )
+                if not rows:
+                    break
+                tg_messages = await _get_tg_messages(topic.chat_id, [row["topic_msg_id"] for row in rows])
+                records = [_get_record(row, tg_messages.get(row["topic_msg_id"]), topic) for row in rows]
+                await asyncio.to_thread(_write, file, records, fmt)
+                exported += len(rows)
+                after_id = rows[-1]["id"]
+            if fmt == "html":
+                await asyncio.to_thread(file.write, _HTML_TAIL.encode())
+
+            size = file.tell()
+            file.seek(0)
+            await clients.tg_bot.send_document(
+                chat_id=topic.chat_id,
+                document=file,
+                file_name=name,
+                caption=f"__{exported} messages, exported in {time.monotonic() - start_time:.1f}s__",
+                reply_parameters=tg_types.ReplyParameters(message_id=msg_id),
+            )
+        except Exception as e:  # noqa
+            _stats["errors"] += 1
+            _logger.exception(f"Error exporting topic {topic.topic_id}: ")
+            try:
+                await clients.tg_bot.send_message(
+                    chat_id=topic.chat_id,
+                    text=f"__The export failed after {exported} messages: {e}__",
+                    reply_parameters=tg_types.ReplyParameters(message_id=msg_id),
+                )
+            except tg_errors.RPCError:
+                pass
+            return
+
+    _stats["exports"] += 1
+    _stats["messages"] += exported
+    _stats["bytes"] += size
+
+
+def get_stats() -> dict[str, int]:
+    """Return the exports since the bot started"""
+    return {**_stats, "running": len(_tasks)}
@@ -2,7 +2,7 @@ import logging
 from pyrogram import handlers, filters
 
 from tg import tg_bot
-from data import utils, modules
+from data import utils, modules, numbers
 
 _logger = logging.getLogger(__name__)
 
@@ -13,7 +13,7 @@ HANDLERS = [
         & filters.create(lambda _, __, msg: msg.is_topic_message)
         & ~filters.service
         & ~filters.regex(r"^/")
-        & filters.chat(tg_bot.settings.tg_group_topic_id)
+        & filters.chat(numbers.get_group_ids())
         & ~filters.create(utils.is_answer()),
     ),
     handlers.MessageHandler(
@@ -21,19 +21,19 @@ HANDLERS = [
         filters.group
         & filters.create(lambda _, __, msg: msg.is_topic_message)
         & filters.service
-        & filters.chat(tg_bot.settings.tg_group_topic_id),
+        & filters.chat(numbers.get_group_ids()),
     ),
     handlers.MessageHandler(
         tg_bot.on_command,
         filters.group
         & filters.text
         & filters.regex(r"^/")
-        & filters.chat(tg_bot.settings.tg_group_topic_id),
+        & filters.chat(numbers.get_group_ids()),
     ),
     handlers.MessageReactionUpdatedHandler(
         tg_bot.on_reaction,
         filters.group,
-        # & filters.chat(tg_bot.settings.tg_group_topic_id),
+        # & filters.chat(numbers.get_group_ids()),
     ),
     handlers.CallbackQueryHandler(
         tg_bot.on_callback_query,
@@ -43,7 +43,10 @@ HANDLERS = [
         filters.group
         & ~filters.service
         & ~filters.regex(r"^/")
-        & filters.chat(tg_bot.settings.tg_group_topic_id)
-        & filters.create(utils.is_answer(answer_type=modules.EventType.MSG_WELCOME)),
+        & filters.chat(numbers.get_group_ids())
+        & (
+            filters.create(utils.is_answer(answer_type=modules.EventType.MSG_WELCOME))
+            | filters.create(utils.is_answer(answer_type=modules.EventType.BROADCAST))
+        ),
     ),
 ]
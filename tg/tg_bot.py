@@ -1,14 +1,38 @@
+import asyncio
+import datetime
+import html
+import io
 import logging
 import mimetypes
 import typing
 
 import httpx
 from pyrogram import types as tg_types, Client, enums
-from pywa_async import types as wa_types, errors as wa_errors
+from pywa_async import types as wa_types, errors as wa_errors, WhatsApp
 from sqlalchemy import exc as sqlalchemy_errors
 
-from data import clients, config, modules, utils
+from data import (
+    clients,
+    config,
+    modules,
+    utils,
+    read_receipts,
+    cache_memory,
+    media_reuse,
+    metrics,
+    tracing,
+    profiler,
+    watchdog,
+    memory,
+    numbers,
+    placement,
+    retention,
+    stickers,
+    transcode,
+)
 from db import repositoy
+from tg import album, broadcast, export
+from wa import media_group
 
 _logger = logging.getLogger(__name__)
 
@@ -26,23 +50,64 @@ media_kb_limit = {
 }  # https://developers.facebook.com/docs/whatsapp/cloud-api/reference/media#supported-media-types
 
 
+@metrics.timed_handler
 async def on_message(_: Client, msg: tg_types.Message):
+    if msg.media_group_id and settings.tg_album_window > 0:
+        album.add(
+            msg=msg,
+            handler=_bridge_message,
+            prefetch=msg.media in media_kb_limit and not _is_too_big(msg),
+        )
+        return
+
+    # keep the order of the messages, send the albums of the topic that wait before this message
+    await album.flush(msg=msg)
+    await _bridge_message(msg)
+
+
+def _is_too_big(msg: tg_types.Message) -> bool:
+    return _is_above_limit(msg) and not _can_transcode(msg) and not stickers.can_convert(msg.sticker)
+
+
+def _is_above_limit(msg: tg_types.Message) -> bool:
+    """The media is above the limit of whatsapp, before a conversion (one of media_kb_limit)"""
+    media = utils.get_media_file(getattr(msg, msg.media.name.lower()))
+    return (media.file_size or 0) > (media_kb_limit[msg.media] * 1024)
+
+
+def _can_transcode(msg: tg_types.Message) -> bool:
+    """A photo or a static sticker above the limit is re-encoded instead of rejected (IMAGE_TRANSCODE)"""
+    return transcode.can_transcode(
+        msg.media, is_static=not (msg.sticker and (msg.sticker.is_animated or msg.sticker.is_video))
+    )
+
+
+@metrics.timed_handler
+async def _bridge_message(msg: tg_types.Message, download_task: asyncio.Task | None = None):
+    metrics.messages.inc(
+        direction="tg_to_wa", type=msg.media.name.lower() if msg.media else "text"
+    )
+    trace = tracing.Trace("tg_to_wa", origin=msg.date, first_stage="update")
     topic_id = (
         msg.message_thread_id if msg.message_thread_id else msg.reply_to_message_id
     )
+    phone_id = numbers.get_by_group(msg.chat.id).phone_id
     try:
-        topic = repositoy.get_topic_by_topic_id(topic_id=topic_id)
+        topic = repositoy.get_topic_by_topic_id(topic_id=topic_id, chat_id=msg.chat.id)
     except sqlalchemy_errors.NoResultFound:
         return
 
     if topic.user.banned:
         return
+    trace.mark("resolve_topic")
 
     reply_msg = None
     if msg.message_thread_id:
         reply_to = msg.reply_to_message_id
         try:
-            reply_msg = repositoy.get_message(topic_msg_id=reply_to, wa_msg_id=None)
+            reply_msg = repositoy.get_message(
+                topic_msg_id=reply_to, wa_msg_id=None, chat_id=msg.chat.id
+            )
         except sqlalchemy_errors.NoResultFound:
             pass
 
@@ -50,7 +115,9 @@ async def on_message(_: Client, msg: tg_types.Message):
         topic.user.wa_id or topic.user.bsuid
     )  # bsuid is not supported yet when sending messages
     wa_user_id = topic.user.bsuid or topic.user.wa_id
+    wa = clients.get_wa_bot(phone_id)
     sent = None
+    file_unique_id = content_hash = uploaded_media_id = None  # saved for reuse after the message is saved
 
     kwargs = dict(to=wa_id, tracker=modules.Tracker(chat_id=msg.chat.id, msg_id=msg.id))
 
@@ -79,28 +146,73 @@ async def on_message(_: Client, msg: tg_types.Message):
                 if not msg.media == enums.MessageMediaType.STORY
                 else media_kb_limit.get(media.media, 0)
             )
-            if (media.file_size or 0) > (media_size_kb * 1024):
+            # the limit of a converted sticker is of the animated webp
+            file = utils.get_media_file(media)
+            too_big = (file.file_size or 0) > (media_size_kb * 1024) and not stickers.can_convert(msg.sticker)
+            if too_big and not _can_transcode(msg):
                 await msg.reply(
                     f"__{msg.media.name.title()} size is more than {media_size_kb / 1024} MB, can't send it to WhatsApp__",
                     quote=True,
                 )
                 return
 
-            download = await msg.download(in_memory=True)
-
-            sent = await _handle_media_message(
+            # reuse the media if it was already uploaded to whatsapp
+            file_unique_id = getattr(file, "file_unique_id", None)
+            download = media_reuse.get_media_id(
+                key_type=modules.MediaKeyType.TG_FILE_UNIQUE_ID, key=file_unique_id, phone_id=phone_id
+            )
+            if download is None and stickers.can_convert(msg.sticker):
+                # the converted sticker is shared by all the numbers, a popular sticker is converted once
+                try:
+                    download = memory.track(
+                        await stickers.convert(msg.sticker, download=lambda: msg.download(in_memory=True)),
+                        "tg_to_wa",
+                    )
+                except stickers.ConvertError as e:
+                    await msg.reply(f"__The sticker can't be sent to WhatsApp: {e}__", quote=True)
+                    return
+            elif download is None:
+                download = memory.track(
+                    await (download_task or msg.download(in_memory=True)), "tg_to_wa"
+                )
+                content_hash = await asyncio.to_thread(
+                    media_reuse.get_content_hash, download
+                )
+                download = (
+                    media_reuse.get_media_id(
+                        key_type=modules.MediaKeyType.TG_CONTENT_SHA256,
+                        key=content_hash,
+                        phone_id=phone_id,
+                    )
+                    or download
+                )
+            trace.mark("download")
+
+            if too_big and isinstance(download, io.BytesIO):  # not reused, the reused media was converted
+                try:
+                    download = await transcode.transcode(msg.media, download, media_size_kb)
+                except transcode.TranscodeError as e:
+                    await msg.reply(f"__{msg.media.name.title()} is too big for WhatsApp: {e}__", quote=True)
+                    return
+                trace.mark("transcode")
+
+            sent_media = await _handle_media_message(
+                wa=wa,
                 msg=msg,
                 reply_msg=reply_msg,
                 text=text,
                 download=typing.cast(bytes, download),
                 msg_kwargs=kwargs,
             )
-            if not sent:
+            if not sent_media:
                 return
+            sent = sent_media.id
+            if sent_media.uploaded_media:
+                uploaded_media_id = sent_media.uploaded_media.id
 
         else:
             sent = await _handle_other_message(
-                msg=msg, reply_msg=reply_msg, text=text, msg_kwargs=kwargs
+                wa=wa, msg=msg, reply_msg=reply_msg, text=text, msg_kwargs=kwargs
             )
 
     except wa_errors.WhatsAppError as e:
@@ -115,21 +227,14 @@ async def on_message(_: Client, msg: tg_types.Message):
             text=f"__trying to send {msg.media.name.lower()} message "
             f"but the download failed because timeout set to {settings.httpx_timeout} __",
         )
+    trace.mark("wa_upload")
 
     if sent:
-        # read the last message the wa user sent
+        # read the last message the wa user sent (debounced, see data/read_receipts.py)
         try:
-            db_settings = repositoy.get_settings()
-            mark_as_read = db_settings.wa_mark_as_read
-            if mark_as_read:
-                message_to_read = repositoy.get_last_message(wa_id=wa_user_id)
-                if (
-                    not message_to_read.sent_from_tg
-                ):  # the last message to read is from whatsapp
-                    await clients.wa_bot.mark_message_as_read(
-                        message_id=message_to_read.wa_msg_id
-                    )
-        except (sqlalchemy_errors.NoResultFound, wa_errors.WhatsAppError):
+            if repositoy.get_settings().wa_mark_as_read:
+                read_receipts.mark_as_read(wa_user_id=wa_user_id, phone_id=phone_id)
+        except sqlalchemy_errors.NoResultFound:
             pass
 
         # create the new message
@@ -139,18 +244,36 @@ async def on_message(_: Client, msg: tg_types.Message):
             wa_msg_id=sent,
             wa_id=wa_user_id,
             sent_from_tg=True,
+            phone_id=phone_id,
+            chat_id=msg.chat.id,
+            text=msg.text or msg.caption,
         )
+        media_reuse.save_media_id(
+            key_type=modules.MediaKeyType.TG_FILE_UNIQUE_ID,
+            key=file_unique_id,
+            media_id=uploaded_media_id,
+            phone_id=phone_id,
+        )
+        media_reuse.save_media_id(
+            key_type=modules.MediaKeyType.TG_CONTENT_SHA256,
+            key=content_hash,
+            media_id=uploaded_media_id,
+            phone_id=phone_id,
+        )
+        trace.mark("db_write")
+        trace.finish()
     else:
         await msg.reply("__Unsupported message type__", quote=True)
 
 
 async def _handle_media_message(
+    wa: WhatsApp,
     msg: tg_types.Message,
     reply_msg: repositoy.Message,
     text: str | None,
-    download: bytes,
+    download: bytes | str,
     msg_kwargs: dict,
-) -> str | None:
+) -> wa_types.SentMessage | None:
     media_kwargs = dict(
         **msg_kwargs,
         reply_to_message_id=reply_msg.wa_msg_id if reply_msg else None,
@@ -158,12 +281,12 @@ async def _handle_media_message(
     )
     match msg.media:
         case enums.MessageMediaType.PHOTO:
-            sent = await clients.wa_bot.send_image(
+            sent = await wa.send_image(
                 **media_kwargs, image=download, mime_type="image/jpeg"
             )
 
         case enums.MessageMediaType.VIDEO:
-            sent = await clients.wa_bot.send_video(
+            sent = await wa.send_video(
                 **media_kwargs,
                 video=download,
                 mime_type=msg.video.mime_type or "video/mp4",
@@ -171,13 +294,13 @@ async def _handle_media_message(
 
         case enums.MessageMediaType.STORY:
             if msg.story.video:
-                sent = await clients.wa_bot.send_video(
+                sent = await wa.send_video(
                     **media_kwargs,
                     video=download,
                     mime_type=msg.story.video.mime_type or "video/mp4",
                 )
             elif msg.story.photo:
-                sent = await clients.wa_bot.send_image(
+                sent = await wa.send_image(
                     **media_kwargs, image=download, mime_type="image/jpeg"
                 )
             else:
@@ -186,21 +309,21 @@ async def _handle_media_message(
                 return
 
         case enums.MessageMediaType.ANIMATION:
-            sent = await clients.wa_bot.send_video(
+            sent = await wa.send_video(
                 **media_kwargs,
                 video=download,
                 mime_type=msg.animation.mime_type or "video/mp4",
             )
 
         case enums.MessageMediaType.VIDEO_NOTE:
-            sent = await clients.wa_bot.send_video(
+            sent = await wa.send_video(
                 **media_kwargs,
                 video=download,
                 mime_type=msg.video_note.mime_type or "video/mp4",
             )
 
         case enums.MessageMediaType.DOCUMENT:
-            sent = await clients.wa_bot.send_document(
+            sent = await wa.send_document(
                 **media_kwargs,
                 document=download,
                 filename=msg.document.file_name,
@@ -211,34 +334,36 @@ async def _handle_media_message(
 
         # with no caption
         case enums.MessageMediaType.AUDIO:
-            sent = await clients.wa_bot.send_audio(
+            sent = await wa.send_audio(
                 **msg_kwargs,
                 audio=download,
                 mime_type=msg.audio.mime_type or "audio/mpeg",
             )
         case enums.MessageMediaType.VOICE:
-            sent = await clients.wa_bot.send_audio(
+            sent = await wa.send_audio(
                 **msg_kwargs,
                 audio=download,
                 mime_type=msg.voice.mime_type or "audio/ogg",
             )
         case enums.MessageMediaType.STICKER:
-            if msg.sticker.is_animated:
+            converted = stickers.can_convert(msg.sticker)
+            if msg.sticker.is_animated and not converted:
                 await msg.reply("__Animated stickers are not supported__", quote=True)
                 return
 
-            sent = await clients.wa_bot.send_sticker(
+            sent = await wa.send_sticker(
                 **msg_kwargs,
                 sticker=download,
-                mime_type=msg.sticker.mime_type or "image/webp",
+                mime_type="image/webp" if converted else msg.sticker.mime_type or "image/webp",
             )
         case _:
             return None
 
-    return sent.id
+    return sent
 
 
 async def _handle_other_message(
+    wa: WhatsApp,
     msg: tg_types.Message,
     reply_msg: repositoy.Message,
     text: str | None,
@@ -246,7 +371,7 @@ async def _handle_other_message(
 ) -> str | None:
     sent = None
     if msg.text:
-        sent = await clients.wa_bot.send_message(
+        sent = await wa.send_message(
             **msg_kwargs,
             text=text,
             preview_url=not msg.link_preview_options.is_disabled
@@ -255,7 +380,7 @@ async def _handle_other_message(
             reply_to_message_id=reply_msg.wa_msg_id if reply_msg else None,
         )
     elif msg.location or msg.venue:
-        sent = await clients.wa_bot.send_location(
+        sent = await wa.send_location(
             **msg_kwargs,
             latitude=msg.location.latitude
             if msg.location
@@ -267,7 +392,7 @@ async def _handle_other_message(
             address=msg.venue.address if msg.venue else None,
         )
     elif msg.contact:
-        sent = await clients.wa_bot.send_contact(
+        sent = await wa.send_contact(
             **msg_kwargs,
             reply_to_message_id=reply_msg.wa_msg_id if reply_msg else None,
             contact=wa_types.Contact(
@@ -288,13 +413,18 @@ async def _handle_other_message(
     return sent.id if sent else sent
 
 
+@metrics.timed_handler
 async def on_reaction(_: Client, reaction: tg_types.MessageReactionUpdated):
+    number = numbers.get_by_group(reaction.chat.id)
+    if number is None:
+        return
+    wa = clients.get_wa_bot(number.phone_id)
     if not reaction.new_reaction:
         try:
             msg = repositoy.get_message(
-                topic_msg_id=reaction.message_id, wa_msg_id=None
+                topic_msg_id=reaction.message_id, wa_msg_id=None, chat_id=reaction.chat.id
             )
-            await clients.wa_bot.remove_reaction(
+            await wa.remove_reaction(
                 to=msg.user.wa_id,
                 message_id=msg.wa_msg_id,
                 tracker=modules.Tracker(
@@ -309,9 +439,9 @@ async def on_reaction(_: Client, reaction: tg_types.MessageReactionUpdated):
 
         try:
             msg = repositoy.get_message(
-                topic_msg_id=reaction.message_id, wa_msg_id=None
+                topic_msg_id=reaction.message_id, wa_msg_id=None, chat_id=reaction.chat.id
             )
-            await clients.wa_bot.send_reaction(
+            await wa.send_reaction(
                 to=msg.user.wa_id,
                 message_id=msg.wa_msg_id,
                 emoji=reaction.new_reaction[-1].emoji,
@@ -323,40 +453,49 @@ async def on_reaction(_: Client, reaction: tg_types.MessageReactionUpdated):
             return
 
 
+@metrics.timed_handler
 async def on_message_service(_: Client, msg: tg_types.Message):
     topic_id = (
         msg.message_thread_id if msg.message_thread_id else msg.reply_to_message_id
     )
 
+    phone_id = numbers.get_by_group(msg.chat.id).phone_id
     try:
-        topic = repositoy.get_topic_by_topic_id(topic_id=topic_id)
+        topic = repositoy.get_topic_by_topic_id(topic_id=topic_id, chat_id=msg.chat.id)
     except sqlalchemy_errors.NoResultFound:
         return
 
     match msg.service:
         case enums.MessageServiceType.FORUM_TOPIC_CLOSED:
             if not topic.user.banned:
-                repositoy.update_user(wa_id=topic.user.wa_id, banned=True)
+                repositoy.update_user(
+                    wa_user_id=topic.user.bsuid or topic.user.wa_id, phone_id=phone_id, banned=True
+                )
                 await msg.reply("User banned", quote=True)
 
         case enums.MessageServiceType.FORUM_TOPIC_REOPENED:
             if topic.user.banned:
-                repositoy.update_user(wa_id=topic.user.wa_id, banned=False)
+                repositoy.update_user(
+                    wa_user_id=topic.user.bsuid or topic.user.wa_id, phone_id=phone_id, banned=False
+                )
                 await msg.reply("User unbanned", quote=True)
         case _:
             pass
 
 
+@metrics.timed_handler
 async def on_command(client: Client, msg: tg_types.Message):
     topic_id = (
         msg.message_thread_id if msg.message_thread_id else msg.reply_to_message_id
     )
 
+    phone_id = numbers.get_by_group(msg.chat.id).phone_id
     try:
-        topic = repositoy.get_topic_by_topic_id(topic_id=topic_id)
+        topic = repositoy.get_topic_by_topic_id(topic_id=topic_id, chat_id=msg.chat.id)
     except sqlalchemy_errors.NoResultFound:
         topic = None
-    cmd, _ = msg.text.split("@", maxsplit=1) if "@" in msg.text else (msg.text, None)
+    cmd, *args = msg.text.split()
+    cmd = cmd.split("@", maxsplit=1)[0]
     if cmd == "/info":
         if topic is None:
             await msg.reply("No topic found", quote=True)
@@ -378,7 +517,7 @@ async def on_command(client: Client, msg: tg_types.Message):
                         ),
                         tg_types.InlineKeyboardButton(
                             text="Topic",
-                            url=f"https://t.me/c/{str(settings.tg_group_topic_id).replace('-100', '')}"
+                            url=f"https://t.me/c/{str(msg.chat.id).replace('-100', '')}"
                             f"/{topic.topic_id}",
                         ),
                     ]
@@ -391,11 +530,11 @@ async def on_command(client: Client, msg: tg_types.Message):
             await msg.reply("No topic found", quote=True)
             return
 
-        await clients.wa_bot.request_location(
+        await clients.get_wa_bot(phone_id).request_location(
             to=topic.user.bsuid or topic.user.wa_id, text="Location requested"
         )
 
-    elif cmd in ["/settings", "/ban", "/unban"]:
+    elif cmd in ["/settings", "/ban", "/unban", "/stats", "/profile", "/memory", "/broadcast", "/search", "/export"]:
         # check if the user is admin in the group
         user = await client.get_chat_member(msg.chat.id, msg.from_user.id)
         if user.status not in (
@@ -450,6 +589,228 @@ async def on_command(client: Client, msg: tg_types.Message):
                 ),
             )
 
+        elif cmd == "/stats":
+            cache_stats = cache_memory.my_cache.get_stats()
+            hit_stats = cache_memory.my_cache.get_hit_stats()
+            read_stats = read_receipts.get_stats()
+            group_stats = media_group.get_stats()
+            album_stats = album.get_stats()
+            media_stats = media_reuse.get_stats()
+            logging_stats = config.get_logging_stats()
+            loop_stats = watchdog.get_stats()
+            broadcast_stats = broadcast.get_stats()
+            number_stats = numbers.get_stats()
+            placement_stats = placement.get_stats()
+            retention_stats = retention.get_stats()
+            export_stats = export.get_stats()
+            transcode_stats = transcode.get_stats()
+            sticker_stats = stickers.get_stats()
+            await msg.reply(
+                text="**Stats**\n"
+                "**Cache:**\n"
+                + "".join(f"> {name}: __{count}__\n" for name, count in cache_stats.items())
+                + f"> hits: __{hit_stats['hits']}__\n"
+                f"> misses: __{hit_stats['misses']}__\n"
+                f"> hit rate: __{hit_stats['hit_rate']:.0%}__\n"
+                + (
+                    f"> local hits: __{hit_stats['local_hits']}__\n"
+                    f"> shared hits: __{hit_stats['shared_hits']}__\n"
+                    f"> invalidations: __{hit_stats['invalidations_sent']}__ sent, "
+                    f"__{hit_stats['invalidations_received']}__ received\n"
+                    f"> invalidation lag: __{hit_stats['invalidation_lag_avg'] * 1000:.1f}ms__ avg, "
+                    f"__{hit_stats['invalidation_lag_max'] * 1000:.1f}ms__ max\n"
+                    f"> errors: __{hit_stats['errors']}__ "
+                    f"(__{hit_stats['skipped']}__ lookups skipped redis after an error)\n"
+                    if "shared_hits" in hit_stats
+                    else ""
+                )
+                + "\n**Mark as read:**\n"
+                f"> requested: __{read_stats['requested']}__\n"
+                f"> sent: __{read_stats['sent']}__\n"
+                f"> saved: __{read_stats['saved']}__\n"
+                f"> failed: __{read_stats['failed']}__\n"
+                f"> pending: __{read_stats['pending']}__\n"
+                "\n**Media groups:**\n"
+                f"> media: __{group_stats['items']}__\n"
+                f"> sent: __{group_stats['api_calls']}__\n"
+                f"> saved: __{group_stats['saved']}__\n"
+                "\n**Albums to WhatsApp:**\n"
+                f"> albums: __{album_stats['albums']}__\n"
+                f"> media: __{album_stats['items']}__\n"
+                f"> avg latency: __{album_stats['latency_avg']:.2f}s__\n"
+                f"> max latency: __{album_stats['latency_max']:.2f}s__\n"
+                "\n**Media cache:**\n"
+                f"> hits: __{media_stats['hits']}__\n"
+                f"> misses: __{media_stats['misses']}__\n"
+                f"> hit rate: __{media_stats['hit_rate']:.0%}__\n"
+                f"> evicted: __{media_stats['evicted']}__\n"
+                "\n**Logging:**\n"
+                f"> queued: __{logging_stats['queued']}__\n"
+                f"> dropped: __{logging_stats['dropped']}__\n"
+                "\n**Event loop:**\n"
+                f"> lag p50: __{loop_stats['lag_p50'] * 1000:.1f}ms__\n"
+                f"> lag p99: __{loop_stats['lag_p99'] * 1000:.1f}ms__\n"
+                f"> lag max: __{loop_stats['lag_max'] * 1000:.1f}ms__\n"
+                f"> blocked: __{loop_stats['blocked']}__\n"
+                "\n**Broadcast:**\n"
+                f"> running: __{broadcast_stats['running']}__\n"
+                f"> sent: __{broadcast_stats['sent']}__\n"
+                f"> failed: __{broadcast_stats['failed']}__\n"
+                f"> skipped: __{broadcast_stats['skipped']}__\n"
+                "\n**Numbers:**\n"
+                + "".join(
+                    f"> {phone_id}: __{stats['messages']}__ sent, __{stats['throttled']}__ throttled "
+                    f"(__{stats['wait_total']:.1f}s__)\n"
+                    for phone_id, stats in number_stats.items()
+                )
+                + "\n**Groups:**\n"
+                + "".join(
+                    f"> {chat_id}: __{topics}__ topics\n" for chat_id, topics in placement_stats["groups"].items()
+                )
+                + f"> all full: __{placement_stats['full']}__\n"
+                "\n**Database maintenance:**\n"
+                f"> runs: __{retention_stats['runs']}__ (last __{retention_stats['last_run_seconds']:.1f}s__)\n"
+                f"> messages: __{retention_stats['deleted']}__ deleted, __{retention_stats['archived']}__ archived\n"
+                f"> vacuumed pages: __{retention_stats['vacuumed_pages']}__\n"
+                f"> errors: __{retention_stats['errors']}__\n"
+                "\n**Export:**\n"
+                f"> exports: __{export_stats['exports']}__ (__{export_stats['running']}__ running)\n"
+                f"> messages: __{export_stats['messages']}__\n"
+                f"> size: __{export_stats['bytes'] / 1024 / 1024:.1f}MB__\n"
+                f"> errors: __{export_stats['errors']}__\n"
+                "\n**Image conversion:**\n"
+                f"> converted: __{transcode_stats['converted']}__ "
+                f"(avg __{transcode_stats['avg_seconds']:.2f}s__, __{transcode_stats['pending']}__ now)\n"
+                f"> size: __{transcode_stats['bytes_in'] / 1024 / 1024:.1f}MB__ to "
+                f"__{transcode_stats['bytes_out'] / 1024 / 1024:.1f}MB__\n"
+                f"> failed: __{transcode_stats['failed']}__, timeouts: __{transcode_stats['timeouts']}__, "
+                f"rejected: __{transcode_stats['rejected']}__, pool restarts: __{transcode_stats['restarts']}__\n"
+                "\n**Sticker conversion:**\n"
+                f"> hits: __{sticker_stats['hits'] + sticker_stats['waited']}__, "
+                f"misses: __{sticker_stats['misses']}__ (hit rate __{sticker_stats['hit_rate']:.0%}__)\n"
+                f"> cached: __{sticker_stats['cached']}__ (__{sticker_stats['cached_bytes'] / 1024 / 1024:.1f}MB__), "
+                f"evicted: __{sticker_stats['evicted']}__\n"
+                f"> converted: __{sticker_stats['converted']}__ (avg __{sticker_stats['avg_seconds']:.2f}s__, "
+                f"max __{sticker_stats['max_seconds']:.2f}s__, __{sticker_stats['pending']}__ now)\n"
+                f"> failed: __{sticker_stats['failed']}__, timeouts: __{sticker_stats['timeouts']}__, "
+                f"rejected: __{sticker_stats['rejected']}__, pool restarts: __{sticker_stats['restarts']}__\n",
+                quote=True,
+            )
+
+        elif cmd == "/profile":
+            seconds = int(args[0]) if args and args[0].isdigit() else 30
+            seconds = min(seconds, profiler.MAX_SECONDS)
+            await msg.reply(f"__Profiling for {seconds} seconds...__", quote=True)
+            try:
+                report = await profiler.profile(
+                    seconds=seconds, slow_callback_ms=settings.profile_slow_callback_ms
+                )
+            except profiler.ProfilerBusy:
+                await msg.reply("__The profiler is already running__", quote=True)
+                return
+
+            document = io.BytesIO(report.encode())
+            document.name = f"profile_{datetime.datetime.now():%Y%m%d_%H%M%S}.txt"
+            await msg.reply_document(document=document, quote=True)
+
+        elif cmd == "/memory":
+            if args and args[0] == "start":
+                await asyncio.to_thread(memory.start_tracing)
+                await msg.reply(
+                    "__Memory tracing started, send /memory to see what grew since now__", quote=True
+                )
+                return
+            if args and args[0] == "stop":
+                memory.stop_tracing()
+                await msg.reply("__Memory tracing stopped__", quote=True)
+                return
+
+            document = io.BytesIO((await asyncio.to_thread(memory.get_report)).encode())
+            document.name = f"memory_{datetime.datetime.now():%Y%m%d_%H%M%S}.txt"
+            await msg.reply_document(document=document, quote=True)
+
+        elif cmd == "/search":
+            if not settings.message_search:
+                await msg.reply("__The search is disabled, set MESSAGE_SEARCH to save the messages for it__", quote=True)
+                return
+            if not args:
+                await msg.reply("__Send /search and the words to search, example: /search order 1234__", quote=True)
+                return
+
+            query = " ".join(args)
+            start = datetime.datetime.now()
+            results = await asyncio.to_thread(
+                repositoy.search_messages,
+                query=query,
+                phone_id=phone_id,
+                limit=settings.search_results,
+            )
+            took = (datetime.datetime.now() - start).total_seconds() * 1000
+            if not results:
+                await msg.reply(f"__No messages found for__ `{query}`", quote=True)
+                return
+
+            # html, the snippets are the text of the users and can have any markdown
+            lines = [f"<b>Search:</b> <i>{html.escape(query)}</i> (results: {len(results)}, {took:.0f}ms)"]
+            for message, snippet in results:
+                snippet = html.escape(" ".join(snippet.split())).replace("\x02", "<b>").replace("\x03", "</b>")
+                link = (
+                    f"https://t.me/c/{str(message.chat_id).replace('-100', '')}"
+                    f"/{message.topic.topic_id}/{message.topic_msg_id}"
+                )
+                lines.append(
+                    f'<a href="{link}">{html.escape(message.user.name)}</a> '
+                    f"{'→' if message.sent_from_tg else '←'} <i>{message.created_at:%Y-%m-%d %H:%M}</i>\n"
+                    f"<blockquote>{snippet}</blockquote>"
+                )
+            await msg.reply(
+                "\n".join(lines), quote=True, parse_mode=enums.ParseMode.HTML, disable_web_page_preview=True
+            )
+
+        elif cmd == "/export":
+            if topic is None:
+                await msg.reply("No topic found", quote=True)
+                return
+            fmt = args[0].lower() if args else "html"
+            if fmt not in export.FORMATS:
+                await msg.reply(f"__Send /export or /export {' or /export '.join(export.FORMATS)}__", quote=True)
+                return
+            try:
+                export.start(topic=topic, msg_id=msg.id, fmt=fmt)
+            except export.ExportBusy:
+                await msg.reply("__The topic is already being exported__", quote=True)
+                return
+            await msg.reply("__Exporting the conversation, the file will be sent here...__", quote=True)
+
+        elif cmd == "/broadcast":
+            if args and args[0] == "stop":
+                if not await broadcast.stop():
+                    await msg.reply("__No broadcast is running__", quote=True)
+                return
+            if broadcast.is_running():
+                await msg.reply(
+                    "__A broadcast is already running, send /broadcast stop to stop it__", quote=True
+                )
+                return
+
+            await msg.reply(
+                text="Send the message to broadcast to all the active users",
+                quote=True,
+                reply_markup=tg_types.InlineKeyboardMarkup(
+                    inline_keyboard=[
+                        [
+                            tg_types.InlineKeyboardButton(
+                                text="Cancel", callback_data="cancel_listen"
+                            )
+                        ]
+                    ]
+                ),
+            )
+            utils.add_listener(
+                user_id=msg.from_user.id,
+                data={"answer_type": modules.EventType.BROADCAST},
+            )
+
         elif cmd == "/ban":
             if not topic:
                 await msg.reply("No topic found", quote=True)
@@ -464,7 +825,7 @@ async def on_command(client: Client, msg: tg_types.Message):
             )
 
             repositoy.update_user(
-                wa_user_id=topic.user.bsuid or topic.user.wa_id, banned=True
+                wa_user_id=topic.user.bsuid or topic.user.wa_id, phone_id=phone_id, banned=True
             )
             await msg.reply("User banned", quote=True)
 
@@ -482,12 +843,13 @@ async def on_command(client: Client, msg: tg_types.Message):
             )
 
             repositoy.update_user(
-                wa_user_id=topic.user.bsuid or topic.user.wa_id, banned=False
+                wa_user_id=topic.user.bsuid or topic.user.wa_id, phone_id=phone_id, banned=False
             )
             await msg.reply("User unbanned", quote=True)
 
 
-async def on_callback_query(_: Client, cbd: tg_types.CallbackQuery):
+@metrics.timed_handler
+async def on_callback_query(client: Client, cbd: tg_types.CallbackQuery):
     cbd_data = cbd.data
 
     if cbd_data.startswith("settings"):
@@ -538,11 +900,35 @@ async def on_callback_query(_: Client, cbd: tg_types.CallbackQuery):
                 data={"answer_type": modules.EventType.MSG_WELCOME},
             )
 
+    elif cbd_data.startswith("broadcast_start_"):
+        user = await client.get_chat_member(cbd.message.chat.id, cbd.from_user.id)
+        if user.status not in (
+            enums.ChatMemberStatus.OWNER,
+            enums.ChatMemberStatus.ADMINISTRATOR,
+        ):
+            await cbd.answer("You are not admin in the group")
+            return
+
+        msg = await client.get_messages(
+            chat_id=cbd.message.chat.id, message_ids=int(cbd_data.split("_")[-1])
+        )
+        await cbd.message.edit_text("__Uploading the broadcast...__")
+        try:
+            await broadcast.create(msg)
+        except broadcast.BroadcastBusy:
+            await cbd.message.edit_text("__A broadcast is already running__")
+            return
+        except wa_errors.WhatsAppError as e:
+            await cbd.message.edit_text(f"__Failed to upload to WhatsApp.__\n> **{e.message}**")
+            return
+        await cbd.message.edit_text("__Broadcast started, send /broadcast stop to stop it__")
+
     elif cbd_data == "cancel_listen":
         utils.remove_listener(user_id=cbd.from_user.id)  # remove listener
         await cbd.message.reply("Canceled")
 
 
+@metrics.timed_handler
 async def on_listen(_: Client, msg: tg_types.Message):
     if not msg.from_user:
         await msg.reply("User not found")
@@ -565,3 +951,45 @@ async def on_listen(_: Client, msg: tg_types.Message):
             )
 
         await msg.reply("Welcome message updated", quote=True)
+
+    elif data.get("answer_type") == modules.EventType.BROADCAST:
+        # the media of a broadcast is uploaded as is, without the conversions of the bridge
+        if not (msg.text or msg.media in broadcast.MEDIA_TYPES) or (
+            msg.media in broadcast.MEDIA_TYPES and _is_above_limit(msg)
+        ) or (msg.sticker and (msg.sticker.is_animated or msg.sticker.is_video)):
+            await msg.reply("__This message can't be sent to WhatsApp__", quote=True)
+            return
+        if msg.caption and broadcast.MEDIA_TYPES[msg.media][0] in broadcast.NO_CAPTION_TYPES:
+            await msg.reply(
+                "__WhatsApp sends audio and stickers without a caption, broadcast the text separately__",
+                quote=True,
+            )
+            return
+
+        total, in_window = repositoy.count_broadcast_users(
+            window_start=broadcast.get_window_start(),
+            phone_id=numbers.get_by_group(msg.chat.id).phone_id,
+        )
+        outside = (
+            f"get the template `{settings.broadcast_template}`"
+            if settings.broadcast_template
+            else "are skipped (set BROADCAST_TEMPLATE to send them a template)"
+        )
+        await msg.reply(
+            text=f"**Broadcast this message to {total} users?**\n"
+            f"> {in_window} users sent a message in the last 24 hours\n"
+            f"> {total - in_window} users {outside}",
+            quote=True,
+            reply_markup=tg_types.InlineKeyboardMarkup(
+                inline_keyboard=[
+                    [
+                        tg_types.InlineKeyboardButton(
+                            text="Send ✅", callback_data=f"broadcast_start_{msg.id}"
+                        ),
+                        tg_types.InlineKeyboardButton(
+                            text="Cancel ❌", callback_data="cancel_listen"
+                        ),
+                    ]
+                ]
+            ),
+        )
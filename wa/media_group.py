@@ -0,0 +1,253 @@
+import asyncio
+import dataclasses
+import io
+import logging
+
+from pyrogram import types as tg_types, errors as tg_errors
+from pywa_async import types as wa_types
+
+from data import clients, config, utils, modules, read_receipts, media_reuse
+from db import repositoy
+
+_logger = logging.getLogger(__name__)
+
+settings = config.get_settings()
+
+MAX_GROUP_SIZE = 10  # telegram limit for media group
+
+_kinds = {
+    wa_types.MessageType.IMAGE: "visual",
+    wa_types.MessageType.VIDEO: "visual",
+    wa_types.MessageType.DOCUMENT: "document",
+}  # documents can't be grouped with photos and videos
+
+
+@dataclasses.dataclass
+class _Group:
+    """Media that arrived from the user and waits to be sent to the topic"""
+
+    phone_id: str
+    chat_id: int  # the group of the topic
+    topic_id: int
+    kind: str
+    wa_msg_ids: list[str] = dataclasses.field(default_factory=list)
+    media_keys: list[str] = dataclasses.field(default_factory=list)  # see media_reuse.get_wa_key
+    media: list[tg_types.InputMediaPhoto | tg_types.InputMediaVideo | tg_types.InputMediaDocument] = (
+        dataclasses.field(default_factory=list)
+    )
+    task: asyncio.Task | None = None
+
+
+_groups: dict[tuple[str, str], _Group] = {}
+"""example: {(phone_id, wa_user_id): _Group} - the pending group of the user"""
+
+_sending: dict[tuple[str, str], asyncio.Future] = {}
+"""example: {(phone_id, wa_user_id): future} - the group of the user that is sent now, done when it was sent"""
+
+_stats = {"items": 0, "api_calls": 0}
+
+
+def can_coalesce(*, msg: wa_types.Message, reply_msg: repositoy.Message | None) -> bool:
+    """
+    Check if the message can wait to be sent with the next media of the user
+    :param msg: the message from whatsapp
+    :param reply_msg: the message that the user replied to
+    :return: true if the coalescing is enabled and the message is image, video or document without reply
+    """
+    return settings.tg_media_group_window > 0 and msg.type in _kinds and reply_msg is None
+
+
+async def add(
+    *,
+    msg: wa_types.Message,
+    wa_user_id: str,
+    phone_id: str,
+    chat_id: int,
+    topic_id: int,
+    media: io.BytesIO | str,
+    caption: str | None,
+):
+    """
+    Add media to the pending group of the user, the group is sent when the user stops sending media
+    :param msg: the message from whatsapp
+    :param wa_user_id: the bsuid or the wa_id of the user
+    :param phone_id: the number that received the message
+    :param chat_id: the group of the topic
+    :param topic_id: the id of the topic
+    :param media: the downloaded media or the telegram file id of the media
+    :param caption: the caption of the media
+    """
+    kind = _kinds[msg.type]
+    key = (phone_id, wa_user_id)
+    group = _groups.get(key)
+    if group is not None and msg.id in group.wa_msg_ids:  # webhook retry
+        return
+
+    if group is not None and (group.kind != kind or group.topic_id != topic_id):
+        await flush(wa_user_id=wa_user_id, phone_id=phone_id)
+        group = None
+
+    if group is None:
+        group = _groups[key] = _Group(phone_id=phone_id, chat_id=chat_id, topic_id=topic_id, kind=kind)
+
+    match msg.type:
+        case wa_types.MessageType.IMAGE:
+            input_media = tg_types.InputMediaPhoto(media=media, caption=caption or "")
+        case wa_types.MessageType.VIDEO:
+            input_media = tg_types.InputMediaVideo(media=media, caption=caption or "")
+        case _:
+            input_media = tg_types.InputMediaDocument(
+                media=media, caption=caption or "", file_name=msg.media.filename
+            )
+
+    group.wa_msg_ids.append(msg.id)
+    group.media_keys.append(media_reuse.get_wa_key(msg))
+    group.media.append(input_media)
+
+    if group.task is not None:
+        group.task.cancel()
+    if len(group.media) >= MAX_GROUP_SIZE:
+        await flush(wa_user_id=wa_user_id, phone_id=phone_id)
+    else:
+        group.task = asyncio.create_task(_flush_later(wa_user_id, phone_id))
+
+
+async def _flush_later(wa_user_id: str, phone_id: str):
+    await asyncio.sleep(settings.tg_media_group_window)
+    await flush(wa_user_id=wa_user_id, phone_id=phone_id)
+
+
+async def flush(*, wa_user_id: str, phone_id: str):
+    """
+    Send the pending group of the user to the topic, should be called before sending other message of the user.
+    A group of the user that is being sent is waited for first, so the messages stay in order.
+    :param wa_user_id: the bsuid or the wa_id of the user
+    :param phone_id: the number that received the media
+    """
+    key = (phone_id, wa_user_id)
+    while (sending := _sending.get(key)) is not None:
+        await asyncio.shield(sending)
+
+    group = _groups.pop(key, None)
+    if group is None:
+        return
+    if group.task is not None and group.task is not asyncio.current_task():
+        group.task.cancel()
+
+    _sending[key] = asyncio.get_running_loop().create_future()
+    try:
+        await _send_group(group, wa_user_id=wa_user_id, phone_id=phone_id)
+    finally:
+        _sending.pop(key).set_result(None)
+
+
+async def _send_group(group: _Group, *, wa_user_id: str, phone_id: str):
+    while True:
+        for input_media in group.media:
+            if isinstance(input_media.media, io.BytesIO):
+                input_media.media.seek(0)
+        try:
+            sent = await _send(
+                chat_id=group.chat_id, topic_id=group.topic_id, media=group.media
+            )
+
+        except tg_errors.FloodWait as e:
+            await asyncio.sleep(e.value)
+            continue
+
+        except tg_errors.TopicDeleted:
+            _logger.debug("his topic was deleted, creating new topic..")
+            try:
+                user = repositoy.get_user_by_wa_id(wa_id=wa_user_id, phone_id=phone_id)
+                new_topic_id = await utils.create_topic(
+                    clients.tg_bot,
+                    wa_user_id,
+                    user.name,
+                    is_new=False,
+                    chat_id=group.chat_id,
+                )
+                repositoy.update_topic(
+                    tg_topic_id=group.topic_id, chat_id=group.chat_id, topic_id=new_topic_id
+                )
+            except Exception:  # noqa
+                _logger.exception(
+                    "Error creating topic: ",
+                )
+                return
+            group.topic_id = new_topic_id
+            continue
+
+        except Exception:  # noqa
+            _logger.exception(
+                "Error sending media group: ",
+            )
+            return
+        break
+
+    _stats["items"] += len(group.media)
+    _stats["api_calls"] += 1
+
+    for wa_msg_id, media_key, input_media, sent_msg in zip(
+        group.wa_msg_ids, group.media_keys, group.media, sent
+    ):
+        repositoy.create_message(
+            wa_id=wa_user_id,
+            topic_id=group.topic_id,
+            wa_msg_id=wa_msg_id,
+            topic_msg_id=sent_msg.id,
+            sent_from_tg=False,
+            phone_id=phone_id,
+            chat_id=group.chat_id,
+            text=input_media.caption or None,
+        )
+        if isinstance(input_media.media, io.BytesIO):
+            media_reuse.save_media_id(
+                key_type=modules.MediaKeyType.WA_SHA256,
+                key=media_key,
+                media_id=media_reuse.get_file_id(sent_msg),
+            )
+    read_receipts.set_unread(
+        wa_user_id=wa_user_id, wa_msg_id=group.wa_msg_ids[-1], phone_id=phone_id
+    )
+
+
+async def _send(
+    *,
+    chat_id: int,
+    topic_id: int,
+    media: list[tg_types.InputMediaPhoto | tg_types.InputMediaVideo | tg_types.InputMediaDocument],
+) -> list[tg_types.Message]:
+    kwargs = dict(
+        chat_id=chat_id,
+        reply_parameters=tg_types.ReplyParameters(message_id=topic_id),
+    )
+    if len(media) > 1:
+        return await clients.tg_bot.send_media_group(**kwargs, media=media)
+
+    # telegram doesn't allow media group with one item
+    input_media = media[0]
+    if isinstance(input_media, tg_types.InputMediaPhoto):
+        sent = await clients.tg_bot.send_photo(
+            **kwargs, photo=input_media.media, caption=input_media.caption
+        )
+    elif isinstance(input_media, tg_types.InputMediaVideo):
+        sent = await clients.tg_bot.send_video(
+            **kwargs, video=input_media.media, caption=input_media.caption
+        )
+    else:
+        sent = await clients.tg_bot.send_document(
+            **kwargs,
+            document=input_media.media,
+            caption=input_media.caption,
+            file_name=input_media.file_name,
+        )
+    return [sent]
+
+
+def get_stats() -> dict[str, int]:
+    """Return media group stats, how many requests to telegram were saved by grouping"""
+    return {
+        **_stats,
+        "saved": _stats["items"] - _stats["api_calls"],
+        "pending": sum(len(group.media) for group in _groups.values()),
+    }
@@ -7,16 +7,39 @@ from pywa_async import types as wa_types, errors as wa_errors, WhatsApp, filters
 from pyrogram import types as tg_types, errors as tg_errors
 from sqlalchemy.exc import NoResultFound
 
-from data import clients, config, utils, modules
+from data import (
+    clients,
+    config,
+    utils,
+    modules,
+    read_receipts,
+    media_reuse,
+    metrics,
+    tracing,
+    memory,
+    numbers,
+    placement,
+)
 from db import repositoy
+from wa import media_group
 
 _logger = logging.getLogger(__name__)
 
 settings = config.get_settings()
-send_to = settings.tg_group_topic_id
 
+tg_upload_limit = {
+    wa_types.MessageType.IMAGE: 10 * 1024 * 1024,
+}  # https://core.telegram.org/api/files#uploading-files, other media use settings.tg_upload_limit_mb
 
+
+@metrics.timed_handler
 async def _create_user(_: WhatsApp, msg: wa_types.Message) -> bool:
+    phone_id = msg.metadata.phone_number_id
+    number = numbers.get(phone_id)
+    if number is None:  # the webhook of a number that is not in WA_NUMBERS
+        _logger.warning(f"Message to unknown number {phone_id}, add it to WA_NUMBERS")
+        return False
+
     bsuid = (wa_user := msg.from_user).bsuid
     wa_id = wa_user.wa_id
     name = wa_user.name
@@ -25,9 +48,9 @@ async def _create_user(_: WhatsApp, msg: wa_types.Message) -> bool:
         2
     ):  # try twice to handle bsuid update if the user was created before the bsuid was added to the database
         try:
-            user = repositoy.get_user_by_wa_id(wa_id=bsuid)
+            user = repositoy.get_user_by_wa_id(wa_id=bsuid, phone_id=phone_id)
             if not user.active:
-                repositoy.update_user(wa_user_id=bsuid, active=True)
+                repositoy.update_user(wa_user_id=bsuid, phone_id=phone_id, active=True)
             if user.banned:
                 return False
 
@@ -35,14 +58,14 @@ async def _create_user(_: WhatsApp, msg: wa_types.Message) -> bool:
                 wa_id is not None
             ):  # the user share his wa_id but the bsuid is the same, update the wa_id
                 try:
-                    repositoy.get_user_by_wa_id(wa_id=wa_id)
+                    repositoy.get_user_by_wa_id(wa_id=wa_id, phone_id=phone_id)
                 except NoResultFound:
-                    repositoy.update_user(wa_user_id=bsuid, wa_id=wa_id)
+                    repositoy.update_user(wa_user_id=bsuid, phone_id=phone_id, wa_id=wa_id)
 
         except NoResultFound:
             try:
-                repositoy.get_user_by_wa_id(wa_id=wa_id)
-                repositoy.update_user(wa_user_id=wa_id, bsuid=bsuid)  # update the bsuid
+                repositoy.get_user_by_wa_id(wa_id=wa_id, phone_id=phone_id)
+                repositoy.update_user(wa_user_id=wa_id, phone_id=phone_id, bsuid=bsuid)  # update the bsuid
                 continue  # check if active or banned
 
             except NoResultFound:  # if user not exists than create user
@@ -68,11 +91,14 @@ async def _create_user(_: WhatsApp, msg: wa_types.Message) -> bool:
                         isinstance(msg, wa_types.Message)
                         and not msg.text.startswith("/start")
                     ):
-                        await msg.reply(text_welcome.text)
+                        await clients.get_wa_bot(phone_id).send_message(
+                            to=msg.sender, text=text_welcome.text
+                        )
 
                 # create user and topic
+                chat_id = placement.get_group(number, bsuid)
                 topic_id = await utils.create_topic(
-                    clients.tg_bot, wa_id or bsuid, name, is_new=True
+                    clients.tg_bot, wa_id or bsuid, name, is_new=True, chat_id=chat_id
                 )
                 repositoy.create_user_and_topic(
                     wa_id=wa_id,
@@ -80,6 +106,8 @@ async def _create_user(_: WhatsApp, msg: wa_types.Message) -> bool:
                     name=name,
                     username=wa_user.username,
                     topic_id=topic_id,
+                    phone_id=phone_id,
+                    chat_id=chat_id,
                 )
         break
 
@@ -124,22 +152,27 @@ create_user = filters.new(_create_user)
 
 
 @WhatsApp.on_message_status(filters=filters.failed, factory=modules.Tracker)
+@metrics.timed_handler
 async def on_failed_status(
     _: WhatsApp,
     status: wa_types.MessageStatus,  # TODO [modules.Tracker]
 ):
-    await clients.tg_bot.send_message(
-        chat_id=status.tracker.chat_id,
-        text=f"__Failed to send to WhatsApp.__\n> **{status.error.message}**\n{('> ' + status.error.details) if status.error.details else ''}",
-        reply_parameters=tg_types.ReplyParameters(message_id=status.tracker.msg_id),
-    )
+    if status.tracker is not None:  # broadcast messages have no tracker, see tg/broadcast.py
+        await clients.tg_bot.send_message(
+            chat_id=status.tracker.chat_id,
+            text=f"__Failed to send to WhatsApp.__\n> **{status.error.message}**\n{('> ' + status.error.details) if status.error.details else ''}",
+            reply_parameters=tg_types.ReplyParameters(message_id=status.tracker.msg_id),
+        )
     if isinstance(status.error, wa_errors.ReEngagementMessage):  # 24 hours passed
-        repositoy.update_user(wa_user_id=status.sender, active=False)
+        repositoy.update_user(
+            wa_user_id=status.sender, phone_id=status.metadata.phone_number_id, active=False
+        )
     else:
         _logger.error(status.error)
 
 
 @WhatsApp.on_message(filters=filters.command("start") & create_user)
+@metrics.timed_handler
 async def on_command_start(_: WhatsApp, msg: wa_types.Message):
     # get text welcome message
     try:
@@ -150,19 +183,35 @@ async def on_command_start(_: WhatsApp, msg: wa_types.Message):
         text_welcome = None
 
     if text_welcome:
-        await msg.mark_as_read()
-        await msg.reply(text_welcome.text)
+        wa = clients.get_wa_bot(msg.metadata.phone_number_id)  # the number that received the message
+        await wa.mark_message_as_read(message_id=msg.id)
+        await wa.send_message(to=msg.sender, text=text_welcome.text)
+
+
+def _get_upload_limit(msg_type: wa_types.MessageType) -> int:
+    """Get the max size in bytes of media that the bot can send to telegram"""
+    return tg_upload_limit.get(msg_type, settings.tg_upload_limit_mb * 1024 * 1024)
+
+
+def _get_download_timeout(file_size: int) -> float:
+    """Get the timeout in seconds to download media, bigger media gets more time"""
+    return settings.httpx_timeout + file_size / (settings.wa_download_min_speed_kb * 1024)
 
 
 @WhatsApp.on_message(filters=~filters.is_command & create_user)
+@metrics.timed_handler
 async def get_message(_: WhatsApp, msg: wa_types.Message):
+    metrics.messages.inc(direction="wa_to_tg", type=msg.type)
+    trace = tracing.Trace("wa_to_tg", origin=msg.timestamp)
+    phone_id = msg.metadata.phone_number_id
     try:
-        repositoy.get_message(wa_msg_id=msg.id, topic_msg_id=None)
+        repositoy.get_message(wa_msg_id=msg.id, topic_msg_id=None, chat_id=None)
         return
     except NoResultFound:
         pass
 
     wa_user_id = msg.sender
+    wa = clients.get_wa_bot(phone_id)
 
     text = (
         utils.get_wa_text_to_tg(msg.text or msg.caption)
@@ -177,9 +226,12 @@ async def get_message(_: WhatsApp, msg: wa_types.Message):
             text = f"{text}\n\n{text_forwarded}"
 
     while True:
-        user = repositoy.get_user_by_wa_id(wa_id=wa_user_id)
+        user = repositoy.get_user_by_wa_id(wa_id=wa_user_id, phone_id=phone_id)
         topic_id = user.topic.topic_id
+        send_to = user.topic.chat_id
+        trace.mark("resolve_user")
         sent = None
+        download = None
         reply_msg = None
         if msg.is_reply:
             try:
@@ -188,10 +240,17 @@ async def get_message(_: WhatsApp, msg: wa_types.Message):
                     if not msg.reaction
                     else msg.message_id_to_reply
                 )
-                reply_msg = repositoy.get_message(wa_msg_id=reply_to, topic_msg_id=None)
+                reply_msg = repositoy.get_message(
+                    wa_msg_id=reply_to, topic_msg_id=None, chat_id=None
+                )
             except NoResultFound:
                 pass
 
+        coalesce = media_group.can_coalesce(msg=msg, reply_msg=reply_msg)
+        if not coalesce:
+            # keep the order of the messages, send the media that waits before this message
+            await media_group.flush(wa_user_id=wa_user_id, phone_id=phone_id)
+
         kwargs = dict(
             chat_id=send_to,
             reply_parameters=tg_types.ReplyParameters(
@@ -200,9 +259,45 @@ async def get_message(_: WhatsApp, msg: wa_types.Message):
         )
 
         try:
+            media_url = None
             if msg.has_media:
-                download = io.BytesIO(await msg.get_media_bytes())
-                download.name = f"{msg.type}{msg.media.extension or ''}"
+                # reuse the file if it was already uploaded to telegram
+                download = media_reuse.get_media_id(
+                    key_type=modules.MediaKeyType.WA_SHA256, key=media_reuse.get_wa_key(msg)
+                )
+                if download is None:  # get the size before downloading
+                    media_url = await wa.get_media_url(media_id=msg.media.id)
+
+            if media_url is not None and media_url.file_size > _get_upload_limit(msg.type):
+                _logger.debug(f"{msg.type} of {media_url.file_size} bytes is too big for telegram")
+                await media_group.flush(wa_user_id=wa_user_id, phone_id=phone_id)  # the notice is after the group
+                sent = await clients.tg_bot.send_message(
+                    **kwargs,
+                    text=f"__The user sent {msg.type} of {media_url.file_size / 1024 / 1024:.1f} MB, "
+                    f"more than {_get_upload_limit(msg.type) / 1024 / 1024:.0f} MB that can be sent to Telegram__",
+                )
+
+            elif msg.has_media:
+                if download is None:
+                    async with asyncio.timeout(_get_download_timeout(media_url.file_size)):
+                        download = memory.track(
+                            io.BytesIO(await wa.get_media_bytes(url=media_url.url)),
+                            "wa_to_tg",
+                        )
+                    download.name = f"{msg.type}{msg.media.extension or ''}"
+                trace.mark("download")
+                if coalesce:
+                    await media_group.add(
+                        msg=msg,
+                        wa_user_id=wa_user_id,
+                        phone_id=phone_id,
+                        chat_id=send_to,
+                        topic_id=topic_id,
+                        media=download,
+                        caption=text,
+                    )
+                    return
+
                 media_kwargs = dict(
                     **kwargs,
                     caption=text,
@@ -325,9 +420,9 @@ async def get_message(_: WhatsApp, msg: wa_types.Message):
             _logger.debug("his topic was deleted, creating new topic..")
             try:
                 new_topic_id = await utils.create_topic(
-                    clients.tg_bot, wa_user_id, user.name, is_new=False
+                    clients.tg_bot, wa_user_id, user.name, is_new=False, chat_id=send_to
                 )
-                repositoy.update_topic(tg_topic_id=topic_id, topic_id=new_topic_id)
+                repositoy.update_topic(tg_topic_id=topic_id, chat_id=send_to, topic_id=new_topic_id)
             except Exception:  # noqa
                 _logger.exception(
                     "Error creating topic: ",
@@ -335,17 +430,24 @@ async def get_message(_: WhatsApp, msg: wa_types.Message):
                 return
             continue
 
-        except httpx.ReadTimeout:
+        except (httpx.ReadTimeout, TimeoutError):
             _logger.debug("Timeout sending message to telegram")
+            timeout = (
+                _get_download_timeout(media_url.file_size)
+                if media_url is not None
+                else settings.httpx_timeout
+            )
+            await media_group.flush(wa_user_id=wa_user_id, phone_id=phone_id)  # the notice is after the group
             sent = await clients.tg_bot.send_message(
                 **kwargs,
-                text=f"__The user send {msg.type} message but the download failed because timeout set to {settings.httpx_timeout} __",
+                text=f"__The user send {msg.type} message but the download failed because timeout set to {timeout:.0f} __",
             )
 
         except Exception as e:  # noqa
             _logger.exception(
                 "Error sending message: ",
             )
+        trace.mark("tg_upload")
 
         if sent:
             repositoy.create_message(
@@ -354,7 +456,19 @@ async def get_message(_: WhatsApp, msg: wa_types.Message):
                 wa_msg_id=msg.id,
                 topic_msg_id=sent.id,
                 sent_from_tg=False,
+                phone_id=phone_id,
+                chat_id=send_to,
+                text=msg.text or msg.caption,
             )
+            read_receipts.set_unread(wa_user_id=wa_user_id, wa_msg_id=msg.id, phone_id=phone_id)
+            if msg.has_media and isinstance(download, io.BytesIO):
+                media_reuse.save_media_id(
+                    key_type=modules.MediaKeyType.WA_SHA256,
+                    key=media_reuse.get_wa_key(msg),
+                    media_id=media_reuse.get_file_id(sent),
+                )
+            trace.mark("db_write")
+        trace.finish()
         break
 
 